@@ -20,6 +20,34 @@ import logging
 import re
 import argparse
 import shutil
+import bisect
+import functools
+import concurrent.futures
+import threading
+import collections
+import time
+import json
+import hashlib
+import tempfile
+import tarfile
+import errno
+import contextlib
+import cProfile
+import pstats
+import tracemalloc
+import configparser
+import socket
+import sqlite3
+
+try:
+    import pypdf
+except ImportError:  # Only needed by the 'merge' collation backend
+    pypdf = None
+
+try:
+    import inotify_simple
+except ImportError:  # Watch mode polls directories without it
+    inotify_simple = None
 
 # Location for finished, collated reports
 FIN_REPORTS = ''
@@ -29,8 +57,111 @@ REVD_REPORTS = ''
 AUS_COCS = ''
 CORP_COCS = ''
 PT_COCS = ''
+# CoC sources (sites) by name, in lookup order, from the config file. When
+# none are configured the three folders above are used.
+COC_SOURCES = {}
+# Config file read when --config isn't given, if it exists
+CONFIG_FILE = os.path.expanduser('~/.PDF_collator.ini')
 # Folder to copy reports into after collation
 BILLINGS = ''
+# Record of the reports already copied to BILLINGS
+BILLING_MANIFEST = os.path.expanduser('~/.PDF_collator_billed.json')
+# Reports to copy to BILLINGS at the same time
+BILLING_JOBS = 4
+# Reports and PDFs put off by the 'defer' policies, collated first next run
+QUEUE_FILE = os.path.expanduser('~/.PDF_collator_queue.json')
+# What to do, without asking, about reports with missing PDFs, PDFs with no
+# CoC, and running on something other than OS X
+INTERACTIVE_POLICIES = {'missing_pdfs': 'prompt',
+                        'missing_coc': 'ignore',
+                        'platform': 'prompt'}
+BATCH_POLICIES = {'missing_pdfs': 'defer',
+                  'missing_coc': 'defer',
+                  'platform': 'continue'}
+# Seconds a worker's claim on a spool job lasts without a heartbeat before
+# another worker may take the job over
+LEASE_SECONDS = 300
+# Seconds between checks of the spool for new jobs or results
+SPOOL_POLL = 1.0
+# Warn when no worker has claimed a job for this many seconds, and stop
+# waiting for workers after SPOOL_TIMEOUT seconds with no progress
+SPOOL_IDLE_WARN = 60
+SPOOL_TIMEOUT = 3600
+# Append-only record of each step of the last run, for --resume and --clean
+JOURNAL = os.path.expanduser('~/.PDF_collator_journal')
+# Where inputs go after their report is collated. Each day's inputs are
+# kept in a YYYY-MM-DD folder, later bundled into YYYY-MM-DD.tar
+ARCHIVE = os.path.expanduser('~/.PDF_collator_archive')
+# Seconds between bundles of the archive's old day folders in --watch mode
+COMPACT_INTERVAL = 3600
+# File to write run metrics to when --profile is given without --metrics
+METRICS_FILE = 'collator_metrics.json'
+# SQLite database every run's reports are added to, for --stats
+HISTORY_DB = os.path.expanduser('~/.PDF_collator_history.sqlite')
+# Cache of collated reports, keyed on their inputs. Disabled when empty.
+CACHE_DIR = ''
+# Largest total size of the cache before old reports are evicted
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+# Key the cache on file contents instead of modification times
+CACHE_HASH = False
+# Local scratch directory that reports are collated in before being moved
+# to FIN_REPORTS. Disabled when empty.
+STAGE_DIR = ''
+# Reports to copy into STAGE_DIR ahead of those being collated
+STAGE_AHEAD = 2
+# Ghostscript executable used by the 'gs' collation backends
+GS_EXECUTABLE = 'gs'
+# Seconds to wait for each mount, folder or ghostscript probe in
+# system_checks before treating it as dead
+CHECK_TIMEOUT = 5.0
+# Passed system checks are remembered here for CHECK_TTL seconds
+CHECK_CACHE = os.path.expanduser('~/.PDF_collator_checks.json')
+CHECK_TTL = 300
+# Ghostscript options shared by every collation
+GS_OPTIONS = ["-q", # Quiet mode
+              "-dNOPAUSE",
+              "-sDEVICE=pdfwrite",
+              "-dAutoRotatePages=/PageByPage"]
+# Compression profiles: ghostscript options added after GS_OPTIONS. Later
+# options override earlier ones, so profiles may change the rotation.
+GS_PROFILES = {
+    # Ghostscript's own defaults, as always used before profiles
+    'default': [],
+    # Quickest: no page rotation, scanned JPEGs kept as they are
+    'fast': ["-dPDFSETTINGS=/default",
+             "-dAutoRotatePages=/None",
+             "-dPassThroughJPEGImages=true",
+             "-dDownsampleColorImages=false",
+             "-dDownsampleGrayImages=false",
+             "-dDownsampleMonoImages=false"],
+    # Smaller files: images downsampled to 150 dpi (mono 300 dpi)
+    'balanced': ["-dPDFSETTINGS=/ebook",
+                 "-dDownsampleColorImages=true",
+                 "-dColorImageResolution=150",
+                 "-dDownsampleGrayImages=true",
+                 "-dGrayImageResolution=150",
+                 "-dDownsampleMonoImages=true",
+                 "-dMonoImageResolution=300",
+                 "-dDetectDuplicateImages=true"],
+    # Print quality for long-term storage: images kept up to 300 dpi
+    'archival': ["-dPDFSETTINGS=/prepress",
+                 "-dColorImageResolution=300",
+                 "-dGrayImageResolution=300",
+                 "-dMonoImageResolution=600",
+                 "-dDetectDuplicateImages=true"],
+}
+# Retry a report whose output is more than this many times the size of
+# its inputs (0 turns the check off)
+BALLOON_RATIO = 1.0
+# (backend, profile) pairs tried in turn on a ballooned report. The
+# smallest output is kept.
+BALLOON_FALLBACKS = [('gs', 'fast'), ('gs', 'balanced'), ('merge', 'default')]
+# Adaptive profile selection: reports averaging more than this many bytes
+# per page are large scans worth downsampling...
+ADAPTIVE_LARGE_PAGE = 1024 ** 2
+# ...and reports smaller than this in total have little to gain from
+# anything but the fastest profile.
+ADAPTIVE_SMALL_REPORT = 256 * 1024
 
 __author__ = "Graham Leva"
 __copyright__ = "2015, AnalySys, Inc."
@@ -43,8 +174,111 @@ __maintainer__ = "Graham Leva"
 __email__ = "gleva@analysysinc.com"
 __status__ = "Testing"
 
+logger = logging.getLogger('PDF_collator')
+
+# Most spans kept in METRICS. Older spans are dropped first, so a
+# long --watch or --worker process doesn't grow without bound.
+METRICS_MAX = 100000
+# Timed spans recorded during this run, see span()
+METRICS = collections.deque(maxlen=METRICS_MAX)
+_metrics_lock = threading.Lock()
+
+
+# Need to account for repeat files - 400-400coc.pdf
+# What if two reports needing the same file. Different function - find_cocs
+# Need to account for report ranges decrementing instead of incrementing.
+# Any CoC or reviewed PDF name: 123456coc.pdf, 123456a-460acoc.pdf,
+# QC123-456coc.pdf, 123456pg1.pdf. Parsed into a NameRecord by parse_name.
+name_RE = re.compile('(?P<sample>(?P<prefix>QC|WP|SP)[\\d]{3}-[\\d]{3}|[\\d]{6})'
+                     '(?P<rerun>[a-d])?'
+                     '(-(?P<last>[\\d]{3})(?P<last_rerun>[a-d])?)?'
+                     '(coc|pg(?P<page>[\\d]))\\.pdf')
+# Scanner prefix of reviewed PDFs
+prefix_RE = re.compile('^job_[\\d]*[\\s]{1}')
+# Day folders in the archive: YYYY-MM-DD
+archive_day_RE = re.compile('[\\d]{4}-[\\d]{2}-[\\d]{2}')
+
+
+def ask(question):
+    """Ask the user a yes or no 'question' until they answer. Returns
+    `True` for yes."""
+    ans = input(question + " (y/n)\n")
+    while True:
+        lower_ans = str(ans).lower()
+        if lower_ans == 'y' or lower_ans == 'yes':
+            return True
+        elif lower_ans == 'n' or lower_ans == 'no':
+            return False
+        else:
+            print("Yes ('y') or no ('n'), please.")
+            ans = input(question + " (y/n)\n")
+
+
+def coc_sources():
+    """Return the CoC sources to use: a dictionary of site names to CoC
+    directories, in lookup order."""
+    if COC_SOURCES:
+        return COC_SOURCES
+    return {'aus': AUS_COCS, 'corp': CORP_COCS, 'pt': PT_COCS}
+
+
+def coc_directories():
+    """Return the list of CoC directories, in lookup order."""
+    return list(coc_sources().values())
+
+
+def load_config(path):
+    """Read folder locations and CoC sources from an INI file.
+
+    The file looks like:
 
-def system_checks():
+        [paths]
+        fin_reports = /Volumes/Data/Final Reports
+        revd_reports = /Volumes/Data/Reviewed Reports
+        billings = /Volumes/Admin/Billings
+
+        [coc:austin]
+        root = /Volumes/scans/Austin CoCs
+
+        [coc:corpus]
+        root = /Volumes/scans/Corpus CoCs
+
+    Any number of '[coc:<site>]' sections may be given; CoCs are looked
+    up in the order the sections appear. Every key in '[paths]' is
+    optional.
+
+    Raises `ValueError` if the file can't be read or a CoC source has no
+    root.
+    """
+    global FIN_REPORTS, REVD_REPORTS, BILLINGS, COC_SOURCES
+    config = configparser.ConfigParser()
+    try:
+        if not config.read(path):
+            raise ValueError("Config file {0} not found.".format(path))
+    except configparser.Error as e:
+        raise ValueError("Config file {0} is not valid: {1}".format(path, e))
+
+    sources = {}
+    for section in config.sections():
+        if not section.startswith('coc:'):
+            continue
+        root = config[section].get('root')
+        if not root:
+            raise ValueError("CoC source '{0}' in {1} has no root.".format(
+                section[4:], path))
+        sources[section[4:]] = os.path.expanduser(root)
+
+    if config.has_section('paths'):
+        paths = config['paths']
+        FIN_REPORTS = os.path.expanduser(paths.get('fin_reports', FIN_REPORTS))
+        REVD_REPORTS = os.path.expanduser(paths.get('revd_reports',
+                                                    REVD_REPORTS))
+        BILLINGS = os.path.expanduser(paths.get('billings', BILLINGS))
+    COC_SOURCES = sources
+    return sources
+
+
+def system_checks(platform='prompt', ghostscript=True):
     """Check required software is installed and that remote file system
     directories are mounted.
 
@@ -55,68 +289,256 @@ def system_checks():
       - Ghostscript install is present on the machine
 
     Returns `False` in the event that any of the checks fail. Users
-    can override the OS X requirement.
+    can override the OS X requirement: 'platform' is 'prompt' to ask,
+    'continue' to carry on after the warning, or 'abort' to fail.
+
+    Mounts and folders are probed concurrently with `probe_paths`, and
+    ghostscript is found with `find_ghostscript` unless 'ghostscript' is
+    `False`. Checks that passed within the last CHECK_TTL seconds are not
+    repeated.
     """
+    global GS_EXECUTABLE
     dir_list = ['Data', 'scans', 'Admin']
 
     # Check operating system
     if os.uname().sysname != 'Darwin':
         print()
         print("Warning! This program was only designed to run on Mac OS X")
-        ans = input("Run at your own risk. Continue? (y/n)\n")
-        while True:
-            lower_ans = str(ans).lower()
-            if lower_ans == 'y' or lower_ans == 'yes':
-                # Continue with checks
-                break
-            elif lower_ans == 'n' or lower_ans == 'no':
-                return False
-            else:
-                print("Yes ('y') or no ('n'), please.")
-                ans = input("Continue program? (y/n)\n")
+        if platform == 'abort':
+            return False
+        elif platform == 'prompt' and not ask("Run at your own risk. "
+                                              "Continue?"):
+            return False
+
+    cache = load_check_cache()
+    now = time.time()
+    fresh = {path for path, checked in cache['paths'].items()
+             if now - checked < CHECK_TTL}
+
+    # Probe every mount and folder at once, so a dead share costs one
+    # CHECK_TIMEOUT rather than one per folder
+    mounts = [os.path.join('/Volumes', d) for d in dir_list]
+    folders = [FIN_REPORTS, REVD_REPORTS, BILLINGS] + coc_directories()
+    found = probe_paths([p for p in mounts + folders if p not in fresh])
+    for path, exists in found.items():
+        if exists:
+            cache['paths'][path] = now
+    found.update(dict.fromkeys(fresh, True))
 
     # Check correct volumes from file server mounted
-    for d in dir_list:
-        if os.path.exists(os.path.join('/Volumes', d)): # Directory is mounted
+    for d, mount in zip(dir_list, mounts):
+        if found[mount]: # Directory is mounted
             continue
         else:
             print()
             print()
-            print("This program cannot run unless you have the '{0}' folder "
-                  "mounted.".format(d))
+            if found[mount] is None:
+                print("The '{0}' folder is not responding.".format(d))
+            else:
+                print("This program cannot run unless you have the '{0}' "
+                      "folder mounted.".format(d))
             print("Please connect to the file server ('New Server') and run this"
                   " program again.\n")
+            save_check_cache(cache)
             return False
 
     # Test specific directories exist
-    for folder in [FIN_REPORTS, REVD_REPORTS, AUS_COCS, CORP_COCS, BILLINGS]:
-        if os.path.exists(folder):
+    for folder in folders:
+        if found[folder]:
             continue
         else:
             print("The folder {0} is not accessible. Please make sure you can"
                   " navigate to the folder before running this"
                   " program again.\n".format(folder))
+            save_check_cache(cache)
             return False
 
     # Test for ghostscript executable
     # Download OS X version from http://pages.uoregon.edu/koch/
     # At time of writing, 9.18 was the current version
     gs_download = 'http://pages.uoregon.edu/koch'
-    gs_path = '/usr/local/bin/gs'
 
-    if not os.path.exists(gs_path):
-        print("The ghostscript program is needed for report collation."
-              " Please download it from {0}, install it  and rerun this"
-              " program.".format(gs_download))
-        return False
+    if not ghostscript:
+        save_check_cache(cache)
+        return True
+    gs = cache['gs']
+    if (not gs or gs['executable'] != GS_EXECUTABLE or
+            now - gs['checked'] >= CHECK_TTL):
+        gs = find_ghostscript()
+        if gs is None:
+            print("The ghostscript program is needed for report collation."
+                  " Please download it from {0}, install it  and rerun this"
+                  " program.".format(gs_download))
+            save_check_cache(cache)
+            return False
+        gs['checked'] = now
+        cache['gs'] = gs
+    if shutil.which(GS_EXECUTABLE) is None:
+        # Only in /usr/local/bin, which OS X apps don't have on the PATH
+        GS_EXECUTABLE = gs['path']
+    logger.info("Using ghostscript %s at %s", gs['version'], gs['path'])
 
+    save_check_cache(cache)
     return True
 
 
-def file_check(directory):
+def probe_paths(paths, timeout=None):
+    """Check whether each of 'paths' exists, all at the same time.
+
+    Each check runs on its own daemon thread, so one that hangs on a
+    stale network mount is abandoned after 'timeout' seconds (default
+    CHECK_TIMEOUT) and never holds up the program's exit.
+
+    Returns a dictionary of each path to `True` or `False`, or `None`
+    if its check timed out.
+    """
+    if timeout is None:
+        timeout = CHECK_TIMEOUT
+    found = dict.fromkeys(paths)
+    threads = []
+
+    def probe(path):
+        found[path] = os.path.exists(path)
+
+    for path in found:
+        thread = threading.Thread(target=probe, args=(path,), daemon=True)
+        thread.start()
+        threads.append(thread)
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+    return dict(found)
+
+
+def find_ghostscript():
+    """Find GS_EXECUTABLE on the PATH (or in /usr/local/bin, where the OS
+    X installer puts it) and ask it for its version.
+
+    Returns a dictionary of 'executable' (GS_EXECUTABLE as given),
+    'path' and 'version', or `None` if ghostscript can't be found or
+    doesn't run.
+    """
+    executable = GS_EXECUTABLE
+    path = (shutil.which(executable) or
+            shutil.which(executable, path='/usr/local/bin'))
+    if path is None:
+        return None
+    try:
+        version = subprocess.run([path, '--version'], stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL,
+                                 timeout=CHECK_TIMEOUT, check=True)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return {'executable': executable, 'path': path,
+            'version': version.stdout.decode('latin-1').strip()}
+
+
+def load_check_cache():
+    """Return the remembered results of earlier system checks, as
+    {'paths': {path: time checked}, 'gs': `find_ghostscript` result
+    plus 'checked', or `None`}."""
+    try:
+        with open(CHECK_CACHE) as f:
+            cache = json.load(f)
+        return {'paths': dict(cache['paths']), 'gs': cache.get('gs')}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {'paths': {}, 'gs': None}
+
+
+def save_check_cache(cache):
+    """Write system check results to CHECK_CACHE. Failing to is not an
+    error; the checks are just run again next time."""
+    try:
+        write_json_atomically(CHECK_CACHE, cache)
+    except OSError:
+        pass
+
+
+def snapshot_directories(*directories):
+    """List each of 'directories' once, at the same time, with os.scandir.
+
+    Every stage of a run reads names and file stats from the returned
+    snapshot instead of listing and stat-ing the (network) directories
+    again. It is a dictionary of directories to dictionaries of file
+    names, e.g.
+        {'/Volumes/scans/reviewed': {'123456pg1.pdf': <DirEntry>, ...}}
+
+    Stats are fetched from each DirEntry the first time they are needed
+    and kept (see `file_stat`). '.DS_Store' files are left out.
+    """
+    def scan(directory):
+        with os.scandir(directory) as entries:
+            return {e.name: e for e in entries if e.name != '.DS_Store'}
+
+    directories = list(dict.fromkeys(os.path.normpath(d) for d in directories))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(directories))) as pool:
+        return dict(zip(directories, pool.map(scan, directories)))
+
+
+def list_directory(directory, snapshot=None):
+    """Return a list of the names in 'directory', without '.DS_Store'.
+
+    Names are read from 'snapshot' if it holds the directory, or listed
+    from the file system otherwise.
+    """
+    if snapshot is not None:
+        entries = snapshot.get(os.path.normpath(directory))
+        if entries is not None:
+            return list(entries)
+    names = os.listdir(directory)
+    if '.DS_Store' in names:
+        names.remove('.DS_Store')
+    return names
+
+
+def snapshot_rename(snapshot, directory, old, new):
+    """Record that 'old' was renamed to 'new' in 'directory' of a
+    snapshot. Does nothing if there is no snapshot."""
+    if snapshot is not None:
+        entries = snapshot.get(os.path.normpath(directory))
+        if entries is not None and old in entries:
+            # Stat by the new path the next time it is needed
+            del entries[old]
+            entries[new] = None
+
+
+def file_stat(path, snapshot=None):
+    """Return the os.stat_result for 'path', or `None` if the file does
+    not exist.
+
+    Files in a directory held by 'snapshot' are only stat-ed once; the
+    result is kept in the snapshot. A file that was not listed in the
+    snapshot is taken not to exist.
+    """
+    if snapshot is not None:
+        entries = snapshot.get(os.path.dirname(os.path.normpath(path)))
+        if entries is not None:
+            name = os.path.basename(path)
+            if name not in entries:
+                return None
+            entry = entries[name]
+            if not isinstance(entry, os.stat_result):
+                try:
+                    if entry is None:
+                        entry = os.stat(path)
+                    else:
+                        entry = entry.stat()
+                except OSError:
+                    return None
+                entries[name] = entry
+            return entry
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def file_check(directory, snapshot=None):
     """Test existence of files for collation in target directory.
 
-    Takes as argument a target `directory` to check for files in.
+    Takes as argument a target `directory` to check for files in, and
+    optionally a `snapshot` from `snapshot_directories` to read it from.
 
     Returns True if files exist and are relevant or False if
     either no files exist or files that exist are irrelevant (e.g.,
@@ -124,18 +546,122 @@ def file_check(directory):
     """
     # Consider checking for .afp_[\d]+ files in collation directory
 
-    if len(os.listdir(directory)) == 0:
-        return False
-    elif len(os.listdir(directory)) == 1 and '.DS_Store' in os.listdir(directory):
+    # .DS_Store is never listed
+    if len(list_directory(directory, snapshot)) == 0:
         return False
     else:
         return True    # Files exist and they're relevant
 
 
-def name_check(*args):
+class NameRecord:
+    """A CoC or reviewed PDF name, parsed once by `parse_name`.
+
+    'name' - the file name.
+    'prefix' - 'QC', 'WP' or 'SP' for those samples, otherwise ''.
+    'sample' - the sample number or QC/WP/SP number, without any rerun
+               letter: '123456', 'QC123-456'.
+    'rerun' - the rerun letter, or ''.
+    'key' - 'sample' and 'rerun' together, e.g. '123456a'. PDFs are
+            matched to CoCs by key.
+    'last' - for range CoCs, the last sample number of the range as an
+             integer, with the 1000s rollover applied; otherwise `None`.
+    'page' - the page number of a reviewed PDF, or `None` for a CoC.
+    'valid' - whether the name follows the naming scheme for its kind
+              (see `coc_name_ok` and `pdf_name_ok`).
+    """
+
+    __slots__ = ('name', 'prefix', 'sample', 'rerun', 'key', 'last', 'page',
+                 'valid')
+
+    def __init__(self, name, prefix, sample, rerun, last, page, valid):
+        self.name = name
+        self.prefix = prefix
+        self.sample = sample
+        self.rerun = rerun
+        self.key = sample + rerun
+        self.last = last
+        self.page = page
+        self.valid = valid
+
+    def __repr__(self):
+        return 'NameRecord({0!r})'.format(self.name)
+
+
+@functools.lru_cache(maxsize=1 << 18)
+def parse_name(name):
+    """Parse a CoC or reviewed PDF name into a `NameRecord`, or return
+    `None` if it isn't one.
+
+    Results are cached, so each name is only parsed once however many
+    stages look at it.
+    """
+    match = name_RE.fullmatch(name)
+    if match is None:
+        return None
+    prefix = match.group('prefix') or ''
+    sample = match.group('sample')
+    rerun = match.group('rerun') or ''
+    page = match.group('page')
+    page = None if page is None else int(page)
+    last = None
+    valid = True
+
+    if match.group('last') is not None and prefix:
+        # QC/WP/SP samples have no ranges: QC123-456-789coc.pdf
+        valid = False
+    elif match.group('last') is not None:
+        end = match.group('last')
+        # The end may only repeat the first number's rerun letter
+        last_rerun = match.group('last_rerun') or ''
+        diff = abs(int(end) - int(sample[3:]))
+        # First range number shouldn't match the second, and ranges
+        # must increment. If range is 400990-010, (incrementing) diff =
+        # 980; if range is 400990-960, (decrementing) diff = 30.
+        if ((last_rerun and last_rerun != rerun) or diff == 0 or
+                (int(end) < int(sample[3:]) and diff < 100)):
+            valid = False
+        # Second number only holds the last three digits
+        last = int(sample[:3] + end)
+        # Check for 1000s rollover (e.g. ...995-002)
+        if last < int(sample):
+            last += 1000
+
+    if page is not None:
+        # Reviewed PDFs are single samples: 123456pg1.pdf, QC123-456pg1.pdf
+        valid = valid and not rerun and match.group('last') is None
+    elif prefix and rerun:
+        valid = False
+    return NameRecord(name, prefix, sample, rerun, last, page, valid)
+
+
+def sample_key(name):
+    """Return the sample key of a CoC or PDF name ('123456a' for
+    '123456apg1.pdf'). Names that don't parse lose their last seven
+    characters ('pg1.pdf' or 'coc.pdf'), as they always have."""
+    record = parse_name(name)
+    return name[:-7] if record is None else record.key
+
+
+def index_pages(pdf_names):
+    """Group reviewed PDF names by sample key.
+
+    Returns a dictionary of sample keys to lists of PDF names, in the
+    order given, e.g.
+        {'123456': ['123456pg1.pdf', '123456pg2.pdf'],
+         '123456a': ['123456apg1.pdf']}
+    """
+    pages = {}
+    for name in pdf_names:
+        pages.setdefault(sample_key(name), []).append(name)
+    return pages
+
+
+def name_check(*args, snapshot=None):
     """Test for incorrect Chain of Custody labels before running each time.
 
-    Takes as arguments a series of directories to check CoC file names.
+    Takes as arguments a series of directories to check CoC file names,
+    and optionally a `snapshot` from `snapshot_directories` to read the
+    directories from.
 
     Returns a tuple, consisting of:
         - A list of bad file names, or None, if name check passes;
@@ -149,42 +675,11 @@ def name_check(*args):
     coc_list = []
     # Get list of all COCs
     for path in args:
-        coc_list.extend(os.listdir(path))
-        # Remove OS X-specific directory services store file
-        #clean_list = list(filter(lambda x: x != '.DS_Store', coc_list))
-        if '.DS_Store' in coc_list:  # Doing this with a list is inefficient
-            coc_list.remove('.DS_Store')
-
-    # Need to account for repeat files - 400-400coc.pdf
-    # What if two reports needing the same file. Different function - find_cocs
-    # Need to account for report ranges decrementing instead of incrementing.
-    coc_RE = re.compile('([\\d]{3}([\\d]{3})([a-d]{1})?(-([\\d]{3})(\\3)?)?coc\\.pdf$|(QC|WP|SP)([\\d]{3})-([\\d]{3})coc\\.pdf$)')
+        # OS X-specific directory services store files are left out
+        coc_list.extend(list_directory(path, snapshot))
 
     for i in coc_list:
-        match = coc_RE.fullmatch(i)
-        # Full match exists!
-        if match:
-            if i.startswith(("QC", "SP", "WP")):
-                # Don't worry about ranges for these samples.
-                continue
-            elif '-' in i:
-                first = int(match.group(2))
-                last = int(match.group(5))
-                diff = abs(last - first)
-                # First range number shouldn't match the second
-                if diff == 0:
-                    bad_names.append(i)
-                # Check that second group is incrementing
-                # If range is 400990-010, (incrementing) diff = 980
-                # If range is 400990-960, (decrementing) diff = 30
-                elif last < first and diff < 100:
-                    bad_names.append(i)
-                else:
-                    continue
-            else:
-                # Normal CoCs - 123456coc.pdf or 123456acoc.pdf
-                continue
-        else:
+        if not coc_name_ok(i):
             bad_names.append(i)
 
     if bad_names:
@@ -193,72 +688,384 @@ def name_check(*args):
         return (None, coc_list)
                 
 
+def coc_name_ok(name):
+    """Return `True` if 'name' is a correctly labelled Chain of Custody
+    file name, or `False` if it is not. Used by `name_check`."""
+    record = parse_name(name)
+    return record is not None and record.page is None and record.valid
+
+
+def pdf_name_ok(name):
+    """Return `True` if 'name' is a correctly labelled reviewed PDF
+    name, or `False` if it is not. Used by `strip_chars`."""
+    record = parse_name(name)
+    return record is not None and record.page is not None and record.valid
+
+
 def parser_setup():
-    """Parse command line arguments."""
+    """Parse command line arguments and return them."""
     parser = argparse.ArgumentParser(description='Rename scanned reports, find'
             ' Chain of Custodies (CoCs) and collate PDF reports.')
     # -h, --help is setup by default
-    parser.add_argument('-c', '--clean', help='Clean up temporary directories '
-                        'and reset files to starting positions.',
+    parser.add_argument('-c', '--clean', help='Roll back the unfinished steps '
+                        'of an interrupted run and reset files to starting '
+                        'positions.', action="store_true")
+    parser.add_argument('-j', '--jobs', help='Number of reports to collate '
+                        'at the same time (default: 1).', type=int, default=1)
+    parser.add_argument('--spool', help='Shared spool directory. Reports '
+                        'are written there as jobs and collated by --worker '
+                        'processes, on this host or others.')
+    parser.add_argument('--worker', help='Collate jobs from the --spool '
+                        'directory until interrupted.', action="store_true")
+    parser.add_argument('-w', '--watch', help='Keep running and collate '
+                        'each report as soon as all of its PDFs are present.',
+                        action="store_true")
+    parser.add_argument('--grace', help='With --watch, seconds to wait after '
+                        "a report's last file arrives before collating it, to "
+                        'allow for reruns (default: 60).', type=float,
+                        default=60.0)
+    parser.add_argument('--poll', help='With --watch, seconds between '
+                        'listings of network directories (default: 10).',
+                        type=float, default=10.0)
+    parser.add_argument('--archive', help='Move the inputs of collated '
+                        'reports into this directory (default: '
+                        '~/.PDF_collator_archive).')
+    parser.add_argument('--stage', help='Copy the inputs of each report '
+                        'to this local directory (default: /dev/shm, or the '
+                        'temporary directory) and collate there, copying the '
+                        'next reports while one renders.', nargs='?',
+                        const='auto')
+    parser.add_argument('--cache', help='Keep collated reports in this '
+                        'directory and reuse them when a report with the same '
+                        'inputs and settings is collated again.')
+    parser.add_argument('--cache-size', help='Largest size of the cache in '
+                        'MiB before the least recently used reports are '
+                        'removed (default: 2048).', type=int, default=2048)
+    parser.add_argument('--cache-hash', help='Match cached reports on input '
+                        'file contents rather than modification times.',
                         action="store_true")
+    parser.add_argument('-m', '--metrics', help='Write the time, counts '
+                        'and bytes of each stage of the run to this JSON '
+                        'file.')
+    parser.add_argument('-p', '--profile', help='Also profile the run with '
+                        'cProfile and tracemalloc, and add the results to the '
+                        'metrics file (default: {0}).'.format(METRICS_FILE),
+                        action="store_true")
+    parser.add_argument('-v', '--verbose', help='Log the time taken by each '
+                        'stage as it finishes.', action="store_true")
+    parser.add_argument('-b', '--backend', help='Collation backend: '
+                        "'gs' re-renders and compresses pages, 'merge' joins "
+                        "pages without re-encoding (default: gs).",
+                        choices=sorted(COLLATION_BACKENDS), default='gs')
+    parser.add_argument('-z', '--compression', help='Ghostscript compression '
+                        "profile: 'fast', 'balanced', 'archival', or "
+                        "'adaptive' to pick one per report from its size "
+                        "and page count (default: ghostscript's defaults).",
+                        choices=sorted(GS_PROFILES) + ['adaptive'],
+                        default='default')
+    parser.add_argument('--balloon-ratio', help='Collate a report again with '
+                        'other profiles and backends when it comes out more '
+                        'than this many times the size of its inputs, and '
+                        'keep the smallest (default: 1.0; 0 turns it off).',
+                        type=float, default=BALLOON_RATIO)
+    parser.add_argument('-r', '--resume', help='Finish the last run if it '
+                        'was interrupted, without redoing reports that were '
+                        'already collated.', action="store_true")
+    parser.add_argument('--stats', help='Print timing, throughput and size '
+                        'reduction percentiles and trends from the history '
+                        'of earlier runs, then exit.', action="store_true")
+    parser.add_argument('--stats-days', help='With --stats, only include '
+                        'runs from the last this many days.', type=int)
+    parser.add_argument('--plan', help='Match PDFs to CoCs and write the '
+                        'reports that would be collated to this JSON file '
+                        "('-' for standard output), without renaming, "
+                        'collating or archiving anything.')
+    parser.add_argument('--execute', help='Collate the reports in a plan '
+                        'written earlier by --plan.', metavar='PLAN')
+    parser.add_argument('--config', help='Read folder locations and CoC '
+                        'sources from this INI file (default: '
+                        '~/.PDF_collator.ini, if it exists).')
+    parser.add_argument('--batch', help='Never wait for an answer: '
+                        'reports with missing PDFs and PDFs with no CoC are '
+                        'deferred to the next run, and platform warnings '
+                        'are ignored, unless the policies below say '
+                        'otherwise.', action="store_true")
+    parser.add_argument('--missing-pdfs', help='What to do with reports '
+                        "missing PDFs from their CoC range: 'prompt', "
+                        "'skip', 'partial' to collate what is there, or "
+                        "'defer' to try again first next run.",
+                        choices=['prompt', 'skip', 'partial', 'defer'])
+    parser.add_argument('--missing-coc', help='What to do with PDFs that '
+                        "have no CoC: 'ignore', 'defer' to list them for "
+                        "the next run, or 'abort' to stop before "
+                        "collating anything.",
+                        choices=['ignore', 'defer', 'abort'])
+    parser.add_argument('--platform', help='What to do when not running on '
+                        "OS X: 'prompt', 'continue' or 'abort'.",
+                        choices=['prompt', 'continue', 'abort'])
     args = parser.parse_args()
-    if args.clean:
-        # do something
-        print("Cleaning in progress...")
-        print('...')
-        clean()
-        print("Cleaning complete.")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.worker and not args.spool:
+        parser.error("--worker needs a --spool directory")
+    policies = BATCH_POLICIES if args.batch else INTERACTIVE_POLICIES
+    for name, policy in policies.items():
+        if getattr(args, name) is None:
+            setattr(args, name, policy)
+    if args.batch and 'prompt' in (args.missing_pdfs, args.platform):
+        parser.error("--batch can't be used with 'prompt' policies")
+
+    return args
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def open_journal(resume=False):
+    """Open the run journal (JOURNAL) for a new run, or for resuming the
+    last one if 'resume' is `True`.
+
+    A new run replaces the journal of the previous, finished run.
+    """
+    global _journal
+    _journal = open(JOURNAL, 'a' if resume else 'w')
+    journal('resume' if resume else 'start', version=__version__)
+
+
+def journal(step, **fields):
+    """Append one step to the run journal, if one is open.
+
+    'step' - the kind of step: 'rename', 'plan', 'collate', 'dispose',
+             'bill' or 'end'.
+    'fields' - details needed to resume or roll back the step, e.g.
+               report=report_name, status='start'.
+
+    Each record is written as a line of JSON and synced to disk before
+    returning, so the journal survives a crash at any point.
+    """
+    if _journal is None:
+        return
+    record = {'step': step, 'time': time.time()}
+    record.update(fields)
+    with _journal_lock:
+        _journal.write(json.dumps(record) + '\n')
+        _journal.flush()
+        os.fsync(_journal.fileno())
+
+
+def close_journal(**fields):
+    """Record that the run finished and close the journal."""
+    global _journal
+    journal('end', **fields)
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+
+
+def read_journal():
+    """Return the list of records in the run journal. A last line cut
+    short by a crash is ignored."""
+    records = []
+    try:
+        with open(JOURNAL) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def journal_state(records):
+    """Work out how far the run in 'records' got.
+
+    Returns `None` if the run finished (or there is no journal), or a
+    dictionary describing the unfinished run:
+        'plan' - the plan the run was executing (see `execute`), or
+                 `None` if it stopped before planning finished;
+        'renames' - (directory, old, new) for each file whose scanner
+                    prefix was stripped;
+        'collating' - report names to the output files being collated;
+        'collated' - report names to the stats of finished collations;
+        'disposing' - report names to the (source, destination) moves
+                      of disposals that were started;
+        'disposed', 'billed' - sets of report names done.
+    """
+    if not records or records[-1]['step'] == 'end':
+        return None
+
+    state = {'plan': None, 'renames': [], 'collating': {}, 'collated': {},
+             'disposing': {}, 'disposed': set(), 'billed': set()}
+    for record in records:
+        step, status = record['step'], record.get('status')
+        if step == 'plan':
+            state['plan'] = record['plan']
+        elif step == 'rename':
+            state['renames'].append((record['directory'], record['old'],
+                                     record['new']))
+        elif step == 'collate' and status == 'start':
+            state['collating'][record['report']] = record['output']
+        elif step == 'collate' and status == 'done':
+            state['collated'][record['report']] = record['stats']
+        elif step == 'dispose' and status == 'start':
+            state['disposing'][record['report']] = record['moves']
+        elif step == 'dispose' and status == 'done':
+            state['disposed'].add(record['report'])
+        elif step == 'bill':
+            state['billed'].add(record['report'])
+    return state
 
 
 def clean():
     """Clean the working directory and reset files back to their starting
-       positions.
+    positions, after a run was interrupted.
+
+    Using the run journal, the unfinished steps of the last run are
+    rolled back:
+        - partly written reports are deleted,
+        - files moved to the archive by an unfinished disposal are moved
+          back, and
+        - PDFs that strip_chars renamed, and that are still in the
+          reviewed reports folder, get their original names back.
+    Reports that were collated and disposed of are left alone.
+
+    Returns a dictionary counting each kind of change, or `None` if the
+    last run finished and there is nothing to clean.
+    """
+    state = journal_state(read_journal())
+    if state is None:
+        return None
+
+    cleaned = {'reports': 0, 'restored': 0, 'renamed': 0}
+    for report_name, output in state['collating'].items():
+        if report_name not in state['collated'] and os.path.exists(output):
+            os.remove(output)
+            cleaned['reports'] += 1
+
+    for report_name, moves in state['disposing'].items():
+        if report_name in state['disposed']:
+            continue
+        for source, destination in moves:
+            if os.path.exists(destination) and not os.path.exists(source):
+                shutil.move(destination, source)
+                cleaned['restored'] += 1
+
+    for directory, old, new in reversed(state['renames']):
+        new_path = os.path.join(directory, new)
+        old_path = os.path.join(directory, old)
+        if os.path.exists(new_path) and not os.path.exists(old_path):
+            os.rename(new_path, old_path)
+            cleaned['renamed'] += 1
+
+    open_journal(resume=True)
+    close_journal(cleaned=cleaned)
+    return cleaned
+
+
+# Renames deferred by strip_chars, by directory: each file's name without
+# the scanner prefix, to the name it is still stored under, e.g.
+#     {REVD_REPORTS: {'123456pg1.pdf': 'job_2055 123456pg1.pdf'}}
+PENDING_RENAMES = {}
+_renames_lock = threading.Lock()
+
+
+def physical_path(directory, name):
+    """Return the full path 'name' is stored under in 'directory', which
+    is still its scanner-prefixed name if strip_chars deferred the
+    rename."""
+    with _renames_lock:
+        name = PENDING_RENAMES.get(directory, {}).get(name, name)
+    return os.path.join(directory, name)
+
+
+def forget_renames(directory, names):
+    """Drop the deferred renames of 'names', e.g. once the files have been
+    archived under their stripped names."""
+    with _renames_lock:
+        pending = PENDING_RENAMES.get(directory, {})
+        for name in names:
+            pending.pop(name, None)
+
+
+def apply_renames(snapshot=None):
+    """Carry out every rename deferred by strip_chars, in one batch at the
+    end of a run. Files that have gone (archived, or removed by hand) are
+    skipped.
+
+    Each rename is recorded in the run journal, so `clean` can undo it.
+
+    Returns the number of files renamed.
     """
-    # Note, if properly handling exceptions and errors, and also maybe using
-    # temporary file systems, this method could become obsolete. That would be
-    # a good thing!
-    return NotImplementedError
+    with _renames_lock:
+        pending = {d: names for d, names in PENDING_RENAMES.items() if names}
+        PENDING_RENAMES.clear()
+
+    renamed = 0
+    for directory, names in pending.items():
+        for new, old in sorted(names.items()):
+            try:
+                os.rename(os.path.join(directory, old),
+                          os.path.join(directory, new))
+            except FileNotFoundError:
+                continue
+            snapshot_rename(snapshot, directory, old, new)
+            journal('rename', directory=directory, old=old, new=new)
+            renamed += 1
+    return renamed
 
 
-def strip_chars(directory):
+def strip_chars(directory, snapshot=None, defer=False):
     """Strip leading characters from file names in a specified directory. 
 
     Pattern is of the form 'job_####', where '#' can be any number of 
     numbers, but usually less than five, followed by a single space.
 
+    If a `snapshot` from `snapshot_directories` is given, the directory
+    is read from it, and it is updated with the new names.
+
+    If 'defer' is `True`, no files are renamed. The stripped names are
+    returned as usual, and PENDING_RENAMES records what each one is
+    still stored under (see `physical_path`). The renames are done later
+    by `apply_renames`, or not at all when the file is archived first.
+
     Function should return a tuple consisting of:
         - a list of the directory's contents (valid names only), and
         - None (in the event that no bad file names were found), or a
           list of bad file names if any were found.
     """
-    prefix_RE = re.compile('^job_[\\d]*[\\s]{1}')
-    name_RE = re.compile('^[\\d]{6}pg[0-9]{1}\\.pdf$|(QC|WP|SP)([\\d]{3})-([\\d]{3})pg[0-9]{1}\\.pdf$')
-
     # New operations
     bad_pdf_names = []
-    dirlist = os.listdir(directory)
-
-    if '.DS_Store' in dirlist:
-        dirlist.remove('.DS_Store')
+    dirlist = list_directory(directory, snapshot)
 
     i = 0
     while i < len(dirlist):
         if dirlist[i].startswith('job'):
             try:
                 new = re.split(prefix_RE, dirlist[i])[1]
-                os.rename(os.path.join(directory, dirlist[i]),
-                          os.path.join(directory, new))
+                if defer:
+                    with _renames_lock:
+                        PENDING_RENAMES.setdefault(directory, {})[new] = \
+                            dirlist[i]
+                else:
+                    os.rename(os.path.join(directory, dirlist[i]),
+                              os.path.join(directory, new))
+                    snapshot_rename(snapshot, directory, dirlist[i], new)
+                    journal('rename', directory=directory, old=dirlist[i],
+                            new=new)
                 # Update the list with new name
                 dirlist[i] = new
                 # Check validity of new name
-                if not name_RE.fullmatch(dirlist[i]):
+                if not pdf_name_ok(dirlist[i]):
                     bad_pdf_names.append(dirlist[i])
                 i += 1
             except IndexError:
                 bad_pdf_names.append(dirlist[i])
                 i += 1
         else:
-            if not name_RE.fullmatch(dirlist[i]):
+            if not pdf_name_ok(dirlist[i]):
                 bad_pdf_names.append(dirlist[i])
             i += 1
 
@@ -270,7 +1077,79 @@ def strip_chars(directory):
         return (valid_names, None)
 
 
-def find_coc(coc_list, coc_tuple, pdf_name):
+def coc_locator(coc_tuple, directories=None):
+    """Return a function mapping a CoC name to its full path, or `None`
+    for a name that is in none of the sets.
+
+    Each name in 'coc_tuple' is resolved to its directory once, up
+    front, so a lookup costs the same however many CoC sources there
+    are. A name in several sets belongs to the first.
+    'directories' defaults to `coc_directories()`.
+    """
+    if directories is None:
+        directories = coc_directories()
+
+    locations = {}
+    for names, directory in reversed(list(zip(coc_tuple, directories))):
+        for name in names:
+            locations[name] = directory
+
+    def locate(name):
+        directory = locations.get(name)
+        if directory is None:
+            return None
+        return os.path.join(directory, name)
+
+    return locate
+
+
+def index_cocs(coc_list, coc_tuple, coc_dirs=None):
+    """Build a lookup table of CoC locations, keyed by sample number
+    and rerun letter. Built once per run and passed to `find_coc`.
+
+    Arguments:
+        'coc_list' - a list of CoCs that have already been checked for
+                     syntax mistakes.
+        'coc_tuple' - a tuple of sets of CoCs by directory (see
+                      `find_coc`).
+        'coc_dirs' - the directories matching each set in 'coc_tuple'.
+                     Defaults to `coc_directories()`.
+
+    Each CoC is stored under its sample key ('123456a', 'QC123-456')
+    and, for reruns, under the bare sample number as well ('123456'),
+    since `find_coc` matches PDF names by prefix. When several CoCs
+    share a key, the first one in 'coc_list' wins, which is what the
+    old linear scan returned.
+
+    Returns a dictionary of sample keys to full CoC paths, e.g.
+        {'123456': '/path/to/123456-460coc.pdf', ...}
+    """
+    locate = coc_locator(coc_tuple, coc_dirs)
+
+    coc_index = {}
+    for name in coc_list:
+        path = locate(name)
+        if path is not None:
+            add_to_coc_index(coc_index, name, path)
+
+    return coc_index
+
+
+def add_to_coc_index(coc_index, name, path):
+    """Add one CoC to an index from `index_cocs`, keeping any CoC that
+    is already stored under the same key.
+
+    'name' - the CoC file name, e.g. '123456acoc.pdf'.
+    'path' - the full path to the CoC.
+    """
+    record = parse_name(name)
+    if record is not None and record.page is None:
+        coc_index.setdefault(record.key, path)
+        if record.rerun:
+            coc_index.setdefault(record.sample, path)
+
+
+def find_coc(coc_list, coc_tuple, pdf_name, coc_index=None):
     """Finds and returns location of a Chain of Custody file given a
     list of all COCs, a tuple of sets of COCs by directory, and a
     single PDF name to use for pattern matching.
@@ -278,38 +1157,24 @@ def find_coc(coc_list, coc_tuple, pdf_name):
     Arguments:
         'coc_list' - a list of CoCs that have already been checked for
                      syntax mistakes.
-        'coc_tuple' - a tuple consisting of three sets, used for finding
-                      the location of a coc in the filesystem:
-                        * 'A_set' - Set of Austin CoCs.
-                        * 'C_set' - Set of Corpus CoCs.
-                        * 'P_set' - PT sample CoCs.
+        'coc_tuple' - a tuple of sets of CoC names, one for each CoC
+                      source in `coc_directories()` order, used for finding
+                      the location of a coc in the filesystem.
         'pdf_name' - A single pdf name provides the pattern used to search
                      for CoC matches.
+        'coc_index' - optional index from `index_cocs`. Callers looking
+                      up many PDFs should build it once and pass it in;
+                      otherwise one is built for this call.
 
     Returns path to Chain of Custody if the CoC was found, or 'None' in
     the event that it was not (e.g., '/path/to/123456coc.pdf').
     """
-    # Search for pdf in CoC directories
-    # Reconsider search algorithm - that's what it is.
-    pattern = pdf_name[:-7]
-    for i in coc_list:
-        if i.startswith(pattern):
-            # Austin CoC dir
-            if i in coc_tuple[0]:
-                return os.path.join(AUS_COCS, i)
-            # Corpus CoC dir
-            elif i in coc_tuple[1]:
-                return os.path.join(CORP_COCS, i)
-            # PT CoC dir
-            else:
-                return os.path.join(PT_COCS, i)
-        else:
-            continue
-    # No CoC found
-    return None
+    if coc_index is None:
+        coc_index = index_cocs(coc_list, coc_tuple)
+    return coc_index.get(sample_key(pdf_name))
 
 
-def backcheck(coc_name, pdf_stack):
+def backcheck(coc_name, pdf_stack, pages=None):
     """Checks the list of numbers indicated by the CoC file name to
     make sure the ranges a CoC represents are really present in the pdf
     directory.
@@ -323,6 +1188,9 @@ def backcheck(coc_name, pdf_stack):
                           coc name, and
         'missing_pdfs'  - A list of pdf numbers that were not found, or
                           `None`, if all were accounted for.
+
+    'pages' - optional index from `index_pages`, used instead of
+              'pdf_stack' when checking many CoCs against the same PDFs.
     """
 
     #QC --> ('QC123-456')
@@ -330,8 +1198,10 @@ def backcheck(coc_name, pdf_stack):
     #Single --> ('123456')
     required_pdfs = get_ranges(coc_name)
 
-    # Construct a set of present pdfs, taking off the 'pg?.pdf' suffixes
-    file_set = {f[:-7] for f in pdf_stack}
+    # Set of present sample keys
+    if pages is None:
+        pages = index_pages(pdf_stack)
+    file_set = pages.keys()
 
     # Want to check that all files, as indicated by get_ranges, are present
     # in the file_set. Extra files not in required_pdfs will be present!
@@ -343,6 +1213,23 @@ def backcheck(coc_name, pdf_stack):
         return list(required_pdfs), missing_pdfs
 
 
+def range_bounds(coc_name):
+    """Return the numeric bounds of a range CoC name.
+
+    'coc_name' - A CoC name, like '123990-010coc.pdf'.
+
+    Returns a tuple of (rerun character, first, last), where both ends
+    are inclusive integers and the 1000s rollover has already been
+    applied, e.g. '123990a-010acoc.pdf' returns ('a', 123990, 124010).
+    Returns `None` for CoCs that do not name a range (single numbers
+    and QC/WP/SP samples).
+    """
+    record = parse_name(coc_name)
+    if record is None or record.last is None:
+        return None
+    return record.rerun, int(record.sample), record.last
+
+
 def get_ranges(coc_name):
     """Return a set of ranges from a range coc string.
 
@@ -358,59 +1245,130 @@ def get_ranges(coc_name):
     name. If there are no ranges (like with QC/WP/SP samples or for single
     number CoCs), return the number itself.
     """
+    bounds = range_bounds(coc_name)
+    # No range at all - single number or QC/WP/SP CoC
+    if bounds is None:
+        return {sample_key(coc_name)}
 
-    # Cut 'coc.pdf'
-    r = coc_name[:-7]
-    if r.startswith(('QC', 'WP', 'SP')):
-        return {r}
-    elif '-' in r:
-        first, last = r.split('-')
-        last = first[:3] + last
-    # No range at all - single number CoC
-    else:
-        return {r}
+    rerun_char, first, last = bounds
+    return set((str(x) + rerun_char) for x in range(first, last + 1))
 
-    # handle rerun versus normal range CoC
-    if first.isnumeric():
-        first = int(first)
-        last = int(last) + 1
 
-        # Check for 1000s rollover (e.g. ...995-002)
-        if last < first:
-            last += 1000
+def index_ranges(coc_list, coc_tuple, coc_dirs=None):
+    """Build a sorted interval index of every range CoC in 'coc_list'.
 
-        return set(str(x) for x in list(range(first, last)))
-    # Rerun sample (e.g. 123456a-460a)
-    else:
-        # strip rerun characters off end
-        rerun_char = first[-1:]
-        first = int(first[:-1])
-        # Account for range() stopping at last, instead of including
-        last = int(last[:-1]) + 1
+    Arguments are the same as for `index_cocs`.
+
+    Returns a dictionary keyed by rerun character ('' for normal
+    samples). Each value is a list of (first, last, reach, path) tuples
+    sorted by range, where 'reach' is the highest 'last' seen so far in
+    the list. `find_range_coc` uses it to stop searching early, and
+    `range_overlaps` sweeps the same lists.
+
+    Example:
+        {'': [(123990, 124010, 124010, '/path/to/123990-010coc.pdf')],
+         'a': [(123456, 123460, 123460, '/path/to/123456a-460acoc.pdf')]}
+    """
+    locate = coc_locator(coc_tuple, coc_dirs)
+
+    range_index = {}
+    for name in coc_list:
+        bounds = range_bounds(name)
+        if bounds is None:
+            continue
+        rerun_char, first, last = bounds
+        path = locate(name)
+        if path is not None:
+            range_index.setdefault(rerun_char, []).append((first, last, path))
+
+    for rerun_char, intervals in range_index.items():
+        intervals.sort()
+        reach = None
+        indexed = []
+        for first, last, path in intervals:
+            reach = last if reach is None else max(reach, last)
+            indexed.append((first, last, reach, path))
+        range_index[rerun_char] = indexed
+
+    return range_index
+
+
+def find_range_coc(range_index, sample):
+    """Return the path of the range CoC covering 'sample', or `None`.
+
+    'range_index' - an index from `index_ranges`.
+    'sample' - a sample key such as '124003' or '124003a'.
+
+    Unlike `find_coc`, which only matches the first number of a range,
+    this finds the CoC for any sample inside the range. If several
+    ranges cover the sample, the one starting closest to it is
+    returned; `range_overlaps` reports those cases.
+    """
+    number, rerun_char = sample[:6], sample[6:]
+    if not number.isnumeric() or len(rerun_char) > 1:
+        return None
+    number = int(number)
+    intervals = range_index.get(rerun_char, [])
+
+    # Walk back from the last range starting at or before the sample,
+    # until no earlier range can reach it.
+    i = bisect.bisect_right(intervals, (number, float('inf')))
+    while i > 0:
+        i -= 1
+        first, last, reach, path = intervals[i]
+        if reach < number:
+            break
+        if last >= number:
+            return path
+    return None
 
-        # Check for 1000s rollover (e.g. ...995-002)
-        if last < first:
-            last += 1000
 
-        return set((str(x) + rerun_char) for x in list(range(first, last)))
+def range_overlaps(range_index):
+    """Find range CoCs that claim the same samples, in one sweep.
 
+    'range_index' - an index from `index_ranges`.
 
-def aggregator(coc_list, coc_tuple, missing_coc_list, pdf_stack, report_dict={}):
-    """Function takes in a list of missing cocs, stack of good pdf
-    names, and dictionary for collecting reports recursively. Returns two
+    Returns a list of tuples (first CoC path, second CoC path, samples)
+    where 'samples' is the sorted list of sample keys both CoCs claim,
+    e.g. [('/path/123450-460coc.pdf', '/path/123458-470coc.pdf',
+           ['123458', '123459', '123460'])]
+    """
+    overlaps = []
+    for rerun_char in sorted(range_index):
+        active = []
+        for first, last, reach, path in range_index[rerun_char]:
+            # Drop ranges that end before this one starts
+            active = [a for a in active if a[1] >= first]
+            for a_first, a_last, a_path in active:
+                shared = range(first, min(last, a_last) + 1)
+                overlaps.append((a_path, path,
+                                 [str(x) + rerun_char for x in shared]))
+            active.append((first, last, path))
+    return overlaps
+
+
+def aggregator(coc_list, coc_tuple, missing_coc_list, pdf_stack,
+               report_dict=None, coc_index=None, range_index=None):
+    """Function takes in a list of missing cocs, a list of good pdf
+    names, and dictionary for collecting reports. Returns two
     variables: (1) a list of pdfs for which chains could not be
-    found or 'None' in the case that all CoCs were found for PDFs, and
-    (2) a dictionary consisting of dictionaries whose keys are the report
-    names and values are CoC location, the associated pdfs and missing pdfs
-    after being back-checked from the coc range.
+    found, and (2) a dictionary consisting of dictionaries whose keys
+    are the report names and values are CoC location, the associated
+    pdfs and missing pdfs after being back-checked from the coc range.
 
     Takes as input
         'missing_coc_list' - an initially empty list of missing chain of
                              custodies;
         'pdf_stack' - a list of good single-page pdf names (already
-                      sanitized), which is used as a stack; and
-        'report_dict' - a dictionary consisting of report names, followed
-                        by a nested dict of info relating to that report.
+                      sanitized). It is not modified;
+        'report_dict' - an optional dictionary consisting of report
+                        names, followed by a nested dict of info relating
+                        to that report. A new one is made if not given.
+        'coc_index' - optional CoC index from `index_cocs`; built from
+                      'coc_list' and 'coc_tuple' if not given.
+        'range_index' - optional range index from `index_ranges`, used
+                        to find the CoC for PDFs in the middle of a
+                        range whose first PDF is missing.
 
     Example return report dictionary:
 
@@ -419,137 +1377,1802 @@ def aggregator(coc_list, coc_tuple, missing_coc_list, pdf_stack, report_dict={})
                         'missing_pdfs' = ['123458']}
     }
 
-    The list of missing cocs is added to whenever a coc cannot be found for
-    a given PDF, and the pdf stack is reduced for two reasons:
-        - when a pdf cannot be matched to a CoC, and
-        - when a series of pdfs match to a given coc range (back-checking)
+    PDFs are visited in sorted order, so the search starts from the first
+    PDF in each CoC range. Each PDF is claimed at most once:
+        - when a CoC cannot be found for it, it is added to the list of
+          missing cocs, and
+        - when a CoC is found, every PDF in the CoC's range is claimed
+          for that report (back-checking).
+    A PDF whose CoC does not list it in its range (e.g. '123456pg1.pdf'
+    against '123456acoc.pdf') is also added to the list of missing cocs,
+    and the CoC's report is neither created nor changed for it.
     """
-    while pdf_stack != []:
+    if report_dict is None:
+        report_dict = {}
+    if coc_index is None:
+        coc_index = index_cocs(coc_list, coc_tuple)
+    if range_index is None:
+        range_index = index_ranges(coc_list, coc_tuple)
+
+    pdf_stack = sorted(pdf_stack)
 
-        coc = find_coc(coc_list, coc_tuple, pdf_stack[0])
+    # Group PDF names by sample key ('123456', '123456a') once.
+    groups = index_pages(pdf_stack)
+    # Numbers from a CoC range claim PDFs by prefix, so '123456' also
+    # claims the rerun '123456apg1.pdf'. Map each number to the sample
+    # keys it claims.
+    claims = {}
+    for key, names in groups.items():
+        claims.setdefault(key, []).append(key)
+        record = parse_name(names[0])
+        if record is not None and record.rerun:
+            claims.setdefault(record.sample, []).append(key)
+    # Number of unclaimed PDFs left for each sample key
+    remaining = {key: len(names) for key, names in groups.items()}
+    claimed = set()
 
-        # CoC not found?
+    for pdf in pdf_stack:
+        if pdf in claimed:
+            continue
+
+        key = sample_key(pdf)
+        coc = coc_index.get(key)
         if coc is None:
-            # Remove PDF from stack and add to list of PDFs whose CoCs
-            # could not be found. Effectively ignores these PDFs.
-            missing_coc_list.append(pdf_stack.pop(0))
-            # Recursively call function on reduced pdf_stack.
-            aggregator(coc_list, coc_tuple, missing_coc_list,
-                       pdf_stack, report_dict)
-        else:
-            coc_name = os.path.basename(coc)
-            report_name = coc_name.replace('coc', '')
-            required_pdfs, missing_pdfs = backcheck(coc_name, pdf_stack)
-
-            # Create list of file names (not just nums) for PDFs that match to CoCs
-            # and remove from pdf_stack.
-            # May be room for efficiency gains here
-            matched_pdfs = []
-            for j in required_pdfs:
-                for k in pdf_stack:
-                    if k.startswith(j):
-                        matched_pdfs.append(k)
-            # Remove pdfs from pdf stack that back-matched
-            # Consider using sets and recreating the pdf_stack...
-            for f in matched_pdfs:
-                pdf_stack.remove(f)
-
-            # matched_pdfs are in the wrong order
-            matched_pdfs.sort()
-
-            report_dict[report_name] = {'coc': coc,
-                                        'pdfs': matched_pdfs,
-                                        'missing_pdfs': missing_pdfs}
-            # Recursively call function with updated variables
-            aggregator(coc_list, coc_tuple, missing_coc_list,
-                       pdf_stack, report_dict)
+            # PDF may sit inside a range whose first PDF is missing
+            coc = find_range_coc(range_index, key)
 
-    return missing_coc_list, report_dict
+        # CoC not found? Effectively ignores this PDF.
+        if coc is None:
+            missing_coc_list.append(pdf)
+            claimed.add(pdf)
+            continue
 
+        coc_name = os.path.basename(coc)
+        report_name = coc_name.replace('coc', '')
+        required_pdfs = get_ranges(coc_name)
 
-def collate(report_name, dictionary):
-    """Function takes in a report name and a dictionary describing the
-    report's contents. Reports are collated by using ghostscript, which
-    is invoked through a subprocess.
+        # The CoC found may not list this PDF, e.g. '123456pg1.pdf'
+        # against '123456acoc.pdf'. Leave the CoC's report alone.
+        record = parse_name(pdf)
+        if key not in required_pdfs and not (
+                record is not None and record.rerun and
+                record.sample in required_pdfs):
+            missing_coc_list.append(pdf)
+            claimed.add(pdf)
+            remaining[key] -= 1
+            continue
 
-    The dictionary contains the following keys:
-        'coc' - A full path to the COC used. Needs to be last in the order
-        'pdfs' - A list of PDFs to be used from REVD_REPORTS directory.
-        'missing_pdfs' - either `None` or a list of missing PDFs that were
-        not found during the back-check.
+        # Back-check against PDFs not yet claimed by another report
+        missing_pdfs = sorted(j for j in required_pdfs if not remaining.get(j))
 
-    Returns variable `start_size`, which is an integer representing the
-    number of bytes all input files contain for later comparison to the
-    final report size.
-    """
-    # Generate full paths to reviewed and stripped reports
-    gs_list = [os.path.join(REVD_REPORTS, x) for x in dictionary['pdfs']]
-    # Less efficient to add the COC here, rather than in the command arguments,
-    # but we need a data structure with all PDFs to test file size
-    gs_list.append(dictionary['coc'])  # COC goes last in the report
+        matched_pdfs = []
+        for j in required_pdfs:
+            for claim in claims.get(j, []):
+                if remaining[claim]:
+                    matched_pdfs.extend(k for k in groups[claim]
+                                        if k not in claimed)
+                    remaining[claim] = 0
+        claimed.update(matched_pdfs)
+        matched_pdfs.sort()
 
-    final_report = os.path.join(FIN_REPORTS, report_name)
+        report_dict[report_name] = {'coc': coc,
+                                    'pdfs': matched_pdfs,
+                                    'missing_pdfs': missing_pdfs or None}
 
-    # Get starting file stats
-    start_size = total_file_size(gs_list)
-    
-    command = ["gs",
-               "-q", # Quiet mode
-               "-dBATCH",
-               "-dNOPAUSE",
-               "-sDEVICE=pdfwrite",
-               "-dAutoRotatePages=/PageByPage",
-               "-sOutputFile=%s" % final_report] # Also works with -o flag
+    return missing_coc_list, report_dict
+
+
+def ghostscript_backend(input_files, output_file, options=None):
+    """Collation backend that re-renders and compresses every page
+    through ghostscript's pdfwrite device. This is the default.
+
+    'input_files' - a list of full paths to PDFs, in report order.
+    'output_file' - full path of the report to write.
+    'options' - ghostscript options, from `profile_options`; defaults
+                to GS_OPTIONS.
+
+    Raises `RuntimeError` if ghostscript exits with an error.
+    """
+    if options is None:
+        options = GS_OPTIONS
+    command = [GS_EXECUTABLE, "-dBATCH"] + list(options)
+    command.append("-sOutputFile=%s" % output_file) # Also works with -o flag
 
     # Append each input file -- REQUIRED. Cannot use " ".join(gs_list).
-    for i in gs_list:
+    for i in input_files:
         command.append(i)
 
     # Without .wait(), cleanup operations move the files before
     # gs has the chance to operate on the files.
-    subprocess.Popen(command, stderr=subprocess.DEVNULL).wait()
-
-    return start_size
+    returncode = subprocess.Popen(command, stderr=subprocess.DEVNULL).wait()
+    if returncode != 0:
+        raise RuntimeError("ghostscript could not collate {0} (exit status "
+                           "{1})".format(os.path.basename(output_file),
+                                         returncode))
 
 
-def total_file_size(file_list):
-    """Return the size of a single file or the size of files present in
-    a given list of absolute paths to files.
+def ps_string(text):
+    """Return 'text' (e.g. a file path) as a PostScript string literal.
 
-    Return value is either the size of the file, or files, in bytes, or
-    `False` in the case that the function was passed the wrong file
-    type.
+    Backslashes and parentheses are escaped, and anything that is not
+    printable ASCII is written as octal escapes of its bytes.
     """
+    chars = []
+    for byte in os.fsencode(text):
+        char = chr(byte)
+        if char in '\\()':
+            chars.append('\\' + char)
+        elif 32 <= byte < 127:
+            chars.append(char)
+        else:
+            chars.append('\\%03o' % byte)
+    return '(' + ''.join(chars) + ')'
 
-    total_size = 0
-    # Note that os.path.getsize() is equivalent to instantiating an os.stat
-    # object and calling st_size. Just looks cleaner this way.
-    
-    # Check for type -- str (single file) or list (list of files)
-    if isinstance(file_list, str):
-        try:
-            if os.path.exists(file_list):
-                total_size = os.path.getsize(file_list)
-            else:
-                return False
-        except OSError:
-            print("File {0} could not be found. Maybe it's not a full path?"
-                  .format(file_list))
-            return False
 
-    elif isinstance(file_list, list):
-        try:
-            for f in file_list:
-                if os.path.exists(f):
-                    total_size += os.path.getsize(f)
-                else:
-                    return False
+class GhostscriptSession:
+    """A long-lived ghostscript interpreter that collates one report
+    per job.
+
+    Starting `gs` loads the binary, fonts and resources and sets up the
+    pdfwrite device every time. A session pays that cost once: the
+    interpreter reads PostScript from its stdin, and each job points the
+    device at a new output file, runs the input PDFs, then closes the
+    output again. The device options are the same as for
+    `ghostscript_backend`, so each report comes out the same.
+
+    'options' - ghostscript options for the session; defaults to
+                GS_OPTIONS.
+
+    Sessions keep ghostscript's -dSAFER file sandbox, so a scanned PDF
+    can't reach files outside the collator's folders; see
+    `session_permissions`. This needs ghostscript 9.50 or later.
+    """
+
+    # Printed by the interpreter after each job
+    DONE = '%%[collator: done]%%'
+    FAILED = '%%[collator: failed]%%'
+
+    def __init__(self, options=None):
+        if options is None:
+            options = GS_OPTIONS
+        # Jobs 'run' input files and change OutputFile, which SAFER
+        # only allows for the paths permitted here
+        command = ([GS_EXECUTABLE] + list(options) + ["-dSAFER"] +
+                   session_permissions() +
+                   ["-sOutputFile=%s" % os.devnull, "-"])
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+
+    def alive(self):
+        """Return `True` if the interpreter is still running."""
+        return self.process.poll() is None
+
+    def job(self, input_files, output_file):
+        """Return the PostScript for one collation job."""
+        lines = ['{',
+                 '<< /OutputFile %s >> setpagedevice' % ps_string(output_file)]
+        for i in input_files:
+            lines.append('%s run' % ps_string(i))
+        lines.extend([
+            '} stopped /collator_failed exch def clear',
+            # Switching output away closes and finishes the report
+            '<< /OutputFile %s >> setpagedevice' % ps_string(os.devnull),
+            'collator_failed { %s } { %s } ifelse print flush' %
+            (ps_string(self.FAILED + '\n'), ps_string(self.DONE + '\n'))])
+        return '\n'.join(lines) + '\n'
+
+    def collate(self, input_files, output_file):
+        """Collate 'input_files' into 'output_file' and wait for it.
+
+        Returns `True` if ghostscript finished the job, or `False` if it
+        reported an error or the interpreter died.
+        """
+        try:
+            self.process.stdin.write(self.job(input_files,
+                                              output_file).encode('ascii'))
+            self.process.stdin.flush()
+            # Skip any other output until the job's own status line
+            for line in self.process.stdout:
+                line = line.decode('latin-1').strip()
+                if line == self.DONE:
+                    return True
+                elif line == self.FAILED:
+                    return False
+        # Interpreter died, or the session was closed
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def close(self):
+        """Stop the interpreter."""
+        try:
+            self.process.stdin.close()
         except OSError:
-            print("File {0} could not be found. Maybe it's not a full path?"
-                  .format(f))
+            pass
+        self.process.wait()
+
+
+def session_permissions():
+    """Return the ghostscript options that let a -dSAFER session read and
+    write the files its jobs need, and nothing else.
+
+    Inputs are read from REVD_REPORTS and the CoC folders, and reports
+    written to FIN_REPORTS (including `deflate`'s temporary files beside
+    them). STAGE_DIR, when set, is both read and written.
+    """
+    read = [REVD_REPORTS] + coc_directories()
+    write = [FIN_REPORTS]
+    if STAGE_DIR:
+        read.append(STAGE_DIR)
+        write.append(STAGE_DIR)
+    options = []
+    for flag, directories in (('read', read), ('write', write)):
+        for d in directories:
+            if d:
+                options.append('--permit-file-%s=%s' % (
+                    flag, os.path.join(os.path.abspath(d), '*')))
+    # Where the output goes between jobs
+    options.append('--permit-file-write=%s' % os.devnull)
+    return options
+
+
+# Open sessions for each worker thread, by options
+_gs_local = threading.local()
+_gs_sessions = []
+_gs_sessions_lock = threading.Lock()
+
+
+def ghostscript_session(options=None):
+    """Return this thread's ghostscript session for 'options', starting
+    a new one if there is none or the old one has died."""
+    options = tuple(GS_OPTIONS if options is None else options)
+    sessions = getattr(_gs_local, 'sessions', None)
+    if sessions is None:
+        sessions = _gs_local.sessions = {}
+
+    session = sessions.get(options)
+    if session is None or not session.alive():
+        session = sessions[options] = GhostscriptSession(options)
+        with _gs_sessions_lock:
+            _gs_sessions.append(session)
+    return session
+
+
+def close_ghostscript_sessions():
+    """Stop every ghostscript session started by this process."""
+    with _gs_sessions_lock:
+        while _gs_sessions:
+            _gs_sessions.pop().close()
+
+
+def ghostscript_session_backend(input_files, output_file, options=None):
+    """Collation backend that sends each report to a persistent
+    ghostscript interpreter (one per worker thread and profile) instead
+    of starting a new `gs` process. Output is the same as
+    `ghostscript_backend`.
+
+    Arguments are the same as for `ghostscript_backend`.
+
+    If the session fails the report (ghostscript reported an error, or
+    the interpreter died), the session is stopped and the report tried
+    once more in a fresh one. Raises `RuntimeError` if that fails too,
+    so the report is neither cached nor counted as collated.
+    """
+    for attempt in range(2):
+        session = ghostscript_session(options)
+        if session.collate(input_files, output_file):
+            return
+        # Later jobs on this thread start a new interpreter
+        session.close()
+        with _gs_sessions_lock:
+            if session in _gs_sessions:
+                _gs_sessions.remove(session)
+    raise RuntimeError("ghostscript could not collate {0}".format(
+        os.path.basename(output_file)))
+
+
+def merge_backend(input_files, output_file, options=None):
+    """Collation backend that concatenates the page objects of the
+    input PDFs without re-encoding them. Much faster than ghostscript
+    when the inputs are already optimized, but nothing is compressed or
+    rotated. Requires the `pypdf` package.
+
+    Arguments are the same as for `ghostscript_backend`; 'options' is
+    ignored.
+    """
+    if pypdf is None:
+        raise RuntimeError("The 'merge' backend needs the pypdf package. "
+                           "Install it with 'pip install pypdf'.")
+    writer = pypdf.PdfWriter()
+    for i in input_files:
+        writer.append(i)
+    with open(output_file, 'wb') as f:
+        writer.write(f)
+
+
+# Collation backends by name. Each takes a list of input paths, an
+# output path and the ghostscript options, and writes the collated report.
+COLLATION_BACKENDS = {'gs': ghostscript_backend,
+                      'gs-session': ghostscript_session_backend,
+                      'merge': merge_backend}
+
+
+def choose_profile(bytes_in, pages):
+    """Pick a compression profile for a report from its total input
+    size and number of pages.
+
+    Large scans (over ADAPTIVE_LARGE_PAGE bytes a page on average) are
+    downsampled with 'balanced'. Small reports (under
+    ADAPTIVE_SMALL_REPORT bytes) and long reports of ordinary pages use
+    'fast', since compressing them gains little for the time it takes.
+    Everything else is kept at 'archival' quality.
+    """
+    if bytes_in / max(pages, 1) > ADAPTIVE_LARGE_PAGE:
+        return 'balanced'
+    elif bytes_in < ADAPTIVE_SMALL_REPORT or pages > 50:
+        return 'fast'
+    return 'archival'
+
+
+def profile_options(profile):
+    """Return the ghostscript options for a compression profile."""
+    return GS_OPTIONS + GS_PROFILES[profile]
+
+
+def report_inputs(dictionary):
+    """Return the full paths of a report's input files, in report order:
+    its reviewed PDFs from REVD_REPORTS, then its CoC.
+
+    PDFs are found under the names they are stored under: from the
+    dictionary's optional 'stored' key (logical name to stored name, as
+    sent with spool jobs), otherwise from `physical_path`.
+    """
+    stored = dictionary.get('stored', {})
+    # Generate full paths to reviewed and stripped reports
+    gs_list = [os.path.join(REVD_REPORTS, stored[x]) if x in stored
+               else physical_path(REVD_REPORTS, x)
+               for x in dictionary['pdfs']]
+    # Less efficient to add the COC here, rather than in the command arguments,
+    # but we need a data structure with all PDFs to test file size
+    gs_list.append(dictionary['coc'])  # COC goes last in the report
+    return gs_list
+
+
+def collate(report_name, dictionary, backend=None, snapshot=None,
+            profile=None):
+    """Function takes in a report name and a dictionary describing the
+    report's contents. Reports are collated by one of the
+    COLLATION_BACKENDS; by default ghostscript, which is invoked through
+    a subprocess.
+
+    The dictionary contains the following keys:
+        'coc' - A full path to the COC used. Needs to be last in the order
+        'pdfs' - A list of PDFs to be used from REVD_REPORTS directory.
+        'missing_pdfs' - either `None` or a list of missing PDFs that were
+        not found during the back-check.
+        'backend' - (optional) name of the backend to use for this report.
+        'profile' - (optional) compression profile for this report.
+
+    'backend' chooses the backend for this call, overriding the
+    dictionary. If neither gives one, 'gs' is used. 'snapshot' is an
+    optional snapshot from `snapshot_directories` to read input sizes
+    from.
+
+    'profile' chooses the compression profile (see GS_PROFILES) in the
+    same way, defaulting to 'default'. 'adaptive' picks one from the
+    report's size and page count with `choose_profile`; each reviewed
+    PDF and the CoC count as a page.
+
+    Returns a dictionary of statistics for later comparison:
+        {'backend': 'gs',
+         'profile': 'default',   # Compression profile used
+         'bytes_in': 1238760,    # Size of all input files
+         'bytes_out': 347071,    # Size of the final report
+         'seconds': 1.52,        # Wall time taken by the backend
+         'cached': False,        # Whether the report came from the cache
+         'attempts': 1}          # Times the report was collated
+
+    If CACHE_DIR is set, a report whose inputs and settings match an
+    earlier collation is copied from the cache instead (see
+    `cache_key`).
+
+    A report that comes out more than BALLOON_RATIO times the size of
+    its inputs is collated again by `deflate`, and the stats give the
+    backend and profile of the smallest output.
+
+    If STAGE_DIR is set, the report is collated from local copies of its
+    inputs and moved into FIN_REPORTS when done (see `staged`).
+
+    Raises `FileNotFoundError` if any of the report's input files is
+    missing, before anything is written.
+    """
+    if backend is None:
+        backend = dictionary.get('backend', 'gs')
+
+    gs_list = report_inputs(dictionary)
+
+    final_report = os.path.join(FIN_REPORTS, report_name)
+
+    # Get starting file stats
+    start_size = total_file_size(gs_list, snapshot)
+    if start_size is False:
+        # Moved or removed since the report was planned
+        raise FileNotFoundError("An input of {0} is missing".format(
+            report_name))
+
+    if profile is None:
+        profile = dictionary.get('profile', 'default')
+    if profile == 'adaptive':
+        profile = choose_profile(start_size or 0, len(gs_list))
+    options = profile_options(profile)
+
+    key = None
+    if CACHE_DIR:
+        # Keyed on the stripped names, so the key doesn't change when a
+        # deferred rename is applied or a copy is scanned in again
+        names = [os.path.join(REVD_REPORTS, x) for x in dictionary['pdfs']]
+        names.append(dictionary['coc'])
+        key = cache_key(gs_list, {'backend': backend,
+                                  'executable': GS_EXECUTABLE,
+                                  'options': options},
+                        CACHE_HASH, snapshot, names)
+
+    journal('collate', status='start', report=report_name,
+            output=final_report)
+    with span('collate', report=report_name, backend=backend,
+              profile=profile, files=len(gs_list),
+              bytes_in=start_size) as record:
+        record['cached'] = key is not None and cache_fetch(key, final_report)
+        record['attempts'] = 0
+        if record['cached']:
+            record['bytes_out'] = total_file_size(final_report) or 0
+        else:
+            with staged(report_name, gs_list, final_report) as (inputs, output):
+                try:
+                    COLLATION_BACKENDS[backend](inputs, output, options)
+                except BaseException:
+                    # Don't leave half a report to be billed
+                    if os.path.exists(output):
+                        os.remove(output)
+                    raise
+                record['attempts'] = 1
+                record['bytes_out'] = total_file_size(output) or 0
+
+                if (BALLOON_RATIO and start_size and
+                        record['bytes_out'] > BALLOON_RATIO * start_size):
+                    backend, profile = deflate(inputs, output, start_size,
+                                               backend, profile, record)
+                if key is not None:
+                    cache_store(key, output)
+
+    stats = {'backend': backend,
+             'profile': profile,
+             'bytes_in': start_size,
+             'bytes_out': record['bytes_out'],
+             'seconds': record['seconds'],
+             'cached': record['cached'],
+             'attempts': record['attempts']}
+    journal('collate', status='done', report=report_name, stats=stats)
+    return stats
+
+
+def deflate(input_files, output_file, bytes_in, backend, profile, record):
+    """Collate a report that came out larger than its inputs again with
+    each of the BALLOON_FALLBACKS, keeping whichever output is smallest.
+
+    'input_files', 'output_file' - as given to the collation backend.
+    'bytes_in' - total size of the input files.
+    'backend', 'profile' - the backend and profile already tried.
+    'record' - the collation's metrics record; 'bytes_out' and
+               'attempts' are updated.
+
+    Each retry is written to a temporary file beside 'output_file', and
+    only replaces it when smaller. Stops as soon as an output is within
+    BALLOON_RATIO of the inputs.
+
+    Returns the (backend, profile) of the output kept.
+    """
+    logger.info("%s ballooned to %s from %s, retrying",
+                os.path.basename(output_file),
+                humanize_size(record['bytes_out']), humanize_size(bytes_in))
+    directory = os.path.dirname(output_file) or '.'
+    for retry_backend, retry_profile in BALLOON_FALLBACKS:
+        if record['bytes_out'] <= BALLOON_RATIO * bytes_in:
+            break
+        if ((retry_backend, retry_profile) == (backend, profile) or
+                retry_backend not in COLLATION_BACKENDS):
+            continue
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.',
+                                    suffix='.part')
+        os.close(fd)
+        try:
+            COLLATION_BACKENDS[retry_backend](input_files, temp,
+                                              profile_options(retry_profile))
+            size = total_file_size(temp)
+            record['attempts'] += 1
+            if size and size < record['bytes_out']:
+                os.replace(temp, output_file)
+                record['bytes_out'] = size
+                backend, profile = retry_backend, retry_profile
+        # A fallback that can't run here (e.g. 'merge' without pypdf, or
+        # on a PDF pypdf can't read) is skipped; the first output stands
+        except Exception:
+            logger.debug("%s fallback failed", retry_backend, exc_info=True)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+    return backend, profile
+
+
+# Output cache counters for this run
+CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+_cache_lock = threading.Lock()
+
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of the contents of 'path'."""
+    content = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            content.update(block)
+    return content.hexdigest()
+
+
+def cache_key(input_files, settings, content_hash=False, snapshot=None,
+              names=None):
+    """Return the output cache key for collating 'input_files' with
+    'settings', or `None` if an input file is missing.
+
+    'input_files' - the ordered list of full input paths.
+    'settings' - a JSON-serializable description of how the report is
+                 made (backend, ghostscript executable and options).
+    'content_hash' - if `True`, key on each file's contents instead of
+                     its modification time, so resubmitted copies of the
+                     same files also hit the cache.
+    'snapshot' - optional snapshot from `snapshot_directories`.
+    'names' - optional paths to key each file under instead of its path
+              in 'input_files', e.g. the stripped name of a PDF still
+              stored with its scanner prefix. Files are still read from
+              'input_files'.
+
+    The key covers the order, path and size of each file, plus its
+    modification time or content hash.
+    """
+    if names is None:
+        names = input_files
+    key = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    for path, name in zip(input_files, names):
+        stat = file_stat(path, snapshot)
+        if stat is None:
+            return None
+        if content_hash:
+            part = [name, stat.st_size, file_digest(path)]
+        else:
+            part = [name, stat.st_size, stat.st_mtime_ns]
+        key.update(json.dumps(part).encode())
+    return key.hexdigest()
+
+
+def cache_path(key):
+    """Return the path of the cached report for 'key'."""
+    return os.path.join(CACHE_DIR, key + '.pdf')
+
+
+def cache_fetch(key, output_file):
+    """Copy the cached report for 'key' to 'output_file'.
+
+    Returns `True` on a cache hit, or `False` on a miss.
+    """
+    try:
+        write_atomically(cache_path(key), output_file)
+        # Mark as recently used for eviction
+        os.utime(cache_path(key))
+    except OSError:
+        with _cache_lock:
+            CACHE_STATS['misses'] += 1
+        return False
+    with _cache_lock:
+        CACHE_STATS['hits'] += 1
+    return True
+
+
+def cache_store(key, report_file):
+    """Add 'report_file' to the cache under 'key', then evict the least
+    recently used reports if the cache is over CACHE_MAX_BYTES."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        write_atomically(report_file, cache_path(key))
+    except OSError:
+        return
+    cache_evict(CACHE_MAX_BYTES)
+
+
+def cache_evict(max_bytes):
+    """Remove least recently used reports until the cache holds at most
+    'max_bytes'. Returns the number of reports removed."""
+    with _cache_lock:
+        entries = []
+        with os.scandir(CACHE_DIR) as listing:
+            for entry in listing:
+                if entry.name.endswith('.pdf'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for mtime, size, path in entries)
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        CACHE_STATS['evictions'] += removed
+    return removed
+
+
+def write_atomically(source, destination):
+    """Copy 'source' to 'destination' through a temporary file in the
+    destination's directory, so nothing ever sees a partial file."""
+    directory = os.path.dirname(destination) or '.'
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.',
+                                suffix='.part')
+    os.close(fd)
+    try:
+        shutil.copyfile(source, temp)
+        os.replace(temp, destination)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+
+def local_scratch():
+    """Return a local directory to stage reports in: /dev/shm when it is
+    a writable tmpfs, otherwise the system temporary directory."""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def stage_files(report_name, input_files, root):
+    """Copy 'input_files' into a new directory under 'root', one file
+    after another.
+
+    Copies are numbered ('000-123456pg1.pdf', ...) so they keep the
+    report order and never clash.
+
+    Returns the new directory and the list of copies, in order.
+    """
+    directory = tempfile.mkdtemp(dir=root, prefix=report_name + '.')
+    local_files = []
+    try:
+        with span('stage', report=report_name, files=len(input_files)):
+            for i, path in enumerate(input_files):
+                local = os.path.join(directory, '{0:03d}-{1}'.format(
+                    i, os.path.basename(path)))
+                shutil.copyfile(path, local)
+                local_files.append(local)
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    return directory, local_files
+
+
+class Stager:
+    """Copies the inputs of reports into a local scratch directory, so
+    collation never reads from or writes to network mounts.
+
+    A single copier thread stages reports in the order they are
+    prefetched, keeping at most 'limit' reports staged at once. A report
+    that wasn't prefetched is staged when it is fetched.
+    """
+
+    def __init__(self, root):
+        self.root = tempfile.mkdtemp(dir=root, prefix='PDF_collator-')
+        self.copier = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Report name -> future of (directory, local files)
+        self.staged = {}
+        self.held = 0
+        self.limit = None
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def _stage(self, report_name, input_files, wait=True):
+        with self.condition:
+            while (wait and self.limit is not None and
+                   self.held >= self.limit and not self.closed):
+                self.condition.wait()
+            if self.closed:
+                raise concurrent.futures.CancelledError()
+            self.held += 1
+        try:
+            return stage_files(report_name, input_files, self.root)
+        except BaseException:
+            self._drop()
+            raise
+
+    def _drop(self):
+        with self.condition:
+            self.held -= 1
+            self.condition.notify_all()
+
+    def prefetch(self, reports, limit):
+        """Queue (report name, input files) tuples to be staged in order,
+        with at most 'limit' staged at once."""
+        with self.condition:
+            self.limit = limit
+            for report_name, input_files in reports:
+                if report_name not in self.staged:
+                    self.staged[report_name] = self.copier.submit(
+                        self._stage, report_name, input_files)
+
+    def fetch(self, report_name, input_files):
+        """Return the staged (directory, local files) of a report, waiting
+        for its copy to finish or staging it now."""
+        with self.condition:
+            future = self.staged.get(report_name)
+        if future is None:
+            # Not prefetched: copy in this thread instead
+            future = concurrent.futures.Future()
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(self._stage(report_name, input_files,
+                                              wait=False))
+            except BaseException as e:
+                future.set_exception(e)
+            with self.condition:
+                self.staged[report_name] = future
+        return future.result()
+
+    def release(self, report_name):
+        """Remove a report's staged copies."""
+        with self.condition:
+            future = self.staged.pop(report_name, None)
+        if future is None or future.cancel():
+            return
+        try:
+            directory, local_files = future.result()
+        except BaseException:
+            return    # Never staged; nothing held
+        shutil.rmtree(directory, ignore_errors=True)
+        self._drop()
+
+    def close(self):
+        """Stop copying and remove everything staged."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.copier.shutdown(cancel_futures=True)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+_stager = None
+_stager_lock = threading.Lock()
+
+
+def stager():
+    """Return this run's `Stager` for STAGE_DIR, starting one if needed."""
+    global _stager
+    with _stager_lock:
+        if _stager is None:
+            _stager = Stager(STAGE_DIR)
+        return _stager
+
+
+def close_stager():
+    """Stop this run's `Stager` and remove its scratch directory."""
+    global _stager
+    with _stager_lock:
+        if _stager is not None:
+            _stager.close()
+            _stager = None
+
+
+@contextlib.contextmanager
+def staged(report_name, input_files, output_file):
+    """Collate a report in local scratch space when STAGE_DIR is set.
+
+    Yields the (input files, output file) to give the collation backend:
+    local copies of 'input_files' and a local output file, or the
+    originals when staging is off or the copy failed. Once the block
+    finishes, the local output (if the backend wrote one) is written to
+    'output_file' in one sequential copy and renamed into place, and the
+    copies are removed.
+    """
+    if not STAGE_DIR:
+        yield input_files, output_file
+        return
+
+    stage = stager()
+    try:
+        directory, local_files = stage.fetch(report_name, input_files)
+    except OSError as e:
+        logger.warning("Could not stage %s, collating in place: %s",
+                       report_name, e)
+        stage.release(report_name)
+        yield input_files, output_file
+        return
+
+    local_output = os.path.join(directory, report_name)
+    try:
+        yield local_files, local_output
+        # A backend that wrote nothing fails this report alone, as it
+        # would unstaged
+        if os.path.exists(local_output):
+            write_atomically(local_output, output_file)
+    finally:
+        stage.release(report_name)
+
+
+def collate_reports(reports, jobs=1, backend=None, snapshot=None,
+                    profile=None):
+    """Collate several reports at once on a pool of worker threads.
+
+    'reports' - a list of (report name, report dictionary) tuples, as
+                taken from the `aggregator` report dictionary.
+    'jobs' - the number of reports to collate at the same time.
+    'backend' - the collation backend to use for every report (see
+                `collate`).
+    'snapshot' - optional snapshot from `snapshot_directories`.
+    'profile' - the compression profile, or 'adaptive' (see `collate`).
+
+    Each worker only waits on its own ghostscript process, so threads
+    are enough to keep 'jobs' cores busy. If STAGE_DIR is set, the
+    inputs of the next STAGE_AHEAD reports are copied locally while
+    these render.
+
+    Yields a (report name, dictionary, stats) tuple as soon as each
+    report finishes, in the order they finish. 'stats' is the return
+    value of `collate`. A report whose backend fails is reported and
+    left out.
+    """
+    if STAGE_DIR:
+        stager().prefetch([(name, report_inputs(dictionary))
+                           for name, dictionary in reports],
+                          jobs + STAGE_AHEAD)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(collate, name, dictionary, backend, snapshot,
+                               profile):
+                   (name, dictionary) for name, dictionary in reports}
+        for future in concurrent.futures.as_completed(futures):
+            name, dictionary = futures[future]
+            if STAGE_DIR:
+                # Cached or failed reports never used their copies
+                stager().release(name)
+            try:
+                stats = future.result()
+            except Exception as e:
+                print("Could not collate {0}: {1}".format(name, e))
+                continue
+            yield name, dictionary, stats
+
+
+# Spool directory layout: jobs waiting to be claimed, jobs claimed by a
+# worker (as '<worker>@<job>'), and finished jobs
+SPOOL_JOBS, SPOOL_LEASES, SPOOL_RESULTS = 'jobs', 'leases', 'results'
+
+
+def spool_setup(spool):
+    """Create the spool directory layout under 'spool' if needed."""
+    for sub in (SPOOL_JOBS, SPOOL_LEASES, SPOOL_RESULTS):
+        os.makedirs(os.path.join(spool, sub), exist_ok=True)
+
+
+def write_json_atomically(path, data):
+    """Write 'data' as JSON to 'path' through a temporary file in the same
+    directory, so readers never see a partial file."""
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def submit_jobs(spool, reports, backend=None, profile=None):
+    """Turn reports into job files in the spool for workers to collate.
+
+    'reports' - a list of (report name, report dictionary) tuples.
+    'backend', 'profile' - passed on to `collate` by the worker.
+
+    Results left from an earlier submission of the same reports are
+    removed first.
+    """
+    spool_setup(spool)
+    for name, dictionary in reports:
+        job = name + '.json'
+        try:
+            os.remove(os.path.join(spool, SPOOL_RESULTS, job))
+        except FileNotFoundError:
+            pass
+        # Workers can't see this run's deferred renames, so each job
+        # carries the names its PDFs are still stored under
+        stored = {}
+        for pdf in dictionary['pdfs']:
+            path = os.path.basename(physical_path(REVD_REPORTS, pdf))
+            if path != pdf:
+                stored[pdf] = path
+        write_json_atomically(os.path.join(spool, SPOOL_JOBS, job),
+                              {'report': name,
+                               'dictionary': dict(dictionary, stored=stored),
+                               'backend': backend, 'profile': profile})
+
+
+def claim_job(spool, worker):
+    """Claim the first waiting job in the spool for 'worker'.
+
+    A job is claimed by renaming it into the leases directory, which
+    only one worker can do. The lease's modification time is its
+    heartbeat.
+
+    Returns the path of the lease, or `None` if no job is waiting.
+    """
+    jobs = os.path.join(spool, SPOOL_JOBS)
+    for job in sorted(os.listdir(jobs)):
+        if job.startswith('.'):
+            continue
+        lease = os.path.join(spool, SPOOL_LEASES, worker + '@' + job)
+        try:
+            os.rename(os.path.join(jobs, job), lease)
+        except FileNotFoundError:
+            continue    # Another worker got there first
+        os.utime(lease)
+        return lease
+    return None
+
+
+def reclaim_leases(spool, lease_seconds=None):
+    """Put jobs whose leases have not had a heartbeat for 'lease_seconds'
+    (default LEASE_SECONDS) back in the queue, so jobs held by crashed
+    workers are collated by someone else.
+
+    Returns the list of jobs put back.
+    """
+    if lease_seconds is None:
+        lease_seconds = LEASE_SECONDS
+    leases = os.path.join(spool, SPOOL_LEASES)
+    reclaimed = []
+    now = time.time()
+    for entry in os.scandir(leases):
+        try:
+            if now - entry.stat().st_mtime < lease_seconds:
+                continue
+            job = entry.name.split('@', 1)[1]
+            os.rename(entry.path, os.path.join(spool, SPOOL_JOBS, job))
+        except (FileNotFoundError, IndexError):
+            continue
+        logger.info("Reclaimed %s from %s", job, entry.name.split('@')[0])
+        reclaimed.append(job)
+    return reclaimed
+
+
+def heartbeat(lease, stop, interval):
+    """Touch 'lease' every 'interval' seconds until 'stop' is set."""
+    while not stop.wait(interval):
+        try:
+            os.utime(lease)
+        except FileNotFoundError:
+            return    # Reclaimed from us
+
+
+def run_worker(spool, once=False, worker=None):
+    """Collate jobs from the spool until interrupted.
+
+    'once' - stop when no jobs are waiting instead of polling for more.
+    'worker' - this worker's name (default: '<host>-<pid>').
+
+    Each job's stats from `collate`, or the error it raised, is written
+    to the results directory, then the lease is removed.
+
+    Returns the number of jobs done.
+    """
+    if worker is None:
+        worker = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+    spool_setup(spool)
+    done = 0
+    while True:
+        reclaim_leases(spool)
+        lease = claim_job(spool, worker)
+        if lease is None:
+            if once:
+                return done
+            time.sleep(SPOOL_POLL)
+            continue
+
+        with open(lease) as f:
+            job = json.load(f)
+        result = {'report': job['report'], 'worker': worker}
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat,
+                                args=(lease, stop, LEASE_SECONDS / 4),
+                                daemon=True)
+        beat.start()
+        try:
+            result['stats'] = collate(job['report'], job['dictionary'],
+                                      job['backend'], None, job['profile'])
+        except Exception as e:
+            result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+        finally:
+            stop.set()
+            beat.join()
+        write_json_atomically(os.path.join(spool, SPOOL_RESULTS,
+                                           job['report'] + '.json'), result)
+        try:
+            os.remove(lease)
+        except FileNotFoundError:
+            pass
+        done += 1
+
+
+def spool_reports(spool, reports, backend=None, profile=None):
+    """Collate reports on spool workers instead of in this process.
+
+    Arguments are the same as for `submit_jobs`. Yields a (report name,
+    dictionary, stats) tuple as each worker's result arrives, like
+    `collate_reports`. Reports that failed on a worker are reported and
+    not yielded.
+
+    Workers keep no run journal, so each job is journaled here: 'start'
+    when it is submitted and 'done' when its result is read. `resume`
+    then skips reports already collated, and `clean` removes partial
+    outputs.
+
+    A warning is printed if no worker has claimed a job for
+    SPOOL_IDLE_WARN seconds. After SPOOL_TIMEOUT seconds without a job
+    being claimed or finished, unclaimed jobs are withdrawn and the
+    reports still waiting are not yielded.
+    """
+    submit_jobs(spool, reports, backend, profile)
+    for name, dictionary in reports:
+        journal('collate', status='start', report=name,
+                output=os.path.join(FIN_REPORTS, name))
+    waiting = dict(reports)
+    results = os.path.join(spool, SPOOL_RESULTS)
+    leases = os.path.join(spool, SPOOL_LEASES)
+    print("Waiting for workers to collate {0} reports from {1}...".format(
+        len(waiting), spool))
+    progress = time.monotonic()
+    warned = False
+    while waiting:
+        reclaim_leases(spool)
+        found = False
+        for name in list(waiting):
+            path = os.path.join(results, name + '.json')
+            try:
+                with open(path) as f:
+                    result = json.load(f)
+            except FileNotFoundError:
+                continue
+            os.remove(path)
+            found = True
+            dictionary = waiting.pop(name)
+            if 'error' in result:
+                print("Report {0} failed on worker {1}: {2}".format(
+                    name, result['worker'], result['error']))
+            else:
+                journal('collate', status='done', report=name,
+                        stats=result['stats'])
+                yield name, dictionary, result['stats']
+        if not waiting:
+            break
+
+        if found or os.listdir(leases):
+            progress = time.monotonic()
+            warned = False
+        idle = time.monotonic() - progress
+        if idle >= SPOOL_TIMEOUT:
+            print("No worker has collated anything for {0:.0f} seconds. "
+                  "Giving up on {1} reports.".format(idle, len(waiting)))
+            for name in waiting:
+                try:
+                    os.remove(os.path.join(spool, SPOOL_JOBS, name + '.json'))
+                except FileNotFoundError:
+                    pass
+            return
+        if idle >= SPOOL_IDLE_WARN and not warned:
+            print("Warning! No worker has claimed a job for {0:.0f} seconds. "
+                  "Start workers with --spool {1} --worker.".format(idle,
+                                                                   spool))
+            warned = True
+        if not found:
+            time.sleep(SPOOL_POLL)
+
+
+def archive_file(source, destination):
+    """Move 'source' to 'destination' with a single rename, copying then
+    deleting only when the two are on different filesystems."""
+    try:
+        os.replace(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(source, destination)
+        os.remove(source)
+
+
+def dispose(dictionary, report_name=None):
+    """Move a collated report's PDF then CoC files into today's folder of
+    the archive.
+
+    'dictionary' - the report dictionary from `aggregator`.
+    'report_name' - the report's name, for the run journal.
+
+    Files that are already gone (moved by an interrupted run) are
+    skipped. PDFs whose renames strip_chars deferred are archived under
+    their stripped names, so they are never renamed in place.
+    """
+    paths = [physical_path(REVD_REPORTS, f) for f in dictionary['pdfs']]
+    paths.append(dictionary['coc'])
+    names = dictionary['pdfs'] + [os.path.basename(dictionary['coc'])]
+    folder = os.path.join(ARCHIVE, time.strftime('%Y-%m-%d'))
+    os.makedirs(folder, exist_ok=True)
+    moves = [(p, os.path.join(folder, n)) for p, n in zip(paths, names)]
+
+    journal('dispose', status='start', report=report_name, moves=moves)
+    with span('dispose', files=len(paths),
+              bytes=total_file_size(paths) or 0):
+        for source, destination in moves:
+            try:
+                archive_file(source, destination)
+            except FileNotFoundError:
+                pass
+    forget_renames(REVD_REPORTS, dictionary['pdfs'])
+    journal('dispose', status='done', report=report_name)
+
+
+def compact_archive(before=None):
+    """Bundle each day's folder in the archive into a YYYY-MM-DD.tar file,
+    then remove the folder.
+
+    'before' - only folders for days before this 'YYYY-MM-DD' date are
+               bundled (default: today), so inputs still being archived
+               are left alone.
+
+    A bundle that already exists is added to. Bundles are written to a
+    temporary file first and then renamed into place.
+
+    Returns a list of the bundles written.
+    """
+    before = before or time.strftime('%Y-%m-%d')
+    bundles = []
+    try:
+        entries = sorted(os.scandir(ARCHIVE), key=lambda e: e.name)
+    except FileNotFoundError:
+        return bundles
+
+    for entry in entries:
+        if not (entry.is_dir() and archive_day_RE.fullmatch(entry.name)
+                and entry.name < before):
+            continue
+        bundle = os.path.join(ARCHIVE, entry.name + '.tar')
+        fd, temp = tempfile.mkstemp(dir=ARCHIVE, prefix='.', suffix='.part')
+        os.close(fd)
+        try:
+            mode = 'w'
+            if os.path.exists(bundle):
+                shutil.copyfile(bundle, temp)
+                mode = 'a'
+            with tarfile.open(temp, mode) as tar:
+                for name in sorted(os.listdir(entry.path)):
+                    tar.add(os.path.join(entry.path, name),
+                            arcname=os.path.join(entry.name, name))
+            os.replace(temp, bundle)
+        except BaseException:
+            os.remove(temp)
+            raise
+        shutil.rmtree(entry.path)
+        bundles.append(bundle)
+    return bundles
+
+
+_billing_lock = threading.Lock()
+
+
+def load_billing_manifest():
+    """Return the billing manifest: a dictionary of report names already
+    copied to BILLINGS, each mapped to the 'size', 'mtime' and 'sha256'
+    of the report when it was copied."""
+    try:
+        with open(BILLING_MANIFEST) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_billing_manifest(manifest):
+    """Write the billing manifest through a temporary file, so a crash
+    never leaves half a manifest behind."""
+    directory = os.path.dirname(BILLING_MANIFEST) or '.'
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            with _billing_lock:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(temp, BILLING_MANIFEST)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def needs_billing(report_name, manifest, billed_names):
+    """Return `True` if the report in FIN_REPORTS is not in BILLINGS yet,
+    or has changed since it was copied.
+
+    'manifest' - the billing manifest from `load_billing_manifest`.
+    'billed_names' - the set of file names currently in BILLINGS.
+
+    The report is only hashed when its size or modification time differ
+    from the manifest. A report that was touched but not changed has its
+    manifest entry brought up to date instead.
+    """
+    old = manifest.get(report_name)
+    if old is None or report_name not in billed_names:
+        return True
+    stat = os.stat(os.path.join(FIN_REPORTS, report_name))
+    if (stat.st_size, stat.st_mtime_ns) == (old['size'], old['mtime']):
+        return False
+    if file_digest(os.path.join(FIN_REPORTS, report_name)) != old['sha256']:
+        return True
+    with _billing_lock:
+        old.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+    return False
+
+
+def bill(report_name, manifest=None):
+    """Copy a finished report from FIN_REPORTS into BILLINGS.
+
+    The report is written to a temporary file in BILLINGS and renamed
+    into place, so the billing system never sees a partial PDF. The copy
+    is recorded in 'manifest', or in the billing manifest file if no
+    manifest is given.
+
+    Returns `True` if the copy succeeded, or `False` after warning the
+    user that it did not.
+    """
+    source = os.path.join(FIN_REPORTS, report_name)
+    with span('bill', report=report_name) as record:
+        try:
+            stat = os.stat(source)
+            write_atomically(source, os.path.join(BILLINGS, report_name))
+            record['bytes'] = stat.st_size
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                     'sha256': file_digest(source)}
+        # Report missing from FIN_REPORTS, or BILLINGS not writable
+        except OSError:
+            print("There was a problem moving the report from {0} "
+                  "to {1}! Please double check the files are in the"
+                  " correct locations.".format(FIN_REPORTS, BILLINGS))
+            record['failed'] = True
             return False
+    if manifest is None:
+        manifest = load_billing_manifest()
+        manifest[report_name] = entry
+        save_billing_manifest(manifest)
     else:
+        with _billing_lock:
+            manifest[report_name] = entry
+    journal('bill', report=report_name)
+    return True
+
+
+def sync_billings(manifest=None, jobs=None):
+    """Copy every report in FIN_REPORTS that is new or has changed since
+    it was last copied into BILLINGS.
+
+    'manifest' - the billing manifest, if already loaded. It is saved
+                 back to BILLING_MANIFEST afterwards.
+    'jobs' - the number of reports to copy at the same time (default
+             BILLING_JOBS).
+
+    Returns a tuple of the number of reports copied, already up to date,
+    and failed.
+    """
+    if manifest is None:
+        manifest = load_billing_manifest()
+    billed_names = set(os.listdir(BILLINGS))
+    with span('sync_billings') as record:
+        reports = [entry.name for entry in os.scandir(FIN_REPORTS)
+                   if entry.is_file() and not entry.name.startswith('.')]
+        to_copy = [name for name in reports
+                   if needs_billing(name, manifest, billed_names)]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs or BILLING_JOBS) as pool:
+            copied = sum(pool.map(lambda name: bill(name, manifest),
+                                  to_copy))
+        save_billing_manifest(manifest)
+        failed = len(to_copy) - copied
+        record.update(copied=copied, failed=failed)
+    return copied, len(reports) - len(to_copy), failed
+
+
+# File system types that don't report changes through inotify
+NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afpfs',
+                       'fuse.sshfs', 'davfs', 'webdav'}
+
+
+def is_network_mount(path):
+    """Return `True` if 'path' is on a network file system.
+
+    Mount types are read from /proc/mounts. Where that isn't available
+    (e.g. OS X), every path is treated as a network mount.
+    """
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return True
+
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    for mount_point, mount_type in mounts:
+        # Mount points with spaces are escaped in /proc/mounts
+        mount_point = mount_point.replace('\\040', ' ')
+        inside = (path == mount_point or
+                  path.startswith(mount_point.rstrip('/') + '/'))
+        if inside and len(mount_point) >= len(best):
+            best, fstype = mount_point, mount_type
+    return fstype in NETWORK_FILESYSTEMS
+
+
+class Watcher:
+    """Watch REVD_REPORTS and the CoC directories, and collate each
+    report as soon as it is complete.
+
+    The aggregator's inputs are kept in memory: the set of valid PDFs
+    waiting in 'revd_dir', and the CoC index and range index for the
+    CoC directories. Each scan only applies the files that appeared or
+    disappeared since the last one, and marks their sample keys as
+    changed. Reports are matched again only around the changed keys,
+    so a poll costs time in proportion to what changed, not to the
+    size of the backlog.
+
+    A report is collated when `aggregator` finds none of its PDFs
+    missing and none of its files (PDFs or CoC) have arrived for
+    'grace' seconds, which leaves time for reruns still being scanned.
+    Reports with missing PDFs wait until the PDFs turn up.
+
+    New PDFs are never renamed in place: like strip_chars(defer=True),
+    they are queued under their stripped names and archived under them
+    once collated.
+
+    Local directories are watched with inotify when the `inotify_simple`
+    package is installed. Network mounts don't report changes through
+    inotify, so they (and everything, without inotify) are listed again
+    every 'poll' seconds.
+    """
+
+    def __init__(self, coc_dirs=None, grace=60.0, poll=10.0, jobs=1,
+                 backend=None, profile=None):
+        self.revd_dir = REVD_REPORTS
+        if coc_dirs is None:
+            coc_dirs = coc_directories()
+        self.coc_dirs = list(coc_dirs)
+        self.grace = grace
+        self.poll = poll
+        self.jobs = jobs
+        self.backend = backend
+        self.profile = profile
+
+        # Last listing of each directory
+        self.listings = {d: set() for d in [self.revd_dir] + self.coc_dirs}
+        # Time each PDF or CoC name was first seen
+        self.arrived = {}
+        # Valid PDF names waiting for collation, without scanner prefixes,
+        # and the names they are stored under to those names
+        self.pdfs = set()
+        self.stored = {}
+        # Sample keys to the PDF names waiting for them
+        self.pages = {}
+        # Sample numbers to the rerun keys they claim, e.g.
+        # {'123456': {'123456a'}}
+        self.claims = {}
+        # CoC names to full paths, in the order they were seen
+        self.cocs = {}
+        self.coc_index = {}
+        self.range_index = {}
+        # CoC index keys to every CoC path stored under them, first seen
+        # first, and range CoCs by rerun character as (first, last, path)
+        self.coc_keys = {}
+        self.ranges = {}
+        # Matched reports, the sample keys each one covers, and the
+        # report covering each key
+        self.reports = {}
+        self.report_keys = {}
+        self.key_reports = {}
+        # Sample keys whose PDFs or CoCs changed since the last match
+        self.dirty = set()
+
+        # Inputs are archived on a background thread, off the collation
+        # path, and reports are copied to billings on a small pool of
+        # their own, as in `execute`. The archive is compacted on the
+        # disposal thread every COMPACT_INTERVAL seconds.
+        self.disposal = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.billing = concurrent.futures.ThreadPoolExecutor(
+            max_workers=BILLING_JOBS)
+        self.compaction = None
+        self.compacted = None
+
+        # Directories inotify can watch; the rest are polled
+        self.inotify = None
+        self.watches = {}
+        self.polled = list(self.listings)
+        if inotify_simple is not None:
+            self.inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            mask = (flags.CREATE | flags.DELETE | flags.MOVED_TO |
+                    flags.MOVED_FROM | flags.CLOSE_WRITE)
+            for d in list(self.polled):
+                if not is_network_mount(d):
+                    self.watches[self.inotify.add_watch(d, mask)] = d
+                    self.polled.remove(d)
+
+    def wait(self):
+        """Block until files may have changed, for at most 'poll'
+        seconds. Returns the directories that should be listed again.
+        """
+        if self.inotify is None:
+            time.sleep(self.poll)
+            return list(self.listings)
+        events = self.inotify.read(timeout=int(self.poll * 1000))
+        changed = {self.watches[e.wd] for e in events if e.wd in self.watches}
+        return list(changed) + self.polled
+
+    def scan(self, directories=None, now=None):
+        """List 'directories' (default: all of them) again and apply the
+        files that appeared or disappeared. 'now' is the arrival time
+        given to new files.
+        """
+        if directories is None:
+            directories = list(self.listings)
+        if now is None:
+            now = time.time()
+
+        snapshot = snapshot_directories(*directories)
+        for d in directories:
+            names = set(list_directory(d, snapshot))
+            added = names - self.listings[d]
+            removed = self.listings[d] - names
+            self.listings[d] = names
+
+            if d == self.revd_dir:
+                for name in removed:
+                    stripped = self.stored.pop(name, None)
+                    if stripped is not None:
+                        forget_renames(self.revd_dir, [stripped])
+                        self.drop_pdf(stripped)
+                for name in sorted(added):
+                    self.add_pdf(name, now)
+            else:
+                for name in removed:
+                    if self.cocs.get(name) == os.path.join(d, name):
+                        self.drop_coc(name)
+                for name in sorted(added):
+                    if name in self.cocs:
+                        continue
+                    if not coc_name_ok(name):
+                        print("Ignoring improperly named CoC {0}".format(name))
+                        continue
+                    self.add_coc(name, os.path.join(d, name), now)
+
+    def add_pdf(self, stored, now):
+        """Queue a new PDF under its name without the scanner prefix, if
+        that name is valid.
+
+        The file itself is not renamed. As with strip_chars(defer=True),
+        PENDING_RENAMES records the name it is stored under, and it is
+        archived under its stripped name once collated.
+        """
+        name = stored
+        if name.startswith('job'):
+            try:
+                name = re.split(prefix_RE, name)[1]
+            except IndexError:
+                print("Ignoring improperly named PDF {0}".format(stored))
+                return
+        if not pdf_name_ok(name):
+            print("Ignoring improperly named PDF {0}".format(stored))
+            return
+        if name in self.pdfs:
+            print("Ignoring {0}, {1} is already waiting".format(stored, name))
+            return
+        if name != stored:
+            with _renames_lock:
+                PENDING_RENAMES.setdefault(self.revd_dir, {})[name] = stored
+        self.stored[stored] = name
+        self.pdfs.add(name)
+        self.arrived.setdefault(name, now)
+        key = sample_key(name)
+        self.pages.setdefault(key, set()).add(name)
+        record = parse_name(name)
+        if record is not None and record.rerun:
+            self.claims.setdefault(record.sample, set()).add(key)
+        self.dirty.add(key)
+
+    def drop_pdf(self, name):
+        """Forget a PDF that was removed or collated."""
+        if name not in self.pdfs:
+            return
+        self.pdfs.discard(name)
+        self.arrived.pop(name, None)
+        key = sample_key(name)
+        names = self.pages.get(key, set())
+        names.discard(name)
+        if not names:
+            self.pages.pop(key, None)
+            record = parse_name(name)
+            if record is not None and record.rerun:
+                reruns = self.claims.get(record.sample, set())
+                reruns.discard(key)
+                if not reruns:
+                    self.claims.pop(record.sample, None)
+        self.dirty.add(key)
+
+    def add_coc(self, name, path, now):
+        """Add a new CoC to the CoC index or range index."""
+        self.cocs[name] = path
+        self.arrived.setdefault(name, now)
+        bounds = range_bounds(name)
+        if bounds is None:
+            record = parse_name(name)
+            keys = [record.key] + ([record.sample] if record.rerun else [])
+            for key in keys:
+                paths = self.coc_keys.setdefault(key, [])
+                paths.append(path)
+                self.coc_index[key] = paths[0]
+        else:
+            rerun_char, first, last = bounds
+            bisect.insort(self.ranges.setdefault(rerun_char, []),
+                          (first, last, path))
+            self.reindex_ranges(rerun_char)
+        self.dirty.update(get_ranges(name))
+
+    def drop_coc(self, name):
+        """Remove a CoC that disappeared from the indexes."""
+        path = self.cocs.pop(name)
+        self.arrived.pop(name, None)
+        bounds = range_bounds(name)
+        if bounds is None:
+            record = parse_name(name)
+            keys = [record.key] + ([record.sample] if record.rerun else [])
+            for key in keys:
+                paths = self.coc_keys.get(key, [])
+                if path in paths:
+                    paths.remove(path)
+                if paths:
+                    self.coc_index[key] = paths[0]
+                else:
+                    self.coc_keys.pop(key, None)
+                    self.coc_index.pop(key, None)
+        else:
+            rerun_char, first, last = bounds
+            self.ranges[rerun_char].remove((first, last, path))
+            self.reindex_ranges(rerun_char)
+        self.dirty.update(get_ranges(name))
+
+    def reindex_ranges(self, rerun_char):
+        """Rebuild the range index for one rerun character, in the form
+        `index_ranges` returns."""
+        intervals = self.ranges.get(rerun_char)
+        if not intervals:
+            self.ranges.pop(rerun_char, None)
+            self.range_index.pop(rerun_char, None)
+            return
+        reach = None
+        indexed = []
+        for first, last, path in intervals:
+            reach = last if reach is None else max(reach, last)
+            indexed.append((first, last, reach, path))
+        self.range_index[rerun_char] = indexed
+
+    def match(self):
+        """Match reports again around the sample keys that changed.
+
+        Every report covering a changed key is dropped, along with the
+        reports sharing keys with it, and `aggregator` is run over just
+        the PDFs for those keys.
+        """
+        if not self.dirty:
+            return
+        keys = set()
+        frontier = list(self.dirty)
+        self.dirty.clear()
+        while frontier:
+            key = frontier.pop()
+            if key in keys:
+                continue
+            keys.add(key)
+            report_name = self.key_reports.get(key)
+            if report_name is not None:
+                frontier.extend(self.report_keys[report_name])
+            coc = self.coc_index.get(key)
+            if coc is None:
+                coc = find_range_coc(self.range_index, key)
+            if coc is not None:
+                frontier.extend(get_ranges(os.path.basename(coc)))
+            # Numbers claim their reruns, which a CoC for the number
+            # may cover
+            frontier.extend(self.claims.get(key, ()))
+            if key[:6] != key:
+                frontier.append(key[:6])
+
+        for key in keys:
+            report_name = self.key_reports.pop(key, None)
+            if report_name is not None:
+                self.reports.pop(report_name, None)
+                self.report_keys.pop(report_name, None)
+
+        pdfs = [n for key in keys for n in self.pages.get(key, ())]
+        missing_coc_list, report_dict = aggregator(
+            [], (), [], pdfs, None, self.coc_index, self.range_index)
+        for report_name, dictionary in report_dict.items():
+            covered = get_ranges(os.path.basename(dictionary['coc']))
+            covered.update(sample_key(n) for n in dictionary['pdfs'])
+            self.reports[report_name] = dictionary
+            self.report_keys[report_name] = covered
+            for key in covered:
+                self.key_reports[key] = report_name
+
+    def ready(self, now=None):
+        """Return a list of (report name, dictionary) tuples for reports
+        that are complete and outside the grace window."""
+        if now is None:
+            now = time.time()
+        self.match()
+
+        ready = []
+        for report_name, dictionary in sorted(self.reports.items()):
+            if dictionary['missing_pdfs'] or not dictionary['pdfs']:
+                continue
+            names = dictionary['pdfs'] + [os.path.basename(dictionary['coc'])]
+            if now - max(self.arrived.get(n, now) for n in names) >= self.grace:
+                ready.append((report_name, dictionary))
+        return ready
+
+    def step(self, directories=None, now=None):
+        """Scan, then collate, dispose of and bill every ready report.
+
+        Returns a list of (report name, stats) tuples for the reports
+        collated. Each report's inputs are archived and it is billed in
+        the background while the rest are collated; the step returns
+        once they are done. A report whose inputs can't be archived or
+        whose copy to billings fails is reported, and the watch carries
+        on.
+        """
+        self.scan(directories, now)
+        done = []
+        started = time.time()
+        history = []
+        disposals = {}
+        bills = {}
+        # One manifest per step, saved once the bills are done, so
+        # concurrent bills don't overwrite each other's entries
+        manifest = load_billing_manifest()
+        for report_name, dictionary, stats in collate_reports(
+                self.ready(now), self.jobs, self.backend, None, self.profile):
+            history.append((report_name, dictionary, stats))
+            for name in dictionary['pdfs']:
+                self.drop_pdf(name)
+            disposals[report_name] = self.disposal.submit(dispose, dictionary)
+            bills[report_name] = self.billing.submit(bill, report_name,
+                                                     manifest)
+            print("Collated {0} ({1})".format(report_name,
+                                              humanize_size(stats['bytes_out'])))
+            done.append((report_name, stats))
+
+        for report_name, future in disposals.items():
+            try:
+                future.result()
+            except OSError as e:
+                print("Could not archive the inputs of {0}: {1}".format(
+                    report_name, e))
+        for report_name, future in bills.items():
+            try:
+                future.result()
+            except OSError as e:
+                print("Could not bill {0}: {1}".format(report_name, e))
+        if bills:
+            try:
+                save_billing_manifest(manifest)
+            except OSError as e:
+                print("Could not save the billing manifest: {0}".format(e))
+        if history:
+            record_run(history, started, self.jobs, 'watch')
+        self.compact(now)
+        return done
+
+    def compact(self, now=None):
+        """Start compacting the archive if COMPACT_INTERVAL seconds have
+        passed since it was last started, and report how the last
+        compaction went once it has finished."""
+        if now is None:
+            now = time.time()
+        if self.compaction is not None and self.compaction.done():
+            try:
+                self.compaction.result()
+            except OSError as e:
+                print("Could not compact the archive: {0}".format(e))
+            self.compaction = None
+        if self.compaction is None and (
+                self.compacted is None or
+                now - self.compacted >= COMPACT_INTERVAL):
+            self.compacted = now
+            self.compaction = self.disposal.submit(compact_archive)
+
+    def run(self):
+        """Watch and collate until interrupted with Ctrl-C.
+
+        An OSError while scanning or collating (e.g. a network mount that
+        went away) is printed, and every directory is listed again after
+        'poll' seconds.
+        """
+        try:
+            directories = None
+            while True:
+                try:
+                    self.step(directories)
+                    directories = self.wait()
+                except OSError as e:
+                    # e.g. a network mount that went away for a moment
+                    print("Watching failed: {0}. Trying again in {1} "
+                          "seconds.".format(e, self.poll))
+                    time.sleep(self.poll)
+                    # Changes may have been missed; list everything
+                    directories = None
+        except KeyboardInterrupt:
+            pass
+        finally:
+            close_ghostscript_sessions()
+            close_stager()
+            self.disposal.shutdown()
+            self.billing.shutdown()
+            if self.compaction is not None:
+                try:
+                    self.compaction.result()
+                except OSError as e:
+                    print("Could not compact the archive: {0}".format(e))
+            if self.inotify is not None:
+                self.inotify.close()
+
+
+def total_file_size(file_list, snapshot=None):
+    """Return the size of a single file or the size of files present in
+    a given list of absolute paths to files.
+
+    If a `snapshot` from `snapshot_directories` is given, sizes are read
+    from it, so each file is stat-ed at most once per run.
+
+    Return value is either the size of the file, or files, in bytes, or
+    `False` in the case that the function was passed the wrong file
+    type, or a file does not exist.
+    """
+
+    total_size = 0
+    # One stat per file. os.path.exists() followed by os.path.getsize()
+    # would stat every file twice.
+
+    # Check for type -- str (single file) or list (list of files)
+    if isinstance(file_list, str):
+        file_list = [file_list]
+    elif not isinstance(file_list, list):
         raise TypeError(type(file_list))
+
+    for f in file_list:
+        stat = file_stat(f, snapshot)
+        if stat is None:
+            return False
+        total_size += stat.st_size
     # Return size of file(s) in bytes
     return total_size
 
@@ -564,19 +3187,483 @@ def humanize_size(size):
         size /= 1024.0
 
 
+@contextlib.contextmanager
+def span(stage, **fields):
+    """Time one stage of a run and record it in METRICS.
+
+    'stage' - name of the stage, e.g. 'name_check' or 'collate'.
+    'fields' - starting values for the record, e.g. report=report_name.
+
+    Yields the record, a dictionary the stage can add counts and bytes
+    to. When the stage ends, its wall time is added as 'seconds':
+
+        with span('strip_chars') as record:
+            good, bad = strip_chars(REVD_REPORTS)
+            record['pdfs'] = len(good)
+
+    Records are also logged at the DEBUG level.
+    """
+    record = {'stage': stage}
+    record.update(fields)
+    record['start'] = time.time()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        with _metrics_lock:
+            METRICS.append(record)
+        logger.debug("%s took %.3fs %s", stage, record['seconds'],
+                     {k: v for k, v in record.items()
+                      if k not in ('stage', 'start', 'seconds')})
+
+
+def metrics_summary(records):
+    """Return total seconds, number of spans and summed counts for each
+    stage in 'records', a list of span records."""
+    summary = {}
+    for record in records:
+        stage = summary.setdefault(record['stage'], {'count': 0,
+                                                     'seconds': 0.0})
+        stage['count'] += 1
+        for key, value in record.items():
+            if key in ('stage', 'start', 'count'):
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                stage[key] = stage.get(key, 0) + value
+    return summary
+
+
+def start_profiling():
+    """Start cProfile and tracemalloc. Returns the profiler.
+
+    Only the main thread is profiled by cProfile; collation workers show
+    up in the 'collate' spans instead.
+    """
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiling(profiler, limit=30):
+    """Stop profiling and return the results as a dictionary of the top
+    'limit' functions by cumulative time and the top 'limit' memory
+    allocation sites."""
+    profiler.disable()
+    stats = pstats.Stats(profiler)
+    functions = []
+    for (filename, line, name), (cc, nc, tt, ct, callers) in \
+            stats.stats.items():
+        functions.append({'function': '{0}:{1}({2})'.format(filename, line,
+                                                            name),
+                          'calls': nc,
+                          'total_seconds': tt,
+                          'cumulative_seconds': ct})
+    functions.sort(key=lambda f: f['cumulative_seconds'], reverse=True)
+
+    memory = tracemalloc.take_snapshot().statistics('lineno')
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'functions': functions[:limit],
+            'memory': {'current_bytes': current,
+                       'peak_bytes': peak,
+                       'top': [{'location': str(m.traceback),
+                                'bytes': m.size,
+                                'blocks': m.count} for m in memory[:limit]]}}
+
+
+def write_metrics(path, profile=None):
+    """Write every recorded span, a summary per stage and the optional
+    'profile' results (from `stop_profiling`) to 'path' as JSON.
+
+    Only the last METRICS_MAX spans are kept, so a long-running process
+    writes its most recent ones.
+    """
+    with _metrics_lock:
+        records = list(METRICS)
+    metrics = {'version': __version__,
+               'spans': records,
+               'stages': metrics_summary(records)}
+    if profile is not None:
+        metrics['profile'] = profile
+    with open(path, 'w') as f:
+        json.dump(metrics, f, indent=2)
+
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,       -- Unix time
+    seconds REAL,       -- Wall time of the whole run
+    host TEXT,
+    mode TEXT,          -- 'local', 'spool' or 'watch'
+    jobs INTEGER,
+    collated INTEGER    -- Reports collated (not cached) in the run
+);
+CREATE TABLE IF NOT EXISTS reports (
+    run INTEGER REFERENCES runs(id),
+    report TEXT,
+    site TEXT,          -- CoC source name, see coc_sources()
+    pages INTEGER,      -- Reviewed PDFs plus the CoC
+    bytes_in INTEGER,
+    bytes_out INTEGER,
+    backend TEXT,
+    profile TEXT,
+    seconds REAL,       -- Wall time of the collation
+    attempts INTEGER,
+    outcome TEXT        -- 'collated', 'cached', 'skipped', 'deferred' or
+                        -- 'failed'
+);
+CREATE INDEX IF NOT EXISTS reports_run ON reports (run);
+"""
+
+
+def open_history(path=None):
+    """Open the run history database (default HISTORY_DB), creating its
+    tables if needed."""
+    connection = sqlite3.connect(path or HISTORY_DB, timeout=30)
+    connection.executescript(HISTORY_SCHEMA)
+    return connection
+
+
+def coc_site(coc):
+    """Return the name of the CoC source 'coc' (a full path) came from,
+    or `None` if it is in none of them."""
+    directory = os.path.normpath(os.path.dirname(coc))
+    for site, root in coc_sources().items():
+        if os.path.normpath(root) == directory:
+            return site
+    return None
+
+
+def record_run(reports, started, jobs=1, mode='local'):
+    """Add a run and its reports to the run history.
+
+    'reports' - a list of (report name, report dictionary, result)
+                tuples, where 'result' is the stats from `collate` or
+                "Skipped", "Deferred" or "Failed".
+    'started' - the time the run started, from `time.time`.
+
+    History is a record, not part of the run: if it can't be written, a
+    warning is logged and the run carries on.
+
+    Returns the new run's id, or `None` if nothing was written.
+    """
+    rows = []
+    for report_name, dictionary, result in reports:
+        row = {'report': report_name, 'site': None, 'pages': None,
+               'bytes_in': None, 'bytes_out': None, 'backend': None,
+               'profile': None, 'seconds': None, 'attempts': None}
+        if dictionary is not None:
+            row['site'] = coc_site(dictionary['coc'])
+            row['pages'] = len(dictionary['pdfs']) + 1
+        if isinstance(result, dict):
+            row.update((key, result.get(key)) for key in
+                       ['bytes_in', 'bytes_out', 'backend', 'profile',
+                        'seconds', 'attempts'])
+            row['outcome'] = 'cached' if result.get('cached') else 'collated'
+        else:
+            row['outcome'] = result.lower()
+        rows.append(row)
+
+    try:
+        connection = open_history()
+        try:
+            with connection:
+                run = connection.execute(
+                    "INSERT INTO runs (started, seconds, host, mode, jobs, "
+                    "collated) VALUES (?, ?, ?, ?, ?, ?)",
+                    (started, time.time() - started, socket.gethostname(),
+                     mode, jobs, sum(1 for r in rows
+                                     if r['outcome'] == 'collated'))
+                ).lastrowid
+                connection.executemany(
+                    "INSERT INTO reports (run, report, site, pages, bytes_in, "
+                    "bytes_out, backend, profile, seconds, attempts, outcome) "
+                    "VALUES (:run, :report, :site, :pages, :bytes_in, "
+                    ":bytes_out, :backend, :profile, :seconds, :attempts, "
+                    ":outcome)", [dict(row, run=run) for row in rows])
+        finally:
+            connection.close()
+    except (sqlite3.Error, OSError) as e:
+        logger.warning("Could not write the run history: %s", e)
+        return None
+    return run
+
+
+def percentile(values, fraction):
+    """Return the 'fraction' (0.5 for the median) percentile of 'values',
+    interpolating between the nearest two, or `None` if empty."""
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def batch_size(collated):
+    """Return the batch size bucket ('1', '2-9', '10-99' or '100+') of a
+    run that collated 'collated' reports."""
+    if collated <= 1:
+        return '1'
+    elif collated < 10:
+        return '2-9'
+    elif collated < 100:
+        return '10-99'
+    return '100+'
+
+
+def summarize_reports(rows):
+    """Summarize collated report rows of (seconds, pages, bytes_in,
+    bytes_out):
+        {'reports': 120,
+         'seconds': {'p50': 1.2, 'p90': 3.4, 'p99': 9.8},
+         'seconds_per_page': {'p50': 0.31, 'p90': 0.52, 'p99': 1.1},
+         'bytes_per_second': 2145723.0,   # Input bytes over total time
+         'pages_per_second': 3.2,
+         'reduction': 0.71}               # Share of input bytes saved
+    """
+    rows = [r for r in rows if r[0] is not None]
+    seconds = [r[0] for r in rows]
+    per_page = [r[0] / r[1] for r in rows if r[1]]
+    total_seconds = sum(seconds)
+    bytes_in = sum(r[2] or 0 for r in rows)
+    bytes_out = sum(r[3] or 0 for r in rows)
+    fractions = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
+    return {'reports': len(rows),
+            'seconds': {name: percentile(seconds, f)
+                        for name, f in fractions.items()},
+            'seconds_per_page': {name: percentile(per_page, f)
+                                 for name, f in fractions.items()},
+            'bytes_per_second': (bytes_in / total_seconds
+                                 if total_seconds else None),
+            'pages_per_second': (sum(r[1] or 0 for r in rows) / total_seconds
+                                 if total_seconds else None),
+            'reduction': 1 - bytes_out / bytes_in if bytes_in else None}
+
+
+def history_stats(days=None, path=None):
+    """Summarize the run history of the last 'days' days (default: all
+    of it).
+
+    Returns a dictionary of:
+        'runs' - the number of runs;
+        'outcomes' - the number of reports with each outcome;
+        'overall' - a `summarize_reports` summary of collated reports;
+        'sites', 'profiles', 'backends', 'batch_sizes', 'weeks' - the
+                 same summary grouped by CoC site, compression profile,
+                 backend, batch size (see `batch_size`) and ISO week
+                 ('2026-W42'), for spotting trends.
+    """
+    since = time.time() - days * 86400 if days else 0
+    connection = open_history(path)
+    try:
+        runs = connection.execute("SELECT COUNT(*) FROM runs WHERE "
+                                  "started >= ?", (since,)).fetchone()[0]
+        outcomes = dict(connection.execute(
+            "SELECT outcome, COUNT(*) FROM reports JOIN runs ON run = id "
+            "WHERE started >= ? GROUP BY outcome", (since,)))
+        rows = connection.execute(
+            "SELECT reports.seconds, pages, bytes_in, bytes_out, site, "
+            "profile, backend, collated, started FROM reports "
+            "JOIN runs ON run = id "
+            "WHERE started >= ? AND outcome = 'collated' ORDER BY started",
+            (since,)).fetchall()
+    finally:
+        connection.close()
+
+    groups = {'sites': {}, 'profiles': {}, 'backends': {},
+              'batch_sizes': {}, 'weeks': {}}
+    for row in rows:
+        keys = {'sites': row[4] or '(unknown)', 'profiles': row[5],
+                'backends': row[6], 'batch_sizes': batch_size(row[7]),
+                'weeks': time.strftime('%G-W%V', time.localtime(row[8]))}
+        for group, key in keys.items():
+            groups[group].setdefault(key, []).append(row[:4])
+
+    stats = {'runs': runs, 'outcomes': outcomes,
+             'overall': summarize_reports([row[:4] for row in rows])}
+    for group, members in groups.items():
+        stats[group] = {key: summarize_reports(members)
+                        for key, members in members.items()}
+    return stats
+
+
+def print_stats(days=None):
+    """Print `history_stats` as tables."""
+    stats = history_stats(days)
+    print("Run history{0}: {1} runs, {2}.".format(
+        " for the last {0} days".format(days) if days else "",
+        stats['runs'], ", ".join("{0} {1}".format(count, outcome)
+                                 for outcome, count
+                                 in sorted(stats['outcomes'].items()))
+        or "no reports"))
+
+    def number(value, form):
+        return '-' if value is None else form.format(value)
+
+    tables = [('All collated reports', {'': stats['overall']}),
+              ('By site', stats['sites']),
+              ('By profile', stats['profiles']),
+              ('By backend', stats['backends']),
+              ('By reports per run', stats['batch_sizes']),
+              ('By week', stats['weeks'])]
+    for title, summaries in tables:
+        print()
+        print("{0:<18} {1:>7} {2:>8} {3:>8} {4:>8} {5:>9} {6:>10} "
+              "{7:>8}".format(title, 'Reports', 'p50 s', 'p90 s', 'p99 s',
+                              's/page', 'Input/s', 'Reduced'))
+        print("-" * 83)
+        for key, summary in sorted(summaries.items()):
+            print("{0:<18} {1:>7} {2:>8} {3:>8} {4:>8} {5:>9} {6:>10} "
+                  "{7:>8}".format(
+                      str(key)[:18], summary['reports'],
+                      number(summary['seconds']['p50'], '{0:.2f}'),
+                      number(summary['seconds']['p90'], '{0:.2f}'),
+                      number(summary['seconds']['p99'], '{0:.2f}'),
+                      number(summary['seconds_per_page']['p50'], '{0:.3f}'),
+                      '-' if summary['bytes_per_second'] is None else
+                      humanize_size(summary['bytes_per_second']),
+                      number(summary['reduction'] and
+                             summary['reduction'] * 100, '{0:.1f}%')))
+
+    # Flag the latest week if it got slower than the weeks before it
+    weeks = sorted(stats['weeks'].items())
+    if len(weeks) > 1:
+        latest = weeks[-1][1]['seconds_per_page']['p50']
+        before = percentile([w['seconds_per_page']['p50']
+                             for key, w in weeks[:-1]
+                             if w['seconds_per_page']['p50'] is not None], 0.5)
+        if latest and before:
+            print()
+            print("Median time per page in {0} is {1:+.0f}% against the "
+                  "weeks before.".format(weeks[-1][0],
+                                         (latest / before - 1) * 100))
+
+
 def main():
 
-    parser_setup()
+    args = parser_setup()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else
+                        logging.WARNING, format='%(message)s')
+
+    profiler = start_profiling() if args.profile else None
+    try:
+        run(args)
+    finally:
+        if args.metrics or profiler is not None:
+            profile = stop_profiling(profiler) if profiler else None
+            write_metrics(args.metrics or METRICS_FILE, profile)
+
+
+def run(args):
+    """Run the collator with the parsed command line 'args'."""
+    global CACHE_DIR, CACHE_MAX_BYTES, CACHE_HASH, ARCHIVE, BALLOON_RATIO
+    global STAGE_DIR
+    config = args.config
+    if config is None and os.path.exists(CONFIG_FILE):
+        config = CONFIG_FILE
+    if config:
+        try:
+            load_config(config)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+    BALLOON_RATIO = args.balloon_ratio
+    if args.archive:
+        ARCHIVE = args.archive
+    if args.cache:
+        CACHE_DIR = args.cache
+        CACHE_MAX_BYTES = args.cache_size * 1024 ** 2
+        CACHE_HASH = args.cache_hash
+    if args.stage:
+        STAGE_DIR = local_scratch() if args.stage == 'auto' else args.stage
+
+    if args.stats:
+        print_stats(args.stats_days)
+        return
+
+    if args.plan:
+        dry_run(args)
+        return
 
     # Make system checks
     print("Performing system checks...", end=" ")
-    if system_checks():
+    with span('system_checks') as record:
+        record['passed'] = system_checks(args.platform)
+    if record['passed']:
         print("Passed.")
     else:
         print("System checks failed. Program exiting.\n")
         sys.exit(1)
 
-    if file_check(REVD_REPORTS) == False:
+    if args.worker:
+        print()
+        print("Collating jobs from {0}. Press Ctrl-C to stop.".format(
+            args.spool))
+        try:
+            run_worker(args.spool)
+        finally:
+            close_ghostscript_sessions()
+            close_stager()
+        return
+
+    if args.clean:
+        print("Cleaning in progress...")
+        print('...')
+        cleaned = clean()
+        if cleaned is None:
+            print("The last run finished. Nothing to clean.")
+        else:
+            print("Removed {reports} partial reports, restored {restored} "
+                  "files from the archive and reset {renamed} PDF "
+                  "names.".format(**cleaned))
+        print("Cleaning complete.")
+        return
+
+    state = journal_state(read_journal())
+    if args.resume:
+        resume(args, state)
+        return
+    elif state is not None:
+        print()
+        print("The last run did not finish. Run this program again with "
+              "--resume to finish it, or --clean to roll it back.")
+        sys.exit(1)
+
+    if args.execute:
+        planned = load_plan(args.execute)
+        if planned['revd_reports'] != REVD_REPORTS:
+            print("{0} was planned for {1}, not {2}. Program exiting.\n"
+                  .format(args.execute, planned['revd_reports'],
+                          REVD_REPORTS))
+            sys.exit(1)
+        print()
+        print("Executing the plan from {0}.".format(planned['created']))
+        open_journal()
+        plan = plan_run(args, planned['reports'], planned['unmatched_pdfs'],
+                        planned['renames'])
+        execute(plan, args)
+        return
+
+    if args.watch:
+        print()
+        print("Watching for reviewed reports. Press Ctrl-C to stop.")
+        Watcher(grace=args.grace, poll=args.poll, jobs=args.jobs,
+                backend=args.backend, profile=args.compression).run()
+        return
+
+    # List every directory once, all at the same time
+    directories = coc_directories()
+    with span('snapshot') as record:
+        snapshot = snapshot_directories(REVD_REPORTS, *directories)
+        record['files'] = sum(len(names) for names in snapshot.values())
+
+    if file_check(REVD_REPORTS, snapshot) == False:
         print("No files exist in the reviewed reports folder for collation.")
         print("Program exiting.\n")
         sys.exit(0)
@@ -584,7 +3671,10 @@ def main():
     # Check CoC file names
     print()
     print("Analyzing CoC names...", end=" ")
-    bad_names, coc_list = name_check(AUS_COCS, CORP_COCS, PT_COCS)
+    with span('name_check') as record:
+        bad_names, coc_list = name_check(*directories, snapshot=snapshot)
+        record['cocs'] = len(coc_list)
+        record['bad_names'] = len(bad_names or [])
     if bad_names:
         print()
         print("The following CoCs have been improperly named. Please correct "
@@ -600,7 +3690,13 @@ def main():
     # Remove job_#### prefixes and check namings
     print()
     print("Analyzing and fixing PDF names...", end=" ")
-    good_pdf_names, bad_pdf_names = strip_chars(REVD_REPORTS)
+    # Files are renamed from here on, so keep a journal to resume from
+    open_journal()
+    with span('strip_chars') as record:
+        good_pdf_names, bad_pdf_names = strip_chars(REVD_REPORTS, snapshot,
+                                                    defer=True)
+        record['pdfs'] = len(good_pdf_names)
+        record['bad_names'] = len(bad_pdf_names or [])
     if bad_pdf_names:
         print()
         print("An error has occurred when stripping file names!")
@@ -626,23 +3722,63 @@ def main():
     print("Searching for and matching CoCs...")
     print()
 
-    # Sets used as input to find_coc fn for faster lookups
-    A_set = set(os.listdir(AUS_COCS))
-    A_set.discard('.DS_Store')
-    C_set = set(os.listdir(CORP_COCS))
-    C_set.discard('.DS_Store')
-    P_set = set(os.listdir(PT_COCS))
-    P_set.discard('.DS_Store')
+    # Sets used as input to find_coc fn for faster lookups, one per source
+    coc_tuple = tuple(set(list_directory(d, snapshot)) for d in directories)
+    # Built once; every PDF lookup is then a single dictionary access
+    with span('index') as record:
+        coc_index = index_cocs(coc_list, coc_tuple)
+        range_index = index_ranges(coc_list, coc_tuple)
+        record['keys'] = len(coc_index)
+        record['ranges'] = sum(len(r) for r in range_index.values())
 
-    coc_tuple = (A_set, C_set, P_set)
+    overlaps = range_overlaps(range_index)
+    if overlaps:
+        print("Warning! The following CoC ranges claim the same PDFs. Only "
+              "one CoC will be used for each PDF.")
+        print("--------------------")
+        for first, second, samples in overlaps:
+            print(" * {0} and {1}: {2}".format(os.path.basename(first),
+                                                os.path.basename(second),
+                                                ", ".join(samples)))
+        print("--------------------")
+        print()
 
     pdf_stack = good_pdf_names[:]
     # Sorting is required -- ensures we start searching from the first PDF in
     # each COC range, if a range exists.
     pdf_stack.sort()
     missing_coc_list = [] # The list of all pdfs for which no CoC could be found
-    missing_coc_list, report_dict = aggregator(coc_list, coc_tuple,
-                                               missing_coc_list, pdf_stack)
+    with span('aggregator', pdfs=len(pdf_stack)) as record:
+        missing_coc_list, report_dict = aggregator(coc_list, coc_tuple,
+                                                   missing_coc_list, pdf_stack,
+                                                   coc_index=coc_index,
+                                                   range_index=range_index)
+        record['reports'] = len(report_dict)
+        record['missing_cocs'] = len(missing_coc_list)
+
+    # Deferred renames are kept with the plan, so a resumed run can still
+    # find the PDFs under their stored names
+    with _renames_lock:
+        renames = {d: dict(names)
+                   for d, names in PENDING_RENAMES.items() if names}
+    plan = plan_run(args, report_dict, missing_coc_list, renames)
+    execute(plan, args, snapshot)
+
+
+def plan_run(args, report_dict, missing_coc_list, renames):
+    """Report the PDFs without a CoC, decide which reports to collate and
+    record the plan in the run journal. Shared by normal runs and
+    --execute.
+
+    'report_dict' - the report dictionary from `aggregator`.
+    'missing_coc_list' - PDFs for which no CoC could be found.
+    'renames' - renames strip_chars deferred, as in PENDING_RENAMES.
+
+    Reports deferred by an earlier run go first, and the reports and
+    PDFs put off by this one are saved to the queue for the next.
+    Returns the plan for `execute`.
+    """
+    queue = load_queue()
 
     # Get user's consent to continue execution, despite missing COCs being
     # detected.
@@ -653,8 +3789,19 @@ def main():
               "again.\n")
         print("---------------------")
         for num in missing_coc_list:
-            print(' * ', num)
+            if num in queue['pdfs']:
+                print(' * ', num, time.strftime("(deferred since %Y-%m-%d)",
+                                                time.localtime(
+                                                    queue['pdfs'][num])))
+            else:
+                print(' * ', num)
         print("---------------------")
+        if args.missing_coc == 'defer':
+            print("These PDFs are queued and will be listed again next run.")
+        elif args.missing_coc == 'abort':
+            print("Program exiting.\n")
+            close_journal()
+            sys.exit(1)
 # Commented out -- flow control is off. 'break' causes errors...
 #        ans = input("Do you want to continue with other reports (y/n)?\n")
 #        while True:
@@ -668,11 +3815,40 @@ def main():
 #            else:
 #                print("Yes ('y') or no ('n'), please.")
 #                ans = input("Continue with other reports (y/n)?\n")
-    # Create reports
-    report_stats = []
-    for report_name in list(report_dict.keys()):
-        #unpack dictionary
-        dictionary = report_dict.pop(report_name)
+    # Reports deferred by the last run go first
+    report_names = sorted(report_dict, key=lambda name:
+                          name not in queue['reports'])
+    queued = len([name for name in queue['reports'] if name in report_dict])
+    if queued:
+        print("{0} deferred reports are queued from an earlier "
+              "run.".format(queued))
+        print()
+
+    # Decide which reports to create. Prompts are answered up front so
+    # that collation can run unattended in parallel afterwards.
+    plan = plan_reports(report_names, report_dict, args.missing_pdfs)
+    save_queue(plan['deferred'],
+               missing_coc_list if args.missing_coc == 'defer' else [], queue)
+    plan['renames'] = renames
+    journal('plan', plan=plan)
+    return plan
+
+
+def plan_reports(report_names, report_dict, missing_pdfs='prompt'):
+    """Decide what to do with each report and return the plan for
+    `execute`.
+
+    'report_names' - report names in the order to collate them.
+    'report_dict' - the report dictionary from `aggregator`.
+    'missing_pdfs' - the policy for reports with missing PDFs: 'prompt'
+                     to ask the user whether to skip each one, 'skip',
+                     'partial' to collate the PDFs that are there, or
+                     'defer' to skip it and queue it for the next run.
+    """
+    plan = {'order': report_names, 'reports': report_dict, 'collate': [],
+            'skipped': [], 'deferred': []}
+    for report_name in report_names:
+        dictionary = report_dict[report_name]
 
         # Handle missing PDFs from the back check
         if dictionary['missing_pdfs']:
@@ -681,69 +3857,307 @@ def main():
                     "The missing PDFs are:".format(report_name))
             for i in dictionary['missing_pdfs']:
                 print("\t{0}".format(i))
-
             print()
-            response = input("Skip this report (y/n)?\n")
-            while True:
-                lower_response = str(response).lower()
-                if lower_response == 'y' or lower_response == 'yes':
-                    stats = [report_name, "Skipped"]
-                    report_stats.append(stats)
-                    break
-                elif lower_response == 'n' or lower_response == 'no':
-                    size = collate(report_name, dictionary)
-                    stats = [report_name, size]
-                    report_stats.append(stats)
-                    break
-                else:
-                    print("Yes ('y') or no ('n'), please.")
-                    ans = input("Skip this report (y/n)?\n")
+
+            if missing_pdfs == 'prompt':
+                decision = 'skip' if ask("Skip this report?") else 'partial'
+            else:
+                decision = missing_pdfs
+                print("Policy: {0}.".format(decision))
+            if decision == 'skip':
+                plan['skipped'].append(report_name)
+            elif decision == 'defer':
+                plan['deferred'].append(report_name)
+            else:
+                plan['collate'].append(report_name)
         else:
-            size = collate(report_name, dictionary)
-            stats = [report_name, size]
-            report_stats.append(stats)
+            plan['collate'].append(report_name)
+    return plan
 
-        # Move PDF then COC files to user's trash
-        for f in dictionary['pdfs']:
-            try:
-                shutil.copy2(os.path.join(REVD_REPORTS, f),
-                             os.path.expanduser('~/.Trash'))
-                os.remove(os.path.join(REVD_REPORTS, f))
-            except OSError:
-                os.remove(os.path.join(REVD_REPORTS, f))
 
+def load_queue():
+    """Return the deferred queue: a dictionary of 'reports' and 'pdfs'
+    (PDFs with no CoC), each mapping a name to the time it was first
+    deferred."""
+    try:
+        with open(QUEUE_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'reports': {}, 'pdfs': {}}
+
+
+def save_queue(reports, pdfs, queue=None):
+    """Replace the deferred queue with 'reports' and 'pdfs', keeping the
+    time each was first deferred from the old 'queue'."""
+    queue = queue or {'reports': {}, 'pdfs': {}}
+    now = time.time()
+    new = {'reports': {name: queue['reports'].get(name, now)
+                       for name in reports},
+           'pdfs': {name: queue['pdfs'].get(name, now) for name in pdfs}}
+    directory = os.path.dirname(QUEUE_FILE) or '.'
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(new, f, indent=1, sort_keys=True)
+        os.replace(temp, QUEUE_FILE)
+    except BaseException:
+        os.remove(temp)
+        raise
+    return new
+
+
+def build_plan():
+    """Scan, check names and match PDFs to CoCs as a run would, but change
+    nothing: no files are renamed and no programs are run.
+
+    Returns the plan as a JSON-serializable dictionary:
+        {'created': '2015-06-01T09:30:00',
+         'revd_reports': '/path/to/reviewed',
+         'reports': {'123456-458.pdf': {
+                         'coc': '/path/to/123456-458coc.pdf',
+                         'pdfs': ['123456pg1.pdf', '123457pg1.pdf'],
+                         'missing_pdfs': ['123458'],
+                         'bytes_in': 1238760},   # Estimated input size
+                     ...},
+         'unmatched_pdfs': ['654321pg1.pdf'],    # No CoC found
+         'bad_cocs': [...], 'bad_pdfs': [...],   # Badly named files
+         'overlaps': [['/path/a', '/path/b', ['123457']], ...],
+         'renames': {'/path/to/reviewed': {'123456pg1.pdf':
+                                           'job_12 123456pg1.pdf'}},
+         'bytes_in': 1238760}
+
+    PDF names are given without their scanner prefixes; 'renames' holds
+    the names they are still stored under. File sizes come from a single
+    directory snapshot.
+    """
+    directories = coc_directories()
+    with span('snapshot') as record:
+        snapshot = snapshot_directories(REVD_REPORTS, *directories)
+        record['files'] = sum(len(names) for names in snapshot.values())
+    with span('name_check') as record:
+        bad_names, coc_list = name_check(*directories, snapshot=snapshot)
+        record['cocs'] = len(coc_list)
+    bad_names = bad_names or []
+    # Badly named CoCs stop a run; plan around them
+    good_names = set(coc_list) - set(bad_names)
+    coc_list = [name for name in coc_list if name in good_names]
+
+    with span('strip_chars') as record:
+        good_pdf_names, bad_pdf_names = strip_chars(REVD_REPORTS, snapshot,
+                                                    defer=True)
+        record['pdfs'] = len(good_pdf_names)
+    coc_tuple = tuple(set(list_directory(d, snapshot)) & good_names
+                      for d in directories)
+    with span('index'):
+        coc_index = index_cocs(coc_list, coc_tuple)
+        range_index = index_ranges(coc_list, coc_tuple)
+    with span('aggregator', pdfs=len(good_pdf_names)) as record:
+        missing_coc_list, report_dict = aggregator(
+            coc_list, coc_tuple, [], sorted(good_pdf_names),
+            coc_index=coc_index, range_index=range_index)
+        record['reports'] = len(report_dict)
+
+    reports = {}
+    for report_name in sorted(report_dict):
+        dictionary = report_dict[report_name]
+        reports[report_name] = dict(dictionary, bytes_in=total_file_size(
+            report_inputs(dictionary), snapshot) or 0)
+    with _renames_lock:
+        renames = {d: PENDING_RENAMES.pop(d) for d in list(PENDING_RENAMES)}
+
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revd_reports': REVD_REPORTS,
+            'reports': reports,
+            'unmatched_pdfs': missing_coc_list,
+            'bad_cocs': sorted(bad_names),
+            'bad_pdfs': sorted(bad_pdf_names or []),
+            'overlaps': [[first, second, samples] for first, second, samples
+                         in range_overlaps(range_index)],
+            'renames': {d: names for d, names in renames.items() if names},
+            'bytes_in': sum(r['bytes_in'] for r in reports.values())}
+
+
+def load_plan(path):
+    """Read a plan written by `build_plan` from 'path'.
+
+    Deferred renames of files that have since been renamed or removed are
+    dropped, so the files are looked for under their stripped names.
+    """
+    with open(path) as f:
+        plan = json.load(f)
+    plan['renames'] = {
+        directory: {new: old for new, old in names.items()
+                    if os.path.exists(os.path.join(directory, old))}
+        for directory, names in plan.get('renames', {}).items()}
+    return plan
+
+
+def dry_run(args):
+    """Write the plan from `build_plan` to the --plan file, or to standard
+    output if it is '-'. Messages go to standard error in that case."""
+    stdout = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr if args.plan == '-'
+                                    else stdout):
+        print("Performing system checks...", end=" ")
+        if not system_checks(args.platform, ghostscript=False):
+            print("System checks failed. Program exiting.\n")
+            sys.exit(1)
+        print("Passed.")
+        print("Planning...", end=" ")
+        plan = build_plan()
+
+        if args.plan == '-':
+            json.dump(plan, stdout, indent=1)
+            stdout.write('\n')
+        else:
+            write_json_atomically(args.plan, plan)
+        print("{0} reports from {1} PDFs ({2}), {3} PDFs without a "
+              "CoC.".format(len(plan['reports']),
+                            sum(len(r['pdfs'])
+                                for r in plan['reports'].values()),
+                            humanize_size(plan['bytes_in']),
+                            len(plan['unmatched_pdfs'])))
+
+
+def resume(args, state):
+    """Finish the interrupted run described by 'state' (from
+    `journal_state`), skipping every step the journal shows as done."""
+    if state is None:
+        print("The last run finished. Nothing to resume.")
+        return
+
+    open_journal(resume=True)
+    if state['plan'] is None:
+        # Stopped before any report was planned
+        print("The last run stopped before planning any reports. Run this "
+              "program again to start a new run.")
+        close_journal()
+        return
+
+    print("Resuming the last run: {0} of {1} reports already collated."
+          .format(len(state['collated']), len(state['plan']['collate'])))
+    execute(state['plan'], args, state=state)
+
+
+def execute(plan, args, snapshot=None, state=None):
+    """Collate, dispose of and bill the reports in 'plan', then print
+    the size table and close the run journal.
+
+    'plan' is a dictionary of:
+        'order' - every report name, in the order to print them;
+        'reports' - the report dictionary from `aggregator`;
+        'collate' - names of the reports to collate;
+        'skipped' - names of the reports the user chose to skip;
+        'deferred' - names of the reports queued for the next run;
+        'renames' - (optional) renames strip_chars deferred, as in
+                    PENDING_RENAMES.
+    'snapshot' - optional snapshot from `snapshot_directories`.
+    'state' - when resuming, the `journal_state` of the interrupted
+              run. Steps it shows as done are not repeated.
+    """
+    if state is None:
+        state = {'collated': {}, 'disposed': set(), 'billed': set()}
+    started = time.time()
+    report_dict = plan['reports']
+    results = {name: "Skipped" for name in plan['skipped']}
+    results.update({name: "Deferred" for name in plan.get('deferred', [])})
+    with _renames_lock:
+        for directory, names in plan.get('renames', {}).items():
+            PENDING_RENAMES.setdefault(directory, {}).update(names)
+
+    # Inputs are archived on a background thread, off the collation path,
+    # and reports are copied to billings on a small pool of their own
+    disposal = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    disposals = {}
+    billing = concurrent.futures.ThreadPoolExecutor(max_workers=BILLING_JOBS)
+    bills = []
+    manifest = load_billing_manifest()
+
+    def finish(report_name):
+        if report_name not in state['disposed']:
+            disposals[report_name] = disposal.submit(
+                dispose, report_dict[report_name], report_name)
+        if report_name not in state['billed']:
+            bills.append(billing.submit(bill, report_name, manifest))
+
+    to_collate = []
+    for report_name in plan['collate']:
+        if report_name in state['collated']:
+            # Collated before the run was interrupted
+            results[report_name] = state['collated'][report_name]
+            finish(report_name)
+        else:
+            to_collate.append((report_name, report_dict[report_name]))
+
+    # Create reports, disposing of inputs and billing each one as soon
+    # as its output exists
+    if args.spool:
+        collated = spool_reports(args.spool, to_collate, args.backend,
+                                 args.compression)
+    else:
+        collated = collate_reports(to_collate, args.jobs, args.backend,
+                                   snapshot, args.compression)
+    for report_name, dictionary, stats in collated:
+        results[report_name] = stats
+        finish(report_name)
+    close_ghostscript_sessions()
+    close_stager()
+
+    compaction = disposal.submit(compact_archive)
+    disposal.shutdown()
+    for report_name, future in disposals.items():
         try:
-            shutil.copy2(dictionary['coc'], os.path.expanduser('~/.Trash'))
-            os.remove(os.path.join(REVD_REPORTS, dictionary['coc']))
-        except OSError:
-            os.remove(os.path.join(REVD_REPORTS, dictionary['coc']))
+            future.result()
+        except OSError as e:
+            print("Could not archive the inputs of {0}: {1}".format(
+                report_name, e))
+    try:
+        compaction.result()
+    except OSError as e:
+        print("Could not compact the archive: {0}".format(e))
+    # PDFs left in the reviewed folder get their stripped names now
+    apply_renames(snapshot)
+
+    # report_stats = [<report name>, <collate stats>], in planning order
+    report_stats = [[name, results.get(name, "Failed")]
+                    for name in plan['order']]
 
     # Generate report
-    print("--------------------------------------------------------")
-    print("Report Name               File size             Reduced")
-    print("--------------------------------------------------------")
-    # report_stats = [<report name>, <start size>]
+    print("--------------------------------------------------------------"
+          "----------")
+    print("Report Name               File size             Reduced  Profile"
+          "      Time")
+    print("--------------------------------------------------------------"
+          "----------")
     for j in report_stats:
-        if j[1] == "Skipped":
+        if j[1] in ("Skipped", "Deferred", "Failed"):
             print("{0:<26} {1:15} {2:>12}".format(j[0], j[1], j[1]))
         else:
-            r = os.path.join(FIN_REPORTS, j[0])
-            end_size = total_file_size(r)
+            end_size = j[1]['bytes_out']
             human_size = humanize_size(end_size)
-            reduction = 100 - ((end_size * 100) / j[1])
-            print("{0:<26} {1:<15} {2:>11.2f}%".format(j[0], human_size,
-                                                        reduction))
+            reduction = (100 - ((end_size * 100) / j[1]['bytes_in'])
+                         if j[1]['bytes_in'] else 0.0)
+            print("{0:<26} {1:<15} {2:>11.2f}%  {3:<9} {4:>6.1f}s".format(
+                j[0], human_size, reduction, j[1].get('profile', 'default'),
+                j[1]['seconds']))
+    if CACHE_DIR:
+        print()
+        print("Output cache: {0} hits, {1} misses, {2} evicted.".format(
+            CACHE_STATS['hits'], CACHE_STATS['misses'],
+            CACHE_STATS['evictions']))
 
+    # Copy any other new or changed reports to billings directory
+    billing.shutdown()
+    billed = sum(future.result() for future in bills)
+    copied, unchanged, failed = sync_billings(manifest)
+    print()
+    print("Billings: {0} reports copied, {1} already up to date, {2} "
+          "failed.".format(billed + copied, unchanged - billed, failed))
 
-    # Copy reports to billings directory
-    for item in os.listdir(FIN_REPORTS):
-        try:
-            shutil.copy2(os.path.join(FIN_REPORTS, item), BILLINGS)
-        # Report already in Billings
-        except OSError:
-            print("There was a problem moving the report from {0} "
-                  "to {1}! Please double check the files are in the"
-                  " correct locations.".format(FIN_REPORTS, BILLINGS))
+    record_run([(name, report_dict.get(name), results.get(name, "Failed"))
+                for name in plan['order']], started, args.jobs,
+               'spool' if args.spool else 'local')
+    close_journal()
 
 
 if __name__ == '__main__':
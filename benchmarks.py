@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#---------------------------#
+#  PDF Collator benchmarks  #
+#---------------------------#
+
+# Times each stage of the collation pipeline against generated corpora of
+# CoCs and reviewed PDFs. Collation runs against a fake ghostscript, so
+# the numbers measure our own orchestration overhead rather than
+# rendering.
+#
+#    python3 benchmarks.py --sizes 1000 10000 --output bench.json
+#    python3 benchmarks.py --sizes 1000 10000 --baseline bench.json
+
+import sys
+import os
+import os.path
+import stat
+import json
+import time
+import random
+import argparse
+import platform
+from tempfile import TemporaryDirectory
+
+import PDF_collator
+
+# Stand-in for ghostscript: joins the input files into the output file.
+FAKE_GS = """#!/bin/sh
+out=''
+for arg in "$@"; do
+    case "$arg" in
+        -sOutputFile=*) out="${arg#-sOutputFile=}" ;;
+        -*) ;;
+        *) set -- "$@" "$arg" ;;
+    esac
+    shift
+done
+cat "$@" > "$out"
+"""
+
+# Small PDF-ish payload written into every generated file
+PAYLOAD = b'%PDF-1.4\n' + b'0' * 512
+
+STAGES = ['snapshot', 'name_check', 'strip_chars', 'index', 'aggregator',
+          'collate']
+
+
+def make_corpus(root, cocs, seed=0):
+    """Generate a corpus of 'cocs' CoCs and their PDFs under 'root'.
+
+    The mix roughly follows a month of real scans: mostly single CoCs,
+    ranges (some rolling over the 1000s), reruns, QC/WP/SP samples, a
+    few badly named CoCs, PDFs still carrying the scanner's 'job_#### '
+    prefix, and some PDFs that never turned up. Reviewed PDFs of rerun
+    samples are named after the sample number alone (a rerun of 123456a
+    is scanned as 123456pg1.pdf), as the naming scheme requires, so they
+    reach the aggregator. Badly named PDFs are kept to a small bucket of
+    their own.
+
+    Returns a dictionary of the directories created, keyed by the
+    PDF_collator global they stand in for.
+    """
+    rand = random.Random(seed)
+    dirs = {}
+    for name in ['REVD_REPORTS', 'AUS_COCS', 'CORP_COCS', 'PT_COCS',
+                 'FIN_REPORTS', 'BILLINGS']:
+        dirs[name] = os.path.join(root, name.lower())
+        os.mkdir(dirs[name])
+    coc_dirs = [dirs['AUS_COCS'], dirs['CORP_COCS'], dirs['PT_COCS']]
+
+    def touch(directory, name):
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(PAYLOAD)
+
+    def add_pdfs(sample):
+        # Reviewed PDFs never carry the rerun letter
+        sample = sample.rstrip('abcd')
+        for page in range(1, rand.randint(1, 3) + 1):
+            chance = rand.random()
+            if chance < 0.03:
+                continue    # Never scanned
+            elif chance < 0.33:
+                name = 'job_%d %spg%d.pdf' % (rand.randint(1, 9999), sample,
+                                               page)
+            else:
+                name = '%spg%d.pdf' % (sample, page)
+            touch(dirs['REVD_REPORTS'], name)
+
+    number = 100000
+    for i in range(cocs):
+        kind = rand.random()
+        if kind < 0.55:
+            # Single - 123456coc.pdf
+            samples = [str(number)]
+            name = '%dcoc.pdf' % number
+            number += 1
+        elif kind < 0.80:
+            # Range - 123456-460coc.pdf, or rerun range 123456a-460acoc.pdf
+            rerun = 'a' if kind >= 0.75 else ''
+            if rand.random() < 0.1:
+                # Roll over the 1000s - ...995-002
+                number += (995 - number % 1000) % 1000
+            length = rand.randint(2, 15)
+            last = number + length - 1
+            samples = ['%d%s' % (n, rerun) for n in range(number, last + 1)]
+            name = '%d%s-%03d%scoc.pdf' % (number, rerun, last % 1000, rerun)
+            number = last + 1
+        elif kind < 0.90:
+            # Single rerun - 123456acoc.pdf
+            samples = ['%d%s' % (number, rand.choice('abcd'))]
+            name = '%scoc.pdf' % samples[0]
+            number += 1
+        elif kind < 0.99:
+            # QC123-456coc.pdf
+            samples = ['%s%03d-%03d' % (rand.choice(['QC', 'WP', 'SP']),
+                                        i % 1000, rand.randint(0, 999))]
+            name = '%scoc.pdf' % samples[0]
+        else:
+            # Badly named CoC
+            samples = [str(number)]
+            name = '%dcoc .pdf' % number
+            number += 1
+
+        touch(rand.choice(coc_dirs), name)
+        for sample in samples:
+            add_pdfs(sample)
+
+    # Badly named PDFs: a trailing space, a rerun letter, a two digit page
+    for i in range(max(1, cocs // 100)):
+        sample = rand.randint(100000, number - 1)
+        name = rand.choice(['%dpg1.pdf ', '%dapg1.pdf', '%dpg10.pdf'])
+        touch(dirs['REVD_REPORTS'], name % sample)
+
+    return dirs
+
+
+def timed(stages, stage, function, *args, **kwargs):
+    """Call 'function', store its wall time in 'stages' and return its
+    result."""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    stages[stage] = time.perf_counter() - start
+    return result
+
+
+def run_benchmark(cocs, collate=50, jobs=1, seed=0):
+    """Generate a corpus of 'cocs' CoCs, then time each pipeline stage.
+
+    'collate' - the number of reports to collate with the fake
+                ghostscript (all of them if `None`).
+    'jobs' - the number of reports to collate at the same time.
+
+    Returns a dictionary of file counts and stage times in seconds.
+    """
+    with TemporaryDirectory() as root:
+        dirs = make_corpus(root, cocs, seed)
+        fake_gs = os.path.join(root, 'gs')
+        with open(fake_gs, 'w') as f:
+            f.write(FAKE_GS)
+        os.chmod(fake_gs, os.stat(fake_gs).st_mode | stat.S_IEXEC)
+
+        saved = {name: getattr(PDF_collator, name)
+                 for name in list(dirs) + ['GS_EXECUTABLE']}
+        for name, path in dirs.items():
+            setattr(PDF_collator, name, path)
+        PDF_collator.GS_EXECUTABLE = fake_gs
+        try:
+            stages = {}
+            coc_dirs = (dirs['AUS_COCS'], dirs['CORP_COCS'], dirs['PT_COCS'])
+            snapshot = timed(stages, 'snapshot',
+                             PDF_collator.snapshot_directories,
+                             dirs['REVD_REPORTS'], *coc_dirs)
+            bad_names, coc_list = timed(stages, 'name_check',
+                                        PDF_collator.name_check, *coc_dirs,
+                                        snapshot=snapshot)
+            good_pdfs, bad_pdfs = timed(stages, 'strip_chars',
+                                        PDF_collator.strip_chars,
+                                        dirs['REVD_REPORTS'], snapshot)
+
+            def index():
+                coc_tuple = tuple(set(PDF_collator.list_directory(d, snapshot))
+                                  for d in coc_dirs)
+                return (coc_tuple,
+                        PDF_collator.index_cocs(coc_list, coc_tuple),
+                        PDF_collator.index_ranges(coc_list, coc_tuple))
+            coc_tuple, coc_index, range_index = timed(stages, 'index', index)
+
+            missing_cocs, report_dict = timed(
+                stages, 'aggregator', PDF_collator.aggregator, coc_list,
+                coc_tuple, [], good_pdfs, None, coc_index, range_index)
+
+            reports = list(report_dict.items())[:collate]
+            timed(stages, 'collate', lambda: list(
+                PDF_collator.collate_reports(reports, jobs, 'gs', snapshot)))
+        finally:
+            for name, value in saved.items():
+                setattr(PDF_collator, name, value)
+
+    return {'cocs': cocs,
+            'counts': {'coc_files': len(coc_list),
+                       'bad_cocs': len(bad_names or []),
+                       'pdfs': len(good_pdfs),
+                       'bad_pdfs': len(bad_pdfs or []),
+                       'reports': len(report_dict),
+                       'missing_cocs': len(missing_cocs),
+                       'collated': len(reports)},
+            'stages': stages}
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Print each stage's time against a stored baseline.
+
+    Returns a list of (cocs, stage, ratio) tuples for stages that got
+    slower than the baseline by more than 'tolerance' (0.25 = 25%).
+    """
+    old = {r['cocs']: r['stages'] for r in baseline['results']}
+    regressions = []
+    print("{0:>8} {1:<12} {2:>10} {3:>10} {4:>8}".format(
+        'CoCs', 'Stage', 'Baseline', 'Now', 'Ratio'))
+    for result in results['results']:
+        if result['cocs'] not in old:
+            continue
+        for stage in STAGES:
+            before = old[result['cocs']].get(stage)
+            now = result['stages'].get(stage)
+            if not before or now is None:
+                continue
+            ratio = now / before
+            flag = ''
+            if ratio > 1 + tolerance:
+                regressions.append((result['cocs'], stage, ratio))
+                flag = ' *'
+            print("{0:>8} {1:<12} {2:>9.4f}s {3:>9.4f}s {4:>7.2f}x{5}".format(
+                result['cocs'], stage, before, now, ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the PDF '
+                                     'collator pipeline on generated corpora.')
+    parser.add_argument('-s', '--sizes', help='Corpus sizes, in CoCs '
+                        '(default: 1000 10000).', type=int, nargs='+',
+                        default=[1000, 10000])
+    parser.add_argument('-c', '--collate', help='Reports to collate with the '
+                        'fake ghostscript per corpus (default: 50).', type=int,
+                        default=50)
+    parser.add_argument('-j', '--jobs', help='Reports to collate at the same '
+                        'time (default: 1).', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='Write results to this JSON '
+                        'file.')
+    parser.add_argument('-b', '--baseline', help='Compare against results '
+                        'from an earlier --output file.')
+    parser.add_argument('-t', '--tolerance', help='Allowed slowdown against '
+                        'the baseline before failing (default: 0.25).',
+                        type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = {'python': platform.python_version(),
+               'platform': platform.platform(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'results': []}
+    for size in args.sizes:
+        print("Benchmarking {0} CoCs...".format(size), file=sys.stderr)
+        results['results'].append(run_benchmark(size, args.collate, args.jobs,
+                                                args.seed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,35 @@
 #!/usr/bin/env python3
 
 import unittest
+import unittest.mock
 import os
 import os.path
+import threading
+import time
+import stat
+import sys
+import errno
+import tarfile
+import collections
 from tempfile import TemporaryDirectory, TemporaryFile
 
 from PDF_collator import system_checks, file_check, name_check, strip_chars,\
-     get_ranges, total_file_size, find_coc, backcheck, aggregator, humanize_size
+     get_ranges, total_file_size, find_coc, backcheck, aggregator, humanize_size,\
+     index_cocs, index_ranges, find_range_coc, range_overlaps, collate_reports,\
+     collate, ps_string, GhostscriptSession, close_ghostscript_sessions,\
+     Watcher, snapshot_directories, file_stat, span, metrics_summary,\
+     start_profiling, stop_profiling, write_metrics, cache_key, cache_evict,\
+     open_journal, journal, close_journal, read_journal, journal_state, clean,\
+     dispose, resume, archive_file, compact_archive, bill, sync_billings,\
+     load_billing_manifest, choose_profile, plan_reports, load_queue,\
+     save_queue, load_config, coc_sources, coc_locator, submit_jobs,\
+     claim_job, reclaim_leases, run_worker, spool_reports, parse_name,\
+     index_pages, close_stager, physical_path, apply_renames, probe_paths,\
+     find_ghostscript, build_plan, load_plan, dry_run, record_run,\
+     history_stats, percentile, plan_run, execute
+import json
+import PDF_collator
+import benchmarks
 
 
 class SystemCheckTest(unittest.TestCase):
@@ -76,7 +99,8 @@ class NameChecks(unittest.TestCase):
                          '123456cpc.pdf', '123456coc', '.DS_Store',
                          '123500-500coc.pdf', '123456a-123460coc.pdf',
                          '123456-123460acoc.pdf', '123400-390coc.pdf',
-                         'QP123-345coc.pdf', 'WP123-34coc.pdf']
+                         'QP123-345coc.pdf', 'WP123-34coc.pdf',
+                         'QC123-456-789coc.pdf']
         self.coc_list = []
 
         self.tmpdir = TemporaryDirectory()
@@ -370,6 +394,1748 @@ class ChainCollection(unittest.TestCase):
             print("There was an error removing the temporary directory!")
 
 
+class ChainIndex(unittest.TestCase):
+    """Test the CoC index used by find_coc() against the old linear
+    prefix scan."""
+
+    def setUp(self):
+        self.A_set = ['555001coc.pdf', '555002-003coc.pdf', '555004acoc.pdf',
+                      '555005a-006acoc.pdf', '555004coc.pdf']
+        self.C_set = ['444100coc.pdf', '444101-102coc.pdf', '444103acoc.pdf',
+                      '444103ccoc.pdf']
+        self.P_set = ['QC123-456coc.pdf', 'WP123-456coc.pdf', 'WP123-456acoc.pdf']
+        self.coc_list = self.A_set + self.C_set + self.P_set
+        self.coc_tuple = (set(self.A_set), set(self.C_set), set(self.P_set))
+        self.dirs = ('/aus', '/corp', '/pt')
+
+    def linear_find(self, pdf_name):
+        for i in self.coc_list:
+            if i.startswith(pdf_name[:-7]):
+                for names, d in zip(self.coc_tuple[:2], self.dirs[:2]):
+                    if i in names:
+                        return os.path.join(d, i)
+                return os.path.join(self.dirs[2], i)
+        return None
+
+    def test_index_matches_linear_scan(self):
+        coc_index = index_cocs(self.coc_list, self.coc_tuple, self.dirs)
+        pdfs = ['555001pg1.pdf', '555002pg1.pdf', '555003pg1.pdf',
+                '555004pg1.pdf', '555004apg1.pdf', '555005apg2.pdf',
+                '444100pg3.pdf', '444103pg1.pdf', '444103cpg1.pdf',
+                '444109pg1.pdf', 'QC123-456pg1.pdf', 'WP123-456apg2.pdf',
+                'WP123-456pg1.pdf', 'SP123-456pg1.pdf']
+        for pdf in pdfs:
+            self.assertEqual(find_coc(self.coc_list, self.coc_tuple, pdf,
+                                      coc_index), self.linear_find(pdf))
+
+    def test_plain_coc_not_taken_as_rerun(self):
+        # The 'c' of 'coc' is not a rerun letter
+        coc_index = index_cocs(['123456coc.pdf'], ({'123456coc.pdf'},),
+                               ('/aus',))
+        self.assertEqual(coc_index, {'123456': '/aus/123456coc.pdf'})
+
+
+class RangeIndex(unittest.TestCase):
+    """Test the interval index built from range CoCs."""
+
+    def setUp(self):
+        self.coc_list = ['123990-010coc.pdf', '123456a-460acoc.pdf',
+                         '200100-110coc.pdf', '200105-120coc.pdf',
+                         '300000coc.pdf', 'QC123-456coc.pdf']
+        self.coc_tuple = (set(self.coc_list),)
+        self.range_index = index_ranges(self.coc_list, self.coc_tuple,
+                                        ('/aus',))
+
+    def test_find_inside_range(self):
+        # Middle of a range, across the 1000s rollover
+        self.assertEqual(find_range_coc(self.range_index, '124003'),
+                         '/aus/123990-010coc.pdf')
+        self.assertEqual(find_range_coc(self.range_index, '123458a'),
+                         '/aus/123456a-460acoc.pdf')
+        self.assertEqual(find_range_coc(self.range_index, '123458'), None)
+        self.assertEqual(find_range_coc(self.range_index, '124011'), None)
+        self.assertEqual(find_range_coc(self.range_index, '300000'), None)
+        self.assertEqual(find_range_coc(self.range_index, 'QC123-456'), None)
+        # Long range found behind a shorter, later-starting one
+        self.assertEqual(find_range_coc(self.range_index, '200103'),
+                         '/aus/200100-110coc.pdf')
+
+    def test_overlaps(self):
+        self.assertEqual(range_overlaps(self.range_index),
+                         [('/aus/200100-110coc.pdf', '/aus/200105-120coc.pdf',
+                           ['200105', '200106', '200107', '200108', '200109',
+                            '200110'])])
+
+    def test_aggregator_uses_range_index(self):
+        # First PDF of the range is missing
+        pdfs = ['123992pg1.pdf', '124010pg1.pdf']
+        missing, reports = aggregator(self.coc_list, self.coc_tuple, [], pdfs[:],
+                                      {}, index_cocs(self.coc_list,
+                                                     self.coc_tuple, ('/aus',)),
+                                      self.range_index)
+        self.assertEqual(missing, [])
+        self.assertEqual(reports['123990-010.pdf']['pdfs'], pdfs)
+        self.assertIn('123990', reports['123990-010.pdf']['missing_pdfs'])
+
+
+class ChainAggregation(unittest.TestCase):
+    """Test aggregator() matches PDFs to CoCs without recursion."""
+
+    def setUp(self):
+        self.coc_list = ['555001coc.pdf', '555002-003coc.pdf', '555004acoc.pdf',
+                         '555005a-006acoc.pdf', '444106-107coc.pdf',
+                         'QC123-456coc.pdf', 'WP123-456coc.pdf',
+                         'WP123-456acoc.pdf']
+        self.coc_tuple = (set(self.coc_list),)
+        self.coc_index = index_cocs(self.coc_list, self.coc_tuple, ('/aus',))
+        self.range_index = index_ranges(self.coc_list, self.coc_tuple,
+                                        ('/aus',))
+        self.pdfs = ['555001pg1.pdf', '555001pg2.pdf', '555002pg1.pdf',
+                     '555003pg1.pdf', '555004apg1.pdf', '555005apg1.pdf',
+                     '555006apg1.pdf', '555006apg2.pdf', '444106pg1.pdf',
+                     '444108pg1.pdf', 'QC123-456pg1.pdf', 'WP123-456pg1.pdf',
+                     'WP123-456apg1.pdf']
+
+    def aggregate(self, pdfs):
+        return aggregator(self.coc_list, self.coc_tuple, [], pdfs, None,
+                          self.coc_index, self.range_index)
+
+    def test_reports(self):
+        missing, reports = self.aggregate(self.pdfs)
+        self.assertEqual(missing, ['444108pg1.pdf'])
+        self.assertEqual(reports['555001.pdf'],
+                         {'coc': '/aus/555001coc.pdf',
+                          'pdfs': ['555001pg1.pdf', '555001pg2.pdf'],
+                          'missing_pdfs': None})
+        self.assertEqual(reports['555005a-006a.pdf']['pdfs'],
+                         ['555005apg1.pdf', '555006apg1.pdf', '555006apg2.pdf'])
+        self.assertEqual(reports['444106-107.pdf']['missing_pdfs'], ['444107'])
+        # Rerun PDFs sort first and find their own CoC
+        self.assertEqual(reports['WP123-456a.pdf']['pdfs'],
+                         ['WP123-456apg1.pdf'])
+        self.assertEqual(reports['WP123-456.pdf']['pdfs'],
+                         ['WP123-456pg1.pdf'])
+        # Input is left alone and no state is carried between calls
+        self.assertEqual(len(self.pdfs), 13)
+        self.assertEqual(len(self.aggregate(['555001pg1.pdf'])[1]), 1)
+
+    def test_coc_not_covering_pdf(self):
+        # Only a rerun CoC exists; used to recurse forever
+        missing, reports = self.aggregate(['555004pg1.pdf'])
+        self.assertEqual(missing, ['555004pg1.pdf'])
+        self.assertEqual(reports, {})
+        # Nor does it replace the report matched for the rerun
+        missing, reports = self.aggregate(['555004apg1.pdf', '555004pg1.pdf'])
+        self.assertEqual(missing, ['555004pg1.pdf'])
+        self.assertEqual(reports, {'555004a.pdf': {
+            'coc': '/aus/555004acoc.pdf', 'pdfs': ['555004apg1.pdf'],
+            'missing_pdfs': None}})
+
+    def test_large_backlog(self):
+        coc_list = ['%06dcoc.pdf' % n for n in range(100000, 105000)]
+        pdfs = ['%06dpg1.pdf' % n for n in range(100000, 105000)]
+        missing, reports = aggregator(coc_list, (set(coc_list),), [], pdfs)
+        self.assertEqual(missing, [])
+        self.assertEqual(len(reports), 5000)
+
+
+class ParallelCollation(unittest.TestCase):
+    """Test collate_reports() runs reports on a worker pool."""
+
+    def setUp(self):
+        self.reports = [('%d.pdf' % n, {'pdfs': [], 'coc': '', 'size': n})
+                        for n in range(8)]
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def fake_collate(self, report_name, dictionary, backend=None,
+                     snapshot=None, profile=None):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        return dictionary['size']
+
+    def test_jobs(self):
+        with unittest.mock.patch('PDF_collator.collate', self.fake_collate):
+            results = {name: size for name, d, size
+                       in collate_reports(self.reports, jobs=4)}
+        self.assertEqual(results, {name: d['size'] for name, d in self.reports})
+        self.assertEqual(self.most_running, 4)
+
+    def test_serial(self):
+        with unittest.mock.patch('PDF_collator.collate', self.fake_collate):
+            results = list(collate_reports(self.reports, jobs=1))
+        self.assertEqual(len(results), 8)
+        self.assertEqual(self.most_running, 1)
+
+
+class CollationBackends(unittest.TestCase):
+    """Test collate() dispatches to a backend and reports its stats."""
+
+    def setUp(self):
+        self.revd = TemporaryDirectory()
+        self.fin = TemporaryDirectory()
+        for name, size in [('123456pg1.pdf', 100), ('123456coc.pdf', 50)]:
+            with open(os.path.join(self.revd.name, name), 'wb') as f:
+                f.write(b'x' * size)
+        self.report = {'coc': os.path.join(self.revd.name, '123456coc.pdf'),
+                       'pdfs': ['123456pg1.pdf'], 'missing_pdfs': None}
+        self.calls = []
+        self.patches = [
+            unittest.mock.patch('PDF_collator.REVD_REPORTS', self.revd.name),
+            unittest.mock.patch('PDF_collator.FIN_REPORTS', self.fin.name),
+            unittest.mock.patch.dict('PDF_collator.COLLATION_BACKENDS',
+                                     {'half': self.half_backend})]
+        for patch in self.patches:
+            patch.start()
+
+    def half_backend(self, input_files, output_file, options=None):
+        self.calls.append(input_files)
+        self.options = options
+        with open(output_file, 'wb') as f:
+            f.write(b'x' * 75)
+
+    def test_stats(self):
+        stats = collate('123456.pdf', self.report, 'half')
+        self.assertEqual(self.calls, [[
+            os.path.join(self.revd.name, '123456pg1.pdf'), self.report['coc']]])
+        self.assertEqual(stats['backend'], 'half')
+        self.assertEqual(stats['bytes_in'], 150)
+        self.assertEqual(stats['bytes_out'], 75)
+        self.assertGreaterEqual(stats['seconds'], 0)
+
+    def test_per_report_backend(self):
+        self.report['backend'] = 'half'
+        self.assertEqual(collate('123456.pdf', self.report)['backend'], 'half')
+
+    def test_profiles(self):
+        stats = collate('123456.pdf', self.report, 'half')
+        self.assertEqual(stats['profile'], 'default')
+        self.assertEqual(self.options, PDF_collator.GS_OPTIONS)
+
+        stats = collate('123456.pdf', self.report, 'half', profile='fast')
+        self.assertEqual(stats['profile'], 'fast')
+        # The profile's rotation comes last, so it wins
+        rotation = [o for o in self.options if 'AutoRotatePages' in o]
+        self.assertEqual(rotation[-1], '-dAutoRotatePages=/None')
+
+        # 150 bytes over two pages is a small report
+        stats = collate('123456.pdf', self.report, 'half', profile='adaptive')
+        self.assertEqual(stats['profile'], 'fast')
+
+    def test_balloon_guard(self):
+        sizes = {'fast': 200, 'balanced': 120, 'default': 500}
+
+        def sized_backend(input_files, output_file, options):
+            profile = [name for name in PDF_collator.GS_PROFILES
+                       if options == PDF_collator.profile_options(name)][0]
+            with open(output_file, 'wb') as f:
+                f.write(b'x' * sizes[profile])
+
+        fallbacks = [('missing', 'fast'), ('sized', 'fast'),
+                     ('sized', 'balanced')]
+        with unittest.mock.patch.dict('PDF_collator.COLLATION_BACKENDS',
+                                      {'sized': sized_backend}),\
+                unittest.mock.patch('PDF_collator.BALLOON_FALLBACKS',
+                                    fallbacks):
+            stats = collate('123456.pdf', self.report, 'sized')
+            self.assertEqual((stats['profile'], stats['bytes_out'],
+                              stats['attempts']), ('balanced', 120, 3))
+            self.assertEqual(os.listdir(self.fin.name), ['123456.pdf'])
+
+            # Within the ratio, nothing is retried
+            with unittest.mock.patch('PDF_collator.BALLOON_RATIO', 4):
+                stats = collate('123456.pdf', self.report, 'sized')
+            self.assertEqual((stats['profile'], stats['attempts']),
+                             ('default', 1))
+
+    def test_choose_profile(self):
+        mib = 1024 ** 2
+        self.assertEqual(choose_profile(100 * 1024, 1), 'fast')
+        self.assertEqual(choose_profile(12 * mib, 4), 'balanced')
+        self.assertEqual(choose_profile(30 * mib, 60), 'fast')
+        self.assertEqual(choose_profile(4 * mib, 8), 'archival')
+
+    @unittest.skipIf(PDF_collator.pypdf is None, "pypdf is not installed")
+    def test_merge_backend(self):
+        paths = []
+        for n in range(2):
+            writer = PDF_collator.pypdf.PdfWriter()
+            writer.add_blank_page(72, 72)
+            paths.append(os.path.join(self.revd.name, '%d.pdf' % n))
+            with open(paths[-1], 'wb') as f:
+                writer.write(f)
+        output = os.path.join(self.fin.name, 'out.pdf')
+        PDF_collator.merge_backend(paths, output)
+        self.assertEqual(len(PDF_collator.pypdf.PdfReader(output).pages), 2)
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.revd.cleanup()
+        self.fin.cleanup()
+
+
+# Stand-in for ghostscript reading session jobs from stdin. Writes the
+# interpreter's pid and the inputs it was given to the output file.
+FAKE_GS = """#!{python}
+import os, re, sys
+inputs, output = [], None
+for line in sys.stdin:
+    m = re.match(r'<< /OutputFile \\((.*)\\) >> setpagedevice', line)
+    if m and m.group(1) != os.devnull:
+        inputs, output = [], m.group(1)
+    m = re.match(r'\\((.*)\\) run', line)
+    if m:
+        inputs.append(m.group(1))
+    if line.startswith('collator_failed'):
+        with open(output, 'w') as f:
+            f.write(' '.join([str(os.getpid())] + inputs))
+        print('%%[collator: done]%%', flush=True)
+"""
+
+
+class GhostscriptSessions(unittest.TestCase):
+    """Test that a ghostscript session runs several jobs in one
+    interpreter."""
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        fake_gs = os.path.join(self.tmpdir.name, 'gs')
+        with open(fake_gs, 'w') as f:
+            f.write(FAKE_GS.format(python=sys.executable))
+        os.chmod(fake_gs, os.stat(fake_gs).st_mode | stat.S_IEXEC)
+        self.patch = unittest.mock.patch('PDF_collator.GS_EXECUTABLE', fake_gs)
+        self.patch.start()
+
+    def test_ps_string(self):
+        self.assertEqual(ps_string('/a (b)\\c.pdf'), '(/a \\(b\\)\\\\c.pdf)')
+        self.assertEqual(ps_string('\xe9'), '(\\303\\251)')
+
+    def test_one_interpreter_for_many_jobs(self):
+        outputs = []
+        for n in range(3):
+            outputs.append(os.path.join(self.tmpdir.name, '%d.pdf' % n))
+            PDF_collator.ghostscript_session_backend(['/in/a.pdf', '/in/b.pdf'],
+                                                     outputs[-1])
+        contents = []
+        for output in outputs:
+            with open(output) as f:
+                contents.append(f.read().split())
+        self.assertEqual(contents[0][1:], ['/in/a.pdf', '/in/b.pdf'])
+        self.assertEqual(len({c[0] for c in contents}), 1)
+
+    def test_dead_session(self):
+        session = GhostscriptSession()
+        session.close()
+        self.assertFalse(session.alive())
+        self.assertFalse(session.collate(['/in/a.pdf'], os.devnull))
+
+    def test_safer(self):
+        with unittest.mock.patch('PDF_collator.REVD_REPORTS', '/revd'), \
+             unittest.mock.patch('PDF_collator.FIN_REPORTS', '/fin'), \
+             unittest.mock.patch('PDF_collator.COC_SOURCES', {'aus': '/aus'}), \
+             unittest.mock.patch('PDF_collator.STAGE_DIR', ''):
+            session = GhostscriptSession()
+        command = session.process.args
+        session.close()
+        self.assertIn('-dSAFER', command)
+        self.assertNotIn('-dNOSAFER', command)
+        self.assertIn('--permit-file-read=/revd/*', command)
+        self.assertIn('--permit-file-read=/aus/*', command)
+        self.assertIn('--permit-file-write=/fin/*', command)
+        self.assertNotIn('--permit-file-write=/revd/*', command)
+
+    def test_failed_session_restarted(self):
+        # The first interpreter dies; the retry runs in a fresh one
+        marker = os.path.join(self.tmpdir.name, 'died')
+        with open(PDF_collator.GS_EXECUTABLE, 'w') as f:
+            f.write(FAKE_GS.format(python=sys.executable).replace(
+                'import os, re, sys\n',
+                'import os, re, sys\nif not os.path.exists(%r):\n'
+                '    open(%r, "w").close()\n    sys.exit(1)\n'
+                % (marker, marker), 1))
+        output = os.path.join(self.tmpdir.name, 'out.pdf')
+        PDF_collator.ghostscript_session_backend(['/in/a.pdf'], output)
+        with open(output) as f:
+            self.assertEqual(f.read().split()[1:], ['/in/a.pdf'])
+
+        # Interpreters that always die fail the report
+        with open(PDF_collator.GS_EXECUTABLE, 'w') as f:
+            f.write('#!/bin/sh\nexit 1\n')
+        close_ghostscript_sessions()
+        with self.assertRaises(RuntimeError):
+            PDF_collator.ghostscript_session_backend(['/in/a.pdf'], output)
+
+    def test_failed_report_left_out(self):
+        def failing_backend(input_files, output_file, options=None):
+            with open(output_file, 'w') as f:
+                f.write('half a report')
+            raise RuntimeError("ghostscript could not collate")
+        coc = os.path.join(self.tmpdir.name, '123456coc.pdf')
+        open(coc, 'w').close()
+        fin = os.path.join(self.tmpdir.name, 'fin')
+        os.mkdir(fin)
+        with unittest.mock.patch('PDF_collator.FIN_REPORTS', fin), \
+             unittest.mock.patch.dict('PDF_collator.COLLATION_BACKENDS',
+                                      {'failing': failing_backend}), \
+             unittest.mock.patch('sys.stdout'):
+            done = list(collate_reports(
+                [('123456.pdf', {'coc': coc, 'pdfs': [],
+                                 'missing_pdfs': None})], backend='failing'))
+        self.assertEqual(done, [])
+        self.assertEqual(os.listdir(fin), [])
+
+    def tearDown(self):
+        close_ghostscript_sessions()
+        self.patch.stop()
+        self.tmpdir.cleanup()
+
+
+class WatchMode(unittest.TestCase):
+    """Test the Watcher collates reports once they are complete."""
+
+    def setUp(self):
+        self.dirs = [TemporaryDirectory() for i in range(6)]
+        self.revd, self.fin, self.bills, self.aus, self.corp, self.home = \
+            [d.name for d in self.dirs]
+        self.disposed = []
+        self.patches = [
+            unittest.mock.patch('PDF_collator.REVD_REPORTS', self.revd),
+            unittest.mock.patch('PDF_collator.FIN_REPORTS', self.fin),
+            unittest.mock.patch('PDF_collator.BILLINGS', self.bills),
+            unittest.mock.patch('PDF_collator.BILLING_MANIFEST',
+                                os.path.join(self.home, 'billed.json')),
+            unittest.mock.patch('PDF_collator.HISTORY_DB',
+                                os.path.join(self.home, 'history.sqlite')),
+            unittest.mock.patch('PDF_collator.ARCHIVE',
+                                os.path.join(self.home, 'archive')),
+            unittest.mock.patch('PDF_collator.inotify_simple', None),
+            unittest.mock.patch('PDF_collator.PENDING_RENAMES', {}),
+            unittest.mock.patch('PDF_collator.dispose', self.dispose),
+            unittest.mock.patch.dict('PDF_collator.COLLATION_BACKENDS',
+                                     {'copy': self.copy_backend})]
+        for patch in self.patches:
+            patch.start()
+        self.watcher = Watcher((self.aus, self.corp), grace=30, jobs=2,
+                               backend='copy')
+
+    def copy_backend(self, input_files, output_file, options=None):
+        with open(output_file, 'w') as f:
+            f.write(' '.join(os.path.basename(i) for i in input_files))
+
+    def dispose(self, dictionary):
+        self.disposed.append(dictionary)
+        for f in dictionary['pdfs']:
+            os.remove(PDF_collator.physical_path(self.revd, f))
+        PDF_collator.forget_renames(self.revd, dictionary['pdfs'])
+        os.remove(dictionary['coc'])
+
+    def touch(self, directory, name):
+        open(os.path.join(directory, name), 'w').close()
+
+    def test_collate_when_complete(self):
+        self.touch(self.aus, '123456-457coc.pdf')
+        self.touch(self.corp, '200000coc.pdf')
+        self.touch(self.revd, 'job_12 123456pg1.pdf')
+        self.touch(self.revd, '200000pg1.pdf')
+        self.assertEqual(self.watcher.step(now=100), [])
+        # Queued under the stripped name, without renaming the file
+        self.assertIn('123456pg1.pdf', self.watcher.pdfs)
+        self.assertIn('job_12 123456pg1.pdf', os.listdir(self.revd))
+        self.assertEqual(PDF_collator.PENDING_RENAMES, {
+            self.revd: {'123456pg1.pdf': 'job_12 123456pg1.pdf'}})
+
+        # Complete, but still inside the grace window
+        self.assertEqual(self.watcher.step(now=120), [])
+        done = self.watcher.step(now=130)
+        self.assertEqual([name for name, stats in done], ['200000.pdf'])
+        self.assertEqual(os.listdir(self.bills), ['200000.pdf'])
+
+        # Missing PDF arrives; the grace window starts again
+        self.touch(self.revd, '123457pg1.pdf')
+        self.assertEqual(self.watcher.step(now=140), [])
+        done = self.watcher.step(now=170)
+        self.assertEqual([name for name, stats in done], ['123456-457.pdf'])
+        with open(os.path.join(self.fin, '123456-457.pdf')) as f:
+            # Read from where the PDF is still stored
+            self.assertEqual(f.read(), 'job_12 123456pg1.pdf 123457pg1.pdf '
+                             '123456-457coc.pdf')
+        self.assertEqual(self.watcher.pdfs, set())
+        self.assertEqual(len(self.disposed), 2)
+        # Disposed CoCs drop out of the indexes on the next scan
+        self.watcher.scan(now=180)
+        self.assertEqual(self.watcher.cocs, {})
+        self.assertEqual(self.watcher.coc_index, {})
+
+    def test_incremental_match(self):
+        self.touch(self.aus, '123456-458coc.pdf')
+        self.touch(self.corp, '200000coc.pdf')
+        for name in ['123456pg1.pdf', '123457pg1.pdf', '200000pg1.pdf']:
+            self.touch(self.revd, name)
+        self.watcher.step(now=0)
+        self.assertEqual(self.watcher.reports['123456-458.pdf']['missing_pdfs'],
+                         ['123458'])
+
+        # Only the PDFs around the changed sample key are matched again
+        self.touch(self.revd, '123458pg1.pdf')
+        with unittest.mock.patch('PDF_collator.aggregator',
+                                 wraps=PDF_collator.aggregator) as aggregator:
+            self.watcher.step(now=10)
+        stack = aggregator.call_args[0][3]
+        self.assertEqual(sorted(stack),
+                         ['123456pg1.pdf', '123457pg1.pdf', '123458pg1.pdf'])
+        self.assertIsNone(self.watcher.reports['123456-458.pdf']['missing_pdfs'])
+
+        # A range CoC that disappears leaves the index, and its PDFs
+        # are left without a report
+        os.remove(os.path.join(self.aus, '123456-458coc.pdf'))
+        self.touch(self.corp, '123457-458coc.pdf')
+        self.watcher.step(now=20)
+        self.assertEqual([i[3] for i in self.watcher.range_index['']],
+                         [os.path.join(self.corp, '123457-458coc.pdf')])
+        self.assertNotIn('123456-458.pdf', self.watcher.reports)
+        self.assertEqual(self.watcher.reports['123457-458.pdf']['pdfs'],
+                         ['123457pg1.pdf', '123458pg1.pdf'])
+
+    def test_concurrent_bills_recorded(self):
+        names = ['%dcoc.pdf' % n for n in range(200000, 200040)]
+        for name in names:
+            self.touch(self.corp, name)
+            self.touch(self.revd, name.replace('coc', 'pg1'))
+        self.watcher.step(now=0)
+        with unittest.mock.patch('sys.stdout'):
+            done = self.watcher.step(now=100)
+        self.assertEqual(len(done), 40)
+        self.assertEqual(sorted(load_billing_manifest()),
+                         sorted(name.replace('coc', '') for name in names))
+
+    def test_dispose_errors_reported(self):
+        self.touch(self.corp, '200000coc.pdf')
+        self.touch(self.corp, '200001coc.pdf')
+        self.touch(self.revd, '200000pg1.pdf')
+        self.touch(self.revd, '200001pg1.pdf')
+        self.watcher.step(now=0)
+        with unittest.mock.patch('PDF_collator.dispose',
+                                 side_effect=OSError('disk full')), \
+             unittest.mock.patch('sys.stdout') as stdout:
+            done = self.watcher.step(now=100)
+        self.assertEqual(sorted(name for name, stats in done),
+                         ['200000.pdf', '200001.pdf'])
+        printed = ''.join(c[0][0] for c in stdout.write.call_args_list)
+        self.assertIn("Could not archive the inputs of 200001.pdf", printed)
+        self.assertEqual(sorted(os.listdir(self.bills)),
+                         ['200000.pdf', '200001.pdf'])
+
+    def test_scan_errors_survived(self):
+        self.watcher.poll = 0
+        failures = [OSError('mount went away'), KeyboardInterrupt()]
+        with unittest.mock.patch('PDF_collator.snapshot_directories',
+                                 side_effect=failures) as snapshot, \
+             unittest.mock.patch('sys.stdout') as stdout:
+            self.watcher.run()
+        self.assertEqual(snapshot.call_count, 2)
+        printed = ''.join(c[0][0] for c in stdout.write.call_args_list)
+        self.assertIn("Watching failed: mount went away", printed)
+
+    def test_compact_on_timer(self):
+        with unittest.mock.patch('PDF_collator.compact_archive') as compact:
+            for now in [0, 10, PDF_collator.COMPACT_INTERVAL + 1]:
+                self.watcher.step(now=now)
+                # Let the disposal thread finish the compaction
+                self.watcher.disposal.submit(lambda: None).result()
+        self.assertEqual(compact.call_count, 2)
+
+    def test_bad_names_ignored(self):
+        self.touch(self.aus, '12345coc.pdf')
+        self.touch(self.revd, '123456pg10.pdf')
+        self.watcher.step(now=0)
+        self.assertEqual(self.watcher.pdfs, set())
+        self.assertEqual(self.watcher.cocs, {})
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        for d in self.dirs:
+            d.cleanup()
+
+
+class DirectorySnapshot(unittest.TestCase):
+    """Test that stages read from one directory snapshot."""
+
+    def setUp(self):
+        self.revd = TemporaryDirectory()
+        self.cocs = TemporaryDirectory()
+        for name in ['job_12 123456pg1.pdf', '123457pg1.pdf', '.DS_Store']:
+            with open(os.path.join(self.revd.name, name), 'w') as f:
+                f.write('12345')
+        open(os.path.join(self.cocs.name, '123456-457coc.pdf'), 'w').close()
+        self.snapshot = snapshot_directories(self.revd.name, self.cocs.name,
+                                             self.revd.name + '/')
+
+    def test_listing(self):
+        self.assertEqual(len(self.snapshot), 2)
+        self.assertTrue(file_check(self.revd.name, self.snapshot))
+        bad, coc_list = name_check(self.cocs.name, snapshot=self.snapshot)
+        self.assertEqual((bad, coc_list), (None, ['123456-457coc.pdf']))
+
+    def test_stages_use_snapshot(self):
+        with unittest.mock.patch('os.listdir') as listdir, \
+             unittest.mock.patch('os.path.exists') as exists:
+            good, bad = strip_chars(self.revd.name, self.snapshot)
+            paths = [os.path.join(self.revd.name, f) for f in good]
+            self.assertEqual(total_file_size(paths, self.snapshot), 10)
+            listdir.assert_not_called()
+            exists.assert_not_called()
+        self.assertEqual(set(good), {'123456pg1.pdf', '123457pg1.pdf'})
+        self.assertEqual(set(os.listdir(self.revd.name)),
+                         {'123456pg1.pdf', '123457pg1.pdf', '.DS_Store'})
+
+    def test_stat_cached(self):
+        path = os.path.join(self.revd.name, '123457pg1.pdf')
+        first = file_stat(path, self.snapshot)
+        os.remove(path)
+        self.assertIs(file_stat(path, self.snapshot), first)
+        # Files the snapshot doesn't list don't exist
+        self.assertEqual(total_file_size(
+            os.path.join(self.revd.name, 'new.pdf'), self.snapshot), False)
+
+    def tearDown(self):
+        self.revd.cleanup()
+        self.cocs.cleanup()
+
+
+class BenchmarkHarness(unittest.TestCase):
+    """Test the benchmark harness on a tiny corpus."""
+
+    def test_run_benchmark(self):
+        result = benchmarks.run_benchmark(100, collate=5, jobs=2)
+        self.assertEqual(set(result['stages']), set(benchmarks.STAGES))
+        self.assertEqual(result['counts']['coc_files'], 100)
+        self.assertEqual(result['counts']['collated'], 5)
+        # Globals are put back afterwards
+        self.assertEqual(PDF_collator.GS_EXECUTABLE, 'gs')
+
+    def test_fake_ghostscript(self):
+        with TemporaryDirectory() as root:
+            fake_gs = os.path.join(root, 'gs')
+            with open(fake_gs, 'w') as f:
+                f.write(benchmarks.FAKE_GS)
+            os.chmod(fake_gs, os.stat(fake_gs).st_mode | stat.S_IEXEC)
+            inputs = []
+            for n in range(2):
+                inputs.append(os.path.join(root, '%d.pdf' % n))
+                with open(inputs[-1], 'w') as f:
+                    f.write(str(n))
+            output = os.path.join(root, 'out.pdf')
+            with unittest.mock.patch('PDF_collator.GS_EXECUTABLE', fake_gs):
+                PDF_collator.ghostscript_backend(inputs, output)
+            with open(output) as f:
+                self.assertEqual(f.read(), '01')
+
+    def test_failing_ghostscript(self):
+        with TemporaryDirectory() as root:
+            fake_gs = os.path.join(root, 'gs')
+            with open(fake_gs, 'w') as f:
+                f.write('#!/bin/sh\nfor arg in "$@"; do case "$arg" in\n'
+                        '-sOutputFile=*) echo partial > "${arg#*=}" ;;\n'
+                        'esac; done\nexit 1\n')
+            os.chmod(fake_gs, os.stat(fake_gs).st_mode | stat.S_IEXEC)
+            coc = os.path.join(root, '123456coc.pdf')
+            with open(coc, 'w') as f:
+                f.write('coc')
+            fin = os.path.join(root, 'fin')
+            os.mkdir(fin)
+            with unittest.mock.patch('PDF_collator.GS_EXECUTABLE', fake_gs), \
+                 unittest.mock.patch('PDF_collator.GS_OPTIONS', []), \
+                 unittest.mock.patch('PDF_collator.FIN_REPORTS', fin):
+                with self.assertRaises(RuntimeError):
+                    PDF_collator.ghostscript_backend(
+                        [coc], os.path.join(root, 'out.pdf'))
+                # The report is left out, and its partial output removed
+                with unittest.mock.patch('sys.stdout'):
+                    done = list(collate_reports(
+                        [('123456.pdf', {'coc': coc, 'pdfs': [],
+                                         'missing_pdfs': None})]))
+            self.assertEqual(done, [])
+            self.assertEqual(os.listdir(fin), [])
+
+    def test_compare(self):
+        baseline = {'results': [{'cocs': 10, 'stages': {'aggregator': 1.0,
+                                                        'collate': 1.0}}]}
+        results = {'results': [{'cocs': 10, 'stages': {'aggregator': 1.1,
+                                                       'collate': 2.0}}]}
+        with unittest.mock.patch('sys.stdout'):
+            regressions = benchmarks.compare(results, baseline, 0.25)
+        self.assertEqual(regressions, [(10, 'collate', 2.0)])
+
+
+class RunMetrics(unittest.TestCase):
+    """Test timed spans, profiling and the metrics file."""
+
+    def setUp(self):
+        self.patch = unittest.mock.patch('PDF_collator.METRICS', [])
+        self.metrics = self.patch.start()
+
+    def test_span(self):
+        with span('name_check', cocs=3) as record:
+            record['bad_names'] = 1
+        with self.assertRaises(ValueError):
+            with span('collate', report='1.pdf', bytes_in=100):
+                raise ValueError
+        self.assertEqual([r['stage'] for r in self.metrics],
+                         ['name_check', 'collate'])
+        self.assertEqual(self.metrics[0]['cocs'], 3)
+        self.assertEqual(self.metrics[0]['bad_names'], 1)
+        self.assertGreaterEqual(self.metrics[1]['seconds'], 0)
+
+    def test_bounded(self):
+        self.patch.stop()
+        self.patch = unittest.mock.patch('PDF_collator.METRICS',
+                                         collections.deque(maxlen=3))
+        self.metrics = self.patch.start()
+        for n in range(5):
+            with span('collate', report='%d.pdf' % n):
+                pass
+        self.assertEqual([r['report'] for r in self.metrics],
+                         ['2.pdf', '3.pdf', '4.pdf'])
+
+    def test_summary(self):
+        records = [{'stage': 'collate', 'start': 1, 'seconds': 1.0,
+                    'bytes_in': 10, 'report': 'a.pdf'},
+                   {'stage': 'collate', 'start': 2, 'seconds': 2.0,
+                    'bytes_in': 5, 'report': 'b.pdf'}]
+        self.assertEqual(metrics_summary(records),
+                         {'collate': {'count': 2, 'seconds': 3.0,
+                                      'bytes_in': 15}})
+
+    def test_metrics_file(self):
+        profiler = start_profiling()
+        with span('aggregator'):
+            sorted(range(1000))
+        profile = stop_profiling(profiler, limit=5)
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'metrics.json')
+            write_metrics(path, profile)
+            with open(path) as f:
+                metrics = json.load(f)
+        self.assertEqual(metrics['stages']['aggregator']['count'], 1)
+        self.assertLessEqual(len(metrics['profile']['functions']), 5)
+        self.assertIn('peak_bytes', metrics['profile']['memory'])
+
+    def tearDown(self):
+        self.patch.stop()
+
+
+class OutputCache(unittest.TestCase):
+    """Test collate() reuses cached reports for unchanged inputs."""
+
+    def setUp(self):
+        self.dirs = [TemporaryDirectory() for i in range(3)]
+        self.revd, self.fin, self.cache = [d.name for d in self.dirs]
+        for name in ['123456pg1.pdf', '123456coc.pdf']:
+            with open(os.path.join(self.revd, name), 'w') as f:
+                f.write(name)
+        self.report = {'coc': os.path.join(self.revd, '123456coc.pdf'),
+                       'pdfs': ['123456pg1.pdf'], 'missing_pdfs': None}
+        self.calls = 0
+        self.patches = [
+            unittest.mock.patch('PDF_collator.REVD_REPORTS', self.revd),
+            unittest.mock.patch('PDF_collator.FIN_REPORTS', self.fin),
+            unittest.mock.patch('PDF_collator.CACHE_DIR', self.cache),
+            unittest.mock.patch.dict('PDF_collator.CACHE_STATS',
+                                     {'hits': 0, 'misses': 0, 'evictions': 0}),
+            unittest.mock.patch.dict('PDF_collator.COLLATION_BACKENDS',
+                                     {'copy': self.copy_backend})]
+        for patch in self.patches:
+            patch.start()
+
+    def copy_backend(self, input_files, output_file, options=None):
+        self.calls += 1
+        with open(output_file, 'w') as f:
+            f.write('collated %d' % self.calls)
+
+    def test_hit_and_miss(self):
+        self.assertFalse(collate('123456.pdf', self.report, 'copy')['cached'])
+        os.remove(os.path.join(self.fin, '123456.pdf'))
+        stats = collate('123456.pdf', self.report, 'copy')
+        self.assertTrue(stats['cached'])
+        self.assertEqual(self.calls, 1)
+        with open(os.path.join(self.fin, '123456.pdf')) as f:
+            self.assertEqual(f.read(), 'collated 1')
+        self.assertEqual(PDF_collator.CACHE_STATS['hits'], 1)
+        self.assertEqual(PDF_collator.CACHE_STATS['misses'], 1)
+
+        # A changed input misses
+        with open(os.path.join(self.revd, '123456pg1.pdf'), 'w') as f:
+            f.write('rescanned page')
+        self.assertFalse(collate('123456.pdf', self.report, 'copy')['cached'])
+
+    def test_key(self):
+        paths = [os.path.join(self.revd, '123456pg1.pdf'), self.report['coc']]
+        key = cache_key(paths, {'backend': 'gs'})
+        self.assertNotEqual(key, cache_key(paths[::-1], {'backend': 'gs'}))
+        self.assertNotEqual(key, cache_key(paths, {'backend': 'merge'}))
+        self.assertEqual(cache_key(paths + ['/missing.pdf'], {}), None)
+        # Content keys survive a touch
+        hashed = cache_key(paths, {}, content_hash=True)
+        os.utime(paths[0], (1, 1))
+        self.assertEqual(hashed, cache_key(paths, {}, content_hash=True))
+        self.assertNotEqual(key, cache_key(paths, {'backend': 'gs'}))
+
+    def test_prefixed_copies_hit(self):
+        # The same page scanned in again under new scanner prefixes, and
+        # after its deferred rename was applied
+        page = os.path.join(self.revd, '123456pg1.pdf')
+        with unittest.mock.patch('PDF_collator.CACHE_HASH', True):
+            for stored in ['job_1 123456pg1.pdf', 'job_2 123456pg1.pdf',
+                           '123456pg1.pdf']:
+                os.replace(page, os.path.join(self.revd, stored))
+                page = os.path.join(self.revd, stored)
+                report = dict(self.report, stored={'123456pg1.pdf': stored})
+                collate('123456.pdf', report, 'copy')
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(PDF_collator.CACHE_STATS['hits'], 2)
+
+    def test_lru_eviction(self):
+        for n in range(4):
+            path = os.path.join(self.cache, '%d.pdf' % n)
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+            os.utime(path, (n, n))
+        # '0.pdf' was used most recently
+        os.utime(os.path.join(self.cache, '0.pdf'), (10, 10))
+        self.assertEqual(cache_evict(250), 2)
+        self.assertEqual(sorted(os.listdir(self.cache)), ['0.pdf', '3.pdf'])
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        for d in self.dirs:
+            d.cleanup()
+
+
+class RunJournal(unittest.TestCase):
+    """Test interrupted runs can be resumed or rolled back from the journal."""
+
+    def setUp(self):
+        self.dirs = [TemporaryDirectory() for i in range(5)]
+        self.revd, self.fin, self.trash, self.billings, self.home = \
+            [d.name for d in self.dirs]
+        for name in ['job_12 123456pg1.pdf', '123457pg1.pdf', '123456coc.pdf',
+                     '123457coc.pdf']:
+            with open(os.path.join(self.revd, name), 'w') as f:
+                f.write(name)
+        self.reports = {
+            name + '.pdf': {'coc': os.path.join(self.revd, name + 'coc.pdf'),
+                            'pdfs': [name + 'pg1.pdf'], 'missing_pdfs': None}
+            for name in ['123456', '123457']}
+        self.collated = []
+        self.patches = [
+            unittest.mock.patch('PDF_collator.REVD_REPORTS', self.revd),
+            unittest.mock.patch('PDF_collator.FIN_REPORTS', self.fin),
+            unittest.mock.patch('PDF_collator.BILLINGS', self.billings),
+            unittest.mock.patch('PDF_collator.ARCHIVE', self.trash),
+            unittest.mock.patch('PDF_collator.JOURNAL',
+                                os.path.join(self.home, 'journal')),
+            unittest.mock.patch('PDF_collator.BILLING_MANIFEST',
+                                os.path.join(self.home, 'billed.json')),
+            unittest.mock.patch('PDF_collator.HISTORY_DB',
+                                os.path.join(self.home, 'history.sqlite')),
+            unittest.mock.patch.dict('PDF_collator.COLLATION_BACKENDS',
+                                     {'copy': self.copy_backend})]
+        for patch in self.patches:
+            patch.start()
+
+    def copy_backend(self, input_files, output_file, options=None):
+        self.collated.append(os.path.basename(output_file))
+        with open(output_file, 'w') as f:
+            f.write('collated')
+
+    def test_clean(self):
+        open_journal()
+        strip_chars(self.revd)
+        partial = os.path.join(self.fin, '123456.pdf')
+        journal('collate', status='start', report='123456.pdf', output=partial)
+        with open(partial, 'w') as f:
+            f.write('half a rep')
+        # Crash half way through disposing of 123457.pdf
+        source = os.path.join(self.revd, '123457pg1.pdf')
+        moves = [[source, os.path.join(self.trash, '123457pg1.pdf')]]
+        journal('dispose', status='start', report='123457.pdf', moves=moves)
+        os.rename(*moves[0])
+        PDF_collator._journal.close()
+        PDF_collator._journal = None
+
+        self.assertEqual(clean(), {'reports': 1, 'restored': 1, 'renamed': 1})
+        self.assertEqual(os.listdir(self.fin), [])
+        self.assertEqual(sorted(os.listdir(self.revd)),
+                         ['123456coc.pdf', '123457coc.pdf', '123457pg1.pdf',
+                          'job_12 123456pg1.pdf'])
+        self.assertEqual(journal_state(read_journal()), None)
+        self.assertEqual(clean(), None)
+
+    def test_resume(self):
+        open_journal()
+        plan = {'order': ['123456.pdf', '123457.pdf'], 'reports': self.reports,
+                'collate': ['123456.pdf', '123457.pdf'], 'skipped': []}
+        journal('plan', plan=plan)
+        with open(os.path.join(self.fin, '123456.pdf'), 'w') as f:
+            f.write('collated')
+        journal('collate', status='done', report='123456.pdf',
+                stats={'backend': 'copy', 'bytes_in': 26, 'bytes_out': 8,
+                       'seconds': 0.1, 'cached': False})
+        # Killed before disposing of or billing 123456.pdf
+        PDF_collator._journal.close()
+        PDF_collator._journal = None
+
+        state = journal_state(read_journal())
+        self.assertEqual(list(state['collated']), ['123456.pdf'])
+        args = unittest.mock.Mock(jobs=1, backend='copy',
+                                  compression='default', spool=None)
+        with unittest.mock.patch('sys.stdout'):
+            resume(args, state)
+        self.assertEqual(self.collated, ['123457.pdf'])
+        self.assertEqual(os.listdir(self.revd), ['job_12 123456pg1.pdf'])
+        self.assertEqual(sorted(os.listdir(self.billings)),
+                         ['123456.pdf', '123457.pdf'])
+        self.assertEqual(journal_state(read_journal()), None)
+
+    def test_execute_missing_input(self):
+        # Planned with --plan, then a PDF was removed before --execute
+        os.remove(os.path.join(self.revd, '123457pg1.pdf'))
+        plan = {'order': ['123456.pdf', '123457.pdf'], 'reports': self.reports,
+                'collate': ['123456.pdf', '123457.pdf'], 'skipped': [],
+                'renames': {self.revd: {'123456pg1.pdf':
+                                        'job_12 123456pg1.pdf'}}}
+        args = unittest.mock.Mock(jobs=1, backend='copy',
+                                  compression='default', spool=None)
+        open_journal()
+        with unittest.mock.patch('PDF_collator.PENDING_RENAMES', {}), \
+             unittest.mock.patch('sys.stdout') as stdout:
+            execute(plan, args)
+        printed = ''.join(c[0][0] for c in stdout.write.call_args_list)
+        self.assertIn("Could not collate 123457.pdf", printed)
+        self.assertEqual(self.collated, ['123456.pdf'])
+        # The failed report's CoC stays put, and the run finishes
+        self.assertEqual(os.listdir(self.revd), ['123457coc.pdf'])
+        self.assertEqual(os.listdir(self.billings), ['123456.pdf'])
+        self.assertEqual(journal_state(read_journal()), None)
+
+    def test_torn_record(self):
+        with open(PDF_collator.JOURNAL, 'w') as f:
+            f.write('{"step": "start", "time": 1}\n{"step": "pl')
+        self.assertEqual(read_journal(), [{'step': 'start', 'time': 1}])
+        self.assertEqual(journal_state(read_journal())['plan'], None)
+
+    def tearDown(self):
+        close_journal()
+        for patch in self.patches:
+            patch.stop()
+        for d in self.dirs:
+            d.cleanup()
+
+
+class DisposalArchive(unittest.TestCase):
+    """Test inputs are renamed into the archive and compacted into tars."""
+
+    def setUp(self):
+        self.dirs = [TemporaryDirectory() for i in range(2)]
+        self.revd, self.archive = [d.name for d in self.dirs]
+        for name in ['123456pg1.pdf', '123456pg2.pdf', '123456coc.pdf']:
+            with open(os.path.join(self.revd, name), 'w') as f:
+                f.write(name)
+        self.patches = [
+            unittest.mock.patch('PDF_collator.REVD_REPORTS', self.revd),
+            unittest.mock.patch('PDF_collator.ARCHIVE', self.archive)]
+        for patch in self.patches:
+            patch.start()
+
+    def test_dispose(self):
+        dispose({'coc': os.path.join(self.revd, '123456coc.pdf'),
+                 'pdfs': ['123456pg1.pdf', '123456pg2.pdf'],
+                 'missing_pdfs': None})
+        self.assertEqual(os.listdir(self.revd), [])
+        day = os.path.join(self.archive, time.strftime('%Y-%m-%d'))
+        self.assertEqual(sorted(os.listdir(day)),
+                         ['123456coc.pdf', '123456pg1.pdf', '123456pg2.pdf'])
+
+    def test_cross_device(self):
+        source = os.path.join(self.revd, '123456pg1.pdf')
+        destination = os.path.join(self.archive, '123456pg1.pdf')
+        error = OSError(errno.EXDEV, 'Invalid cross-device link')
+        with unittest.mock.patch('os.replace', side_effect=error):
+            archive_file(source, destination)
+        self.assertFalse(os.path.exists(source))
+        with open(destination) as f:
+            self.assertEqual(f.read(), '123456pg1.pdf')
+
+    def test_compact(self):
+        for day in ['2020-01-01', '2020-01-02', '2020-01-03']:
+            os.mkdir(os.path.join(self.archive, day))
+            with open(os.path.join(self.archive, day, 'a.pdf'), 'w') as f:
+                f.write(day)
+        self.assertEqual(len(compact_archive('2020-01-02')), 1)
+        # Late arrivals are added to the existing bundle
+        os.mkdir(os.path.join(self.archive, '2020-01-01'))
+        with open(os.path.join(self.archive, '2020-01-01', 'b.pdf'), 'w') as f:
+            f.write('late')
+        self.assertEqual(len(compact_archive('2020-01-03')), 2)
+
+        self.assertEqual(sorted(os.listdir(self.archive)),
+                         ['2020-01-01.tar', '2020-01-02.tar', '2020-01-03'])
+        with tarfile.open(os.path.join(self.archive, '2020-01-01.tar')) as tar:
+            self.assertEqual(tar.getnames(),
+                             ['2020-01-01/a.pdf', '2020-01-01/b.pdf'])
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        for d in self.dirs:
+            d.cleanup()
+
+
+class BillingSync(unittest.TestCase):
+    """Test only new or changed reports are copied to billings."""
+
+    def setUp(self):
+        self.dirs = [TemporaryDirectory() for i in range(3)]
+        self.fin, self.bills, self.home = [d.name for d in self.dirs]
+        for name in ['100000.pdf', '100001.pdf']:
+            self.write(name, name)
+        self.patches = [
+            unittest.mock.patch('PDF_collator.FIN_REPORTS', self.fin),
+            unittest.mock.patch('PDF_collator.BILLINGS', self.bills),
+            unittest.mock.patch('PDF_collator.BILLING_MANIFEST',
+                                os.path.join(self.home, 'billed.json'))]
+        for patch in self.patches:
+            patch.start()
+
+    def write(self, name, text, mtime=1000000000):
+        path = os.path.join(self.fin, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        os.utime(path, (mtime, mtime))
+
+    def test_sync(self):
+        self.assertTrue(bill('100000.pdf'))
+        self.assertEqual(list(load_billing_manifest()), ['100000.pdf'])
+        self.assertEqual(sync_billings(jobs=2), (1, 1, 0))
+        self.assertEqual(sync_billings(), (0, 2, 0))
+
+        # Touched but unchanged reports are not copied again
+        self.write('100000.pdf', '100000.pdf', mtime=1100000000)
+        # Changed and deleted reports are
+        self.write('100001.pdf', 'collated again')
+        os.remove(os.path.join(self.bills, '100000.pdf'))
+        self.assertEqual(sync_billings(), (2, 0, 0))
+        with open(os.path.join(self.bills, '100001.pdf')) as f:
+            self.assertEqual(f.read(), 'collated again')
+
+        os.utime(os.path.join(self.fin, '100000.pdf'), (5, 5))
+        self.assertEqual(sync_billings(), (0, 2, 0))
+        self.assertEqual(load_billing_manifest()['100000.pdf']['mtime'],
+                         5 * 10 ** 9)
+        self.assertEqual(sorted(os.listdir(self.bills)),
+                         ['100000.pdf', '100001.pdf'])
+
+    def test_failed_copy(self):
+        with unittest.mock.patch('PDF_collator.BILLINGS',
+                                 os.path.join(self.home, 'unmounted')),\
+                unittest.mock.patch('sys.stdout'):
+            self.assertFalse(bill('100000.pdf'))
+        self.assertEqual(load_billing_manifest(), {})
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        for d in self.dirs:
+            d.cleanup()
+
+
+class BatchPolicies(unittest.TestCase):
+    """Test reports are planned from policies instead of prompts."""
+
+    def setUp(self):
+        self.home = TemporaryDirectory()
+        self.reports = {
+            '100000.pdf': {'coc': '100000coc.pdf', 'pdfs': ['100000pg1.pdf'],
+                           'missing_pdfs': None},
+            '100001.pdf': {'coc': '100001-003coc.pdf',
+                           'pdfs': ['100001pg1.pdf', '100003pg1.pdf'],
+                           'missing_pdfs': ['100002']}}
+        self.names = sorted(self.reports)
+        self.patches = [
+            unittest.mock.patch('PDF_collator.QUEUE_FILE',
+                                os.path.join(self.home.name, 'queue.json')),
+            unittest.mock.patch('sys.stdout')]
+        for patch in self.patches:
+            patch.start()
+
+    def test_policies(self):
+        with unittest.mock.patch('builtins.input') as answer:
+            plan = plan_reports(self.names, self.reports, 'defer')
+            self.assertEqual((plan['collate'], plan['deferred']),
+                             (['100000.pdf'], ['100001.pdf']))
+            plan = plan_reports(self.names, self.reports, 'skip')
+            self.assertEqual(plan['skipped'], ['100001.pdf'])
+            plan = plan_reports(self.names, self.reports, 'partial')
+            self.assertEqual(plan['collate'], self.names)
+            self.assertFalse(answer.called)
+
+        with unittest.mock.patch('builtins.input', side_effect=['maybe', 'y']):
+            plan = plan_reports(self.names, self.reports)
+        self.assertEqual(plan['skipped'], ['100001.pdf'])
+
+    def test_platform(self):
+        with unittest.mock.patch('os.uname') as uname,\
+                unittest.mock.patch('builtins.input') as answer:
+            uname.return_value.sysname = 'Linux'
+            self.assertFalse(system_checks('abort'))
+            self.assertFalse(answer.called)
+            answer.return_value = 'n'
+            self.assertFalse(system_checks('prompt'))
+            self.assertEqual(answer.call_count, 1)
+
+    def test_queue(self):
+        self.assertEqual(load_queue(), {'reports': {}, 'pdfs': {}})
+        first = save_queue(['100001.pdf'], ['100009pg1.pdf'])
+        queue = load_queue()
+        self.assertEqual(queue, first)
+        # Reports still deferred keep the time they were first deferred
+        with unittest.mock.patch('time.time', return_value=2e9):
+            second = save_queue(['100001.pdf', '100004.pdf'], [], queue)
+        self.assertEqual(second['reports']['100001.pdf'],
+                         first['reports']['100001.pdf'])
+        self.assertEqual(second['reports']['100004.pdf'], 2e9)
+        self.assertEqual(load_queue()['pdfs'], {})
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.home.cleanup()
+
+
+class CocSources(unittest.TestCase):
+    """Test CoC sources are read from the config file and looked up by
+    name."""
+
+    CONFIG = """
+[paths]
+fin_reports = /data/final
+billings = /admin/billings
+
+[coc:austin]
+root = /scans/austin
+
+[coc:corpus]
+root = /scans/corpus
+
+[coc:houston]
+root = /scans/houston
+
+[coc:pt]
+root = /scans/pt
+"""
+
+    def setUp(self):
+        self.home = TemporaryDirectory()
+        self.config = os.path.join(self.home.name, 'collator.ini')
+        with open(self.config, 'w') as f:
+            f.write(self.CONFIG)
+        self.patches = [unittest.mock.patch('PDF_collator.' + name, value)
+                        for name, value in [('COC_SOURCES', {}),
+                                            ('FIN_REPORTS', ''),
+                                            ('REVD_REPORTS', '/data/revd'),
+                                            ('BILLINGS', ''),
+                                            ('AUS_COCS', '/aus')]]
+        for patch in self.patches:
+            patch.start()
+
+    def test_load_config(self):
+        self.assertEqual(coc_sources()['aus'], '/aus')
+        load_config(self.config)
+        self.assertEqual(list(coc_sources().items()),
+                         [('austin', '/scans/austin'),
+                          ('corpus', '/scans/corpus'),
+                          ('houston', '/scans/houston'), ('pt', '/scans/pt')])
+        self.assertEqual(PDF_collator.FIN_REPORTS, '/data/final')
+        self.assertEqual(PDF_collator.BILLINGS, '/admin/billings')
+        # Not in the file, so unchanged
+        self.assertEqual(PDF_collator.REVD_REPORTS, '/data/revd')
+
+    def test_bad_config(self):
+        with self.assertRaises(ValueError):
+            load_config(os.path.join(self.home.name, 'missing.ini'))
+        with open(self.config, 'a') as f:
+            f.write('[coc:empty]\n')
+        with self.assertRaises(ValueError):
+            load_config(self.config)
+
+    def test_lookup(self):
+        load_config(self.config)
+        coc_tuple = ({'100000coc.pdf'}, {'200000coc.pdf'}, {'300000coc.pdf'},
+                     {'QC123-456coc.pdf', '100000coc.pdf'})
+        locate = coc_locator(coc_tuple)
+        self.assertEqual(locate('300000coc.pdf'), '/scans/houston/300000coc.pdf')
+        self.assertEqual(locate('QC123-456coc.pdf'),
+                         '/scans/pt/QC123-456coc.pdf')
+        # First source wins, and unknown names aren't guessed
+        self.assertEqual(locate('100000coc.pdf'), '/scans/austin/100000coc.pdf')
+        self.assertEqual(locate('400000coc.pdf'), None)
+        self.assertEqual(index_cocs(['300000coc.pdf', '400000coc.pdf'],
+                                    coc_tuple),
+                         {'300000': '/scans/houston/300000coc.pdf'})
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.home.cleanup()
+
+
+class SpoolWorkers(unittest.TestCase):
+    """Test reports are collated by workers through a spool directory."""
+
+    def setUp(self):
+        self.dirs = [TemporaryDirectory() for i in range(3)]
+        self.revd, self.fin, self.spool = [d.name for d in self.dirs]
+        self.reports = []
+        for sample in ['100000', '100001', '100002']:
+            for name in [sample + 'pg1.pdf', sample + 'coc.pdf']:
+                with open(os.path.join(self.revd, name), 'w') as f:
+                    f.write(name)
+            self.reports.append((sample + '.pdf', {
+                'coc': os.path.join(self.revd, sample + 'coc.pdf'),
+                'pdfs': [sample + 'pg1.pdf'], 'missing_pdfs': None}))
+        self.patches = [
+            unittest.mock.patch('PDF_collator.REVD_REPORTS', self.revd),
+            unittest.mock.patch('PDF_collator.FIN_REPORTS', self.fin),
+            unittest.mock.patch('PDF_collator.SPOOL_POLL', 0.01),
+            unittest.mock.patch('sys.stdout'),
+            unittest.mock.patch.dict('PDF_collator.COLLATION_BACKENDS',
+                                     {'copy': self.copy_backend})]
+        for patch in self.patches:
+            patch.start()
+
+    def copy_backend(self, input_files, output_file, options=None):
+        if input_files[0].endswith('100002pg1.pdf'):
+            raise OSError('gs crashed')
+        with open(output_file, 'w') as f:
+            f.write('collated')
+
+    def test_claims(self):
+        submit_jobs(self.spool, self.reports[:2], 'copy')
+        first = claim_job(self.spool, 'a')
+        second = claim_job(self.spool, 'b')
+        self.assertEqual(os.path.basename(first), 'a@100000.pdf.json')
+        self.assertEqual(os.path.basename(second), 'b@100001.pdf.json')
+        self.assertEqual(claim_job(self.spool, 'c'), None)
+
+        # Worker 'a' crashed; its lease runs out
+        os.utime(first, (1, 1))
+        self.assertEqual(reclaim_leases(self.spool), ['100000.pdf.json'])
+        self.assertEqual(os.path.basename(claim_job(self.spool, 'c')),
+                         'c@100000.pdf.json')
+
+    def test_workers(self):
+        done = []
+        planner = threading.Thread(target=lambda: done.extend(
+            spool_reports(self.spool, self.reports, 'copy')))
+        planner.start()
+        jobs = os.path.join(self.spool, 'jobs')
+        while not (os.path.isdir(jobs) and len(os.listdir(jobs)) == 3):
+            time.sleep(0.01)
+
+        workers = [threading.Thread(target=run_worker,
+                                    args=(self.spool, True, 'w%d' % n))
+                   for n in range(2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers + [planner]:
+            worker.join()
+
+        # The failed report is left out
+        self.assertEqual(sorted(name for name, dictionary, stats in done),
+                         ['100000.pdf', '100001.pdf'])
+        self.assertEqual(sorted(os.listdir(self.fin)),
+                         ['100000.pdf', '100001.pdf'])
+        for sub in ['jobs', 'leases', 'results']:
+            self.assertEqual(os.listdir(os.path.join(self.spool, sub)), [])
+
+    def test_stored_names(self):
+        os.rename(os.path.join(self.revd, '100000pg1.pdf'),
+                  os.path.join(self.revd, 'job_7 100000pg1.pdf'))
+        with unittest.mock.patch('PDF_collator.PENDING_RENAMES', {
+                self.revd: {'100000pg1.pdf': 'job_7 100000pg1.pdf'}}):
+            submit_jobs(self.spool, self.reports[:1], 'copy')
+        calls = []
+        record = lambda input_files, output_file, options=None: \
+            calls.append(input_files)
+        # A worker is another process: it has none of the planner's renames
+        pending = {}
+        with unittest.mock.patch('PDF_collator.PENDING_RENAMES', pending), \
+             unittest.mock.patch.dict('PDF_collator.COLLATION_BACKENDS',
+                                      {'copy': record}):
+            run_worker(self.spool, True, 'w')
+        self.assertEqual(calls[0][0],
+                         os.path.join(self.revd, 'job_7 100000pg1.pdf'))
+        self.assertEqual(pending, {})
+
+    def test_journaled(self):
+        journal_file = os.path.join(self.spool, 'journal')
+        with unittest.mock.patch('PDF_collator.JOURNAL', journal_file):
+            open_journal()
+            try:
+                planner = threading.Thread(target=lambda: list(
+                    spool_reports(self.spool, self.reports, 'copy')))
+                planner.start()
+                jobs = os.path.join(self.spool, 'jobs')
+                while not (os.path.isdir(jobs) and len(os.listdir(jobs)) == 3):
+                    time.sleep(0.01)
+                run_worker(self.spool, True, 'w')
+                planner.join()
+            finally:
+                close_journal()
+            records = read_journal()[:-1]    # As if the planner crashed
+        state = journal_state(records)
+        self.assertEqual(sorted(state['collating']),
+                         ['100000.pdf', '100001.pdf', '100002.pdf'])
+        self.assertEqual(sorted(state['collated']),
+                         ['100000.pdf', '100001.pdf'])
+
+    def test_no_workers(self):
+        with unittest.mock.patch('PDF_collator.SPOOL_TIMEOUT', 0.05):
+            self.assertEqual(list(spool_reports(self.spool, self.reports,
+                                                'copy')), [])
+        # Unclaimed jobs are withdrawn
+        self.assertEqual(os.listdir(os.path.join(self.spool, 'jobs')), [])
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        for d in self.dirs:
+            d.cleanup()
+
+
+class NameRecords(unittest.TestCase):
+    """Test CoC and PDF names are parsed once into records."""
+
+    def test_coc_records(self):
+        record = parse_name('123456a-460acoc.pdf')
+        self.assertEqual((record.sample, record.rerun, record.key,
+                          record.last, record.page, record.valid),
+                         ('123456', 'a', '123456a', 123460, None, True))
+        # 1000s rollover
+        self.assertEqual(parse_name('123995-002coc.pdf').last, 124002)
+        record = parse_name('QC123-456coc.pdf')
+        self.assertEqual((record.prefix, record.key, record.last),
+                         ('QC', 'QC123-456', None))
+        self.assertIsNone(parse_name('123456coc .pdf'))
+        self.assertIsNone(parse_name('notes.txt'))
+        # QC/WP/SP samples can't be ranges
+        for name in ['QC123-456-789coc.pdf', 'WP123-456-460coc.pdf']:
+            record = parse_name(name)
+            self.assertEqual((record.valid, record.last), (False, None))
+
+    def test_pdf_records(self):
+        record = parse_name('123456pg2.pdf')
+        self.assertEqual((record.key, record.page, record.valid),
+                         ('123456', 2, True))
+        # Reruns are parsed, but aren't valid reviewed PDF names
+        record = parse_name('123456apg1.pdf')
+        self.assertEqual((record.key, record.page, record.valid),
+                         ('123456a', 1, False))
+        self.assertFalse(parse_name('QC123-456-789pg1.pdf').valid)
+
+    def test_parsed_once(self):
+        self.assertIs(parse_name('654321coc.pdf'), parse_name('654321coc.pdf'))
+
+    def test_index_pages(self):
+        pages = index_pages(['123456pg1.pdf', '123456apg1.pdf',
+                             '123456pg2.pdf', 'QC123-456pg1.pdf'])
+        self.assertEqual(pages, {'123456': ['123456pg1.pdf', '123456pg2.pdf'],
+                                 '123456a': ['123456apg1.pdf'],
+                                 'QC123-456': ['QC123-456pg1.pdf']})
+        required, missing = backcheck('123456-457coc.pdf', [], pages)
+        self.assertEqual(missing, ['123457'])
+
+
+class LocalStaging(unittest.TestCase):
+    """Test reports are collated from local copies of their inputs and
+    moved into FIN_REPORTS."""
+
+    def setUp(self):
+        self.dirs = [TemporaryDirectory() for i in range(3)]
+        self.revd, self.fin, self.stage = [d.name for d in self.dirs]
+        self.reports = []
+        for n in range(6):
+            sample = '12345%d' % n
+            for name in [sample + 'pg1.pdf', sample + 'coc.pdf']:
+                with open(os.path.join(self.revd, name), 'wb') as f:
+                    f.write(name.encode())
+            self.reports.append((sample + '.pdf', {
+                'coc': os.path.join(self.revd, sample + 'coc.pdf'),
+                'pdfs': [sample + 'pg1.pdf'], 'missing_pdfs': None}))
+        self.calls = []
+        self.patches = [
+            unittest.mock.patch('PDF_collator.REVD_REPORTS', self.revd),
+            unittest.mock.patch('PDF_collator.FIN_REPORTS', self.fin),
+            unittest.mock.patch('PDF_collator.STAGE_DIR', self.stage),
+            unittest.mock.patch('PDF_collator.BALLOON_RATIO', 0),
+            unittest.mock.patch.dict('PDF_collator.COLLATION_BACKENDS',
+                                     {'join': self.join_backend})]
+        for patch in self.patches:
+            patch.start()
+
+    def join_backend(self, input_files, output_file, options=None):
+        self.calls.append((input_files, output_file))
+        with open(output_file, 'wb') as out:
+            for path in input_files:
+                with open(path, 'rb') as f:
+                    out.write(f.read())
+
+    def test_collates_locally(self):
+        stats = collate('123450.pdf', self.reports[0][1], 'join')
+        [(inputs, output)] = self.calls
+        for path in inputs + [output]:
+            self.assertTrue(path.startswith(self.stage))
+        # Copies keep the report order, CoC last
+        self.assertEqual([os.path.basename(p) for p in inputs],
+                         ['000-123450pg1.pdf', '001-123450coc.pdf'])
+        with open(os.path.join(self.fin, '123450.pdf'), 'rb') as f:
+            self.assertEqual(f.read(), b'123450pg1.pdf123450coc.pdf')
+        self.assertEqual(stats['bytes_out'], 26)
+        close_stager()
+        self.assertEqual(os.listdir(self.stage), [])
+
+    def test_prefetch(self):
+        results = list(collate_reports(self.reports, jobs=2, backend='join'))
+        self.assertEqual(len(results), 6)
+        self.assertEqual(sorted(os.listdir(self.fin)),
+                         sorted(name for name, d in self.reports))
+        # Copies are removed as soon as each report is done
+        [root] = os.listdir(self.stage)
+        self.assertEqual(os.listdir(os.path.join(self.stage, root)), [])
+
+    def test_no_output(self):
+        nothing = lambda input_files, output_file, options=None: None
+        with unittest.mock.patch.dict('PDF_collator.COLLATION_BACKENDS',
+                                      {'nothing': nothing}):
+            stats = collate('123450.pdf', self.reports[0][1], 'nothing')
+        self.assertEqual(stats['bytes_out'], 0)
+        self.assertEqual(os.listdir(self.fin), [])
+
+    def test_unstageable_collates_in_place(self):
+        with unittest.mock.patch('PDF_collator.stage_files',
+                                 side_effect=OSError('No space left')):
+            collate('123450.pdf', self.reports[0][1], 'join')
+        [(inputs, output)] = self.calls
+        self.assertEqual(inputs[0], os.path.join(self.revd, '123450pg1.pdf'))
+        self.assertEqual(output, os.path.join(self.fin, '123450.pdf'))
+
+    def tearDown(self):
+        close_stager()
+        for patch in self.patches:
+            patch.stop()
+        for d in self.dirs:
+            d.cleanup()
+
+
+class DeferredRenames(unittest.TestCase):
+    """Test strip_chars can leave files alone and the run works on the
+    stripped names."""
+
+    def setUp(self):
+        self.dirs = [TemporaryDirectory() for i in range(4)]
+        self.revd, self.fin, self.archive, self.cocs = [d.name
+                                                        for d in self.dirs]
+        self.stored = ['job_2055 123456pg1.pdf', 'job_2056 123456pg2.pdf',
+                       'job_12 654321pg1.pdf', '123457pg1.pdf']
+        for name in self.stored:
+            with open(os.path.join(self.revd, name), 'w') as f:
+                f.write(name)
+        self.coc = os.path.join(self.cocs, '123456coc.pdf')
+        open(self.coc, 'w').close()
+        self.calls = []
+        self.patches = [
+            unittest.mock.patch('PDF_collator.REVD_REPORTS', self.revd),
+            unittest.mock.patch('PDF_collator.FIN_REPORTS', self.fin),
+            unittest.mock.patch('PDF_collator.ARCHIVE', self.archive),
+            unittest.mock.patch('PDF_collator.PENDING_RENAMES', {}),
+            unittest.mock.patch.dict('PDF_collator.COLLATION_BACKENDS',
+                                     {'record': self.record_backend})]
+        for patch in self.patches:
+            patch.start()
+
+    def record_backend(self, input_files, output_file, options=None):
+        self.calls.append(input_files)
+        with open(output_file, 'w') as f:
+            f.write('report')
+
+    def test_nothing_renamed(self):
+        good, bad = strip_chars(self.revd, defer=True)
+        self.assertIsNone(bad)
+        self.assertEqual(sorted(good), ['123456pg1.pdf', '123456pg2.pdf',
+                                        '123457pg1.pdf', '654321pg1.pdf'])
+        self.assertEqual(sorted(os.listdir(self.revd)), sorted(self.stored))
+        self.assertEqual(physical_path(self.revd, '123456pg1.pdf'),
+                         os.path.join(self.revd, 'job_2055 123456pg1.pdf'))
+        self.assertEqual(physical_path(self.revd, '123457pg1.pdf'),
+                         os.path.join(self.revd, '123457pg1.pdf'))
+
+    def test_collate_and_archive(self):
+        strip_chars(self.revd, defer=True)
+        report = {'coc': self.coc,
+                  'pdfs': ['123456pg1.pdf', '123456pg2.pdf'],
+                  'missing_pdfs': None}
+        collate('123456.pdf', report, 'record')
+        self.assertEqual(self.calls, [[
+            os.path.join(self.revd, 'job_2055 123456pg1.pdf'),
+            os.path.join(self.revd, 'job_2056 123456pg2.pdf'),
+            report['coc']]])
+
+        dispose(report)
+        day = os.path.join(self.archive, time.strftime('%Y-%m-%d'))
+        self.assertEqual(sorted(os.listdir(day)),
+                         ['123456coc.pdf', '123456pg1.pdf', '123456pg2.pdf'])
+        # Only the PDF left behind is renamed, once, at the end
+        self.assertEqual(apply_renames(), 1)
+        self.assertEqual(sorted(os.listdir(self.revd)),
+                         ['123457pg1.pdf', '654321pg1.pdf'])
+        self.assertEqual(apply_renames(), 0)
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        for d in self.dirs:
+            d.cleanup()
+
+
+class SystemProbes(unittest.TestCase):
+    """Test system checks probe concurrently, time out and are cached."""
+
+    def setUp(self):
+        self.dirs = [TemporaryDirectory() for i in range(2)]
+        self.home, self.bin = [d.name for d in self.dirs]
+        self.gs = os.path.join(self.bin, 'gs')
+        with open(self.gs, 'w') as f:
+            f.write('#!/bin/sh\necho 10.02.1\n')
+        os.chmod(self.gs, os.stat(self.gs).st_mode | stat.S_IEXEC)
+        self.patches = [
+            unittest.mock.patch('PDF_collator.CHECK_CACHE',
+                                os.path.join(self.home, 'checks.json')),
+            unittest.mock.patch('PDF_collator.GS_EXECUTABLE', self.gs),
+            unittest.mock.patch('PDF_collator.CHECK_TIMEOUT', 0.2)]
+        for patch in self.patches:
+            patch.start()
+
+    def test_probe_timeout(self):
+        stale = threading.Event()
+        exists = os.path.exists
+
+        def hanging_exists(path):
+            if path == '/stale':
+                stale.wait(5)
+            return exists(path)
+
+        start = time.monotonic()
+        with unittest.mock.patch('os.path.exists', hanging_exists):
+            found = probe_paths([self.home, '/stale', '/nonexistent'])
+        stale.set()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(found, {self.home: True, '/stale': None,
+                                 '/nonexistent': False})
+
+    def test_find_ghostscript(self):
+        gs = find_ghostscript()
+        self.assertEqual((gs['path'], gs['version']), (self.gs, '10.02.1'))
+        with unittest.mock.patch('PDF_collator.GS_EXECUTABLE',
+                                 os.path.join(self.bin, 'missing')):
+            self.assertIsNone(find_ghostscript())
+
+    def test_cached(self):
+        found = lambda paths: dict.fromkeys(paths, True)
+        with unittest.mock.patch('PDF_collator.probe_paths',
+                                 side_effect=found) as probe, \
+             unittest.mock.patch('PDF_collator.find_ghostscript',
+                                 wraps=find_ghostscript) as find:
+            self.assertTrue(system_checks('continue'))
+            self.assertTrue(probe.call_args[0][0])
+            self.assertTrue(system_checks('continue'))
+            self.assertEqual(probe.call_args[0][0], [])
+            self.assertEqual(find.call_count, 1)
+            # Expired results are checked again
+            with unittest.mock.patch('PDF_collator.CHECK_TTL', 0):
+                self.assertTrue(system_checks('continue'))
+            self.assertEqual(find.call_count, 2)
+
+    def test_failures_not_cached(self):
+        with unittest.mock.patch('os.path.exists', return_value=False):
+            self.assertFalse(system_checks('continue'))
+        with open(os.path.join(self.home, 'checks.json')) as f:
+            self.assertEqual(json.load(f), {'paths': {}, 'gs': None})
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        for d in self.dirs:
+            d.cleanup()
+
+
+class DryRunPlan(unittest.TestCase):
+    """Test --plan matches reports without changing anything."""
+
+    def setUp(self):
+        self.dirs = [TemporaryDirectory() for i in range(4)]
+        self.revd, self.aus, self.corp, self.pt = [d.name for d in self.dirs]
+        self.stored = ['job_12 123456pg1.pdf', '123457pg1.pdf',
+                       '999999pg1.pdf', 'notes.pdf']
+        for name in self.stored:
+            with open(os.path.join(self.revd, name), 'wb') as f:
+                f.write(b'x' * 100)
+        self.coc = os.path.join(self.aus, '123456-458coc.pdf')
+        with open(self.coc, 'wb') as f:
+            f.write(b'x' * 50)
+        self.patches = [
+            unittest.mock.patch('PDF_collator.REVD_REPORTS', self.revd),
+            unittest.mock.patch('PDF_collator.AUS_COCS', self.aus),
+            unittest.mock.patch('PDF_collator.CORP_COCS', self.corp),
+            unittest.mock.patch('PDF_collator.PT_COCS', self.pt),
+            unittest.mock.patch('PDF_collator.COC_SOURCES', {}),
+            unittest.mock.patch('PDF_collator.PENDING_RENAMES', {}),
+            # Nothing may be renamed or run
+            unittest.mock.patch('os.rename', side_effect=AssertionError),
+            unittest.mock.patch('subprocess.Popen', side_effect=AssertionError)]
+        for patch in self.patches:
+            patch.start()
+
+    def test_plan(self):
+        plan = build_plan()
+        self.assertEqual(plan['reports'], {'123456-458.pdf': {
+            'coc': self.coc, 'pdfs': ['123456pg1.pdf', '123457pg1.pdf'],
+            'missing_pdfs': ['123458'], 'bytes_in': 250}})
+        self.assertEqual(plan['unmatched_pdfs'], ['999999pg1.pdf'])
+        self.assertEqual(plan['bad_pdfs'], ['notes.pdf'])
+        self.assertEqual(plan['renames'], {
+            self.revd: {'123456pg1.pdf': 'job_12 123456pg1.pdf'}})
+        self.assertEqual(plan['bytes_in'], 250)
+        self.assertEqual(sorted(os.listdir(self.revd)), sorted(self.stored))
+        json.dumps(plan)
+
+    def test_write_and_load(self):
+        path = os.path.join(self.aus, 'plan.json')
+        args = unittest.mock.Mock(plan=path, platform='continue')
+        with unittest.mock.patch('PDF_collator.system_checks',
+                                 return_value=True), \
+             unittest.mock.patch('sys.stdout'):
+            dry_run(args)
+        self.assertEqual(list(load_plan(path)['reports']), ['123456-458.pdf'])
+        # Renamed since planning: looked for under the stripped name
+        os.replace(os.path.join(self.revd, 'job_12 123456pg1.pdf'),
+                   os.path.join(self.revd, '123456pg1.pdf'))
+        self.assertEqual(load_plan(path)['renames'], {self.revd: {}})
+
+    def test_execute_keeps_queue(self):
+        planned = build_plan()
+        queue_file = os.path.join(self.corp, 'queue.json')
+        args = unittest.mock.Mock(missing_coc='defer', missing_pdfs='defer')
+        with unittest.mock.patch('PDF_collator.QUEUE_FILE', queue_file), \
+             unittest.mock.patch('sys.stdout'):
+            save_queue(['123456-458.pdf'], [])
+            first = load_queue()['reports']['123456-458.pdf']
+            plan = plan_run(args, planned['reports'],
+                            planned['unmatched_pdfs'], planned['renames'])
+            queue = load_queue()
+        self.assertEqual(plan['deferred'], ['123456-458.pdf'])
+        self.assertEqual(plan['renames'], planned['renames'])
+        # Still deferred since the first run, and the PDF without a CoC
+        # is queued too
+        self.assertEqual(queue['reports'], {'123456-458.pdf': first})
+        self.assertEqual(list(queue['pdfs']), ['999999pg1.pdf'])
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        for d in self.dirs:
+            d.cleanup()
+
+
+class RunHistory(unittest.TestCase):
+    """Test runs are added to the history database and summarized."""
+
+    def setUp(self):
+        self.home = TemporaryDirectory()
+        self.patches = [
+            unittest.mock.patch('PDF_collator.HISTORY_DB',
+                                os.path.join(self.home.name, 'history.sqlite')),
+            unittest.mock.patch('PDF_collator.COC_SOURCES',
+                                {'austin': '/scans/austin',
+                                 'corpus': '/scans/corpus'})]
+        for patch in self.patches:
+            patch.start()
+
+    def report(self, coc, pages):
+        return {'coc': coc, 'pdfs': ['p%d.pdf' % i for i in range(pages)],
+                'missing_pdfs': None}
+
+    def stats(self, seconds, bytes_in=1000, bytes_out=250, cached=False):
+        return {'backend': 'gs', 'profile': 'default', 'bytes_in': bytes_in,
+                'bytes_out': bytes_out, 'seconds': seconds, 'cached': cached,
+                'attempts': 1}
+
+    def test_record_and_summarize(self):
+        reports = [
+            ('1.pdf', self.report('/scans/austin/1coc.pdf', 1), self.stats(1)),
+            ('2.pdf', self.report('/scans/austin/2coc.pdf', 3), self.stats(2)),
+            ('3.pdf', self.report('/scans/corpus/3coc.pdf', 1), self.stats(3)),
+            ('4.pdf', self.report('/scans/corpus/4coc.pdf', 1),
+             self.stats(0, cached=True)),
+            ('5.pdf', self.report('/scans/corpus/5coc.pdf', 1), "Skipped"),
+            ('6.pdf', None, "Failed")]
+        self.assertIsNotNone(record_run(reports, time.time() - 10, 2))
+
+        stats = history_stats()
+        self.assertEqual(stats['runs'], 1)
+        self.assertEqual(stats['outcomes'], {'collated': 3, 'cached': 1,
+                                             'skipped': 1, 'failed': 1})
+        overall = stats['overall']
+        self.assertEqual(overall['reports'], 3)
+        self.assertEqual(overall['seconds']['p50'], 2)
+        self.assertEqual(overall['bytes_per_second'], 500)
+        self.assertEqual(overall['reduction'], 0.75)
+        self.assertEqual(stats['sites']['austin']['reports'], 2)
+        self.assertEqual(stats['sites']['corpus']['seconds']['p50'], 3)
+        self.assertEqual(list(stats['batch_sizes']), ['2-9'])
+
+    def test_days(self):
+        report = self.report('/scans/austin/1coc.pdf', 1)
+        record_run([('1.pdf', report, self.stats(1))],
+                   time.time() - 40 * 86400)
+        record_run([('1.pdf', report, self.stats(1))], time.time())
+        self.assertEqual(history_stats()['runs'], 2)
+        self.assertEqual(history_stats(30)['runs'], 1)
+
+    def test_unwritable(self):
+        with unittest.mock.patch('PDF_collator.HISTORY_DB',
+                                 os.path.join(self.home.name, 'no', 'db')):
+            self.assertIsNone(record_run([('1.pdf', None, "Failed")],
+                                         time.time()))
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(percentile([4, 1, 3, 2], 0.5), 2.5)
+        self.assertEqual(percentile([1, 2, 3], 0.99), 2.98)
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.home.cleanup()
+
+
 class SizeCheck(unittest.TestCase):
     """Test for total_file_size() function.
     